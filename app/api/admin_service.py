@@ -1,20 +1,24 @@
+import asyncio
 import csv
 import io
+import os
 from datetime import datetime
 from pathlib import Path
 from typing import List, Optional, Any, Dict, Tuple
 
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, status
 from fastapi.responses import StreamingResponse
-from sqlalchemy import func
+from sqlalchemy import func, insert, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import select
 from openpyxl import Workbook, load_workbook
 from openpyxl.worksheet.datavalidation import DataValidation
 
 from app.api.deps import get_current_admin_user
-from app.core.config import get_session
+from app.core.config import get_session, get_pool_status
 from app.core.security import get_password_hash
+from app.services.audit_log import audit_log_writer, get_audit_session
+from app.services.principal_cache import invalidate_principal
 from app.models.user import UserAccount, UserRole, UserActionLog
 from app.models.hospital import Doctor, Nurse, Department, Ward, Gender, Payment, Patient
 from app.schemas.user import StaffAccountCreate, UserAccountSafe, UserActionLogRead
@@ -32,6 +36,8 @@ router = APIRouter()
 MANAGEABLE_ROLES = {UserRole.DOCTOR, UserRole.NURSE, UserRole.PHARMACIST}
 DEFAULT_PASSWORD = "123456"
 TEMPLATE_DATA_ROWS = 500
+# 批量导入时每个事务写入的账号行数，IN 查询也按此分批
+STAFF_IMPORT_CHUNK_SIZE = int(os.getenv("STAFF_IMPORT_CHUNK_SIZE", "500"))
 
 IMPORT_TEMPLATE_HEADERS: List[Tuple[str, str]] = [
     ("phone", "手机号 (必填)"),
@@ -156,9 +162,10 @@ async def _read_import_rows(upload_file: UploadFile) -> List[Tuple[int, Dict[str
     content = await upload_file.read()
     if not content:
         return []
+    # 解析大文件是纯 CPU 工作，放到线程中避免阻塞事件循环
     if suffix == ".csv":
-        return _parse_csv_bytes(content)
-    return _parse_excel_bytes(content)
+        return await asyncio.to_thread(_parse_csv_bytes, content)
+    return await asyncio.to_thread(_parse_excel_bytes, content)
 
 
 def _safe_text(value: Any) -> str:
@@ -339,10 +346,12 @@ def _to_safe(account: UserAccount) -> UserAccountSafe:
     )
 
 
-async def _create_staff_account_record(payload: StaffAccountCreate, session: AsyncSession) -> UserAccount:
+def _validate_staff_payload(payload: StaffAccountCreate) -> Optional[str]:
+    """Field checks shared by single and bulk creation; returns the normalized doctor title."""
     if payload.role not in MANAGEABLE_ROLES:
         raise HTTPException(status_code=400, detail="仅能创建医生/护士/药师账号")
 
+    doctor_title = None
     if payload.role == UserRole.DOCTOR:
         if not payload.dept_id:
             raise HTTPException(status_code=400, detail="医生账号必须指定所属科室")
@@ -357,19 +366,22 @@ async def _create_staff_account_record(payload: StaffAccountCreate, session: Asy
         if doctor_title not in ALLOWED_DOCTOR_TITLES:
             raise HTTPException(status_code=400, detail="医生级别仅支持专家医师或普通医师")
 
-        dept = (
-            await session.execute(select(Department).where(Department.dept_id == payload.dept_id))
-        ).scalars().first()
-        if not dept:
-            raise HTTPException(status_code=404, detail="指定的科室不存在")
-    else:
-        doctor_title = None
-
     if payload.role == UserRole.NURSE:
         if not payload.nurse_name:
             raise HTTPException(status_code=400, detail="请提供护士姓名")
         if not payload.nurse_gender:
             raise HTTPException(status_code=400, detail="请提供护士性别")
+    return doctor_title
+
+
+async def _create_staff_account_record(payload: StaffAccountCreate, session: AsyncSession) -> UserAccount:
+    doctor_title = _validate_staff_payload(payload)
+    if payload.role == UserRole.DOCTOR:
+        dept = (
+            await session.execute(select(Department).where(Department.dept_id == payload.dept_id))
+        ).scalars().first()
+        if not dept:
+            raise HTTPException(status_code=404, detail="指定的科室不存在")
 
     phone_exists = (
         await session.execute(select(UserAccount).where(UserAccount.phone == payload.phone))
@@ -387,7 +399,7 @@ async def _create_staff_account_record(payload: StaffAccountCreate, session: Asy
         phone=payload.phone,
         username=payload.username,
         role=payload.role,
-        password_hash=get_password_hash(DEFAULT_PASSWORD),
+        password_hash=await asyncio.to_thread(get_password_hash, DEFAULT_PASSWORD),
         status="启用"
     )
 
@@ -438,9 +450,179 @@ async def _create_staff_account_record(payload: StaffAccountCreate, session: Asy
         await session.commit()
         await session.refresh(nurse)
 
+    invalidate_principal(account.phone)
     return account
 
 
+StagedStaffRow = Tuple[int, StaffAccountCreate, Optional[str]]
+
+
+async def _existing_values(session: AsyncSession, column: Any, values: Any) -> set:
+    """Which of ``values`` already exist in ``column``, with one IN query per chunk."""
+    values = list(values)
+    found = set()
+    for start in range(0, len(values), STAFF_IMPORT_CHUNK_SIZE):
+        batch = values[start:start + STAFF_IMPORT_CHUNK_SIZE]
+        found.update((await session.execute(select(column).where(column.in_(batch)))).scalars().all())
+    return found
+
+
+async def _existing_profile_ids(session: AsyncSession, model: Any, id_column: Any, phones: List[str]) -> Dict[str, int]:
+    profile_ids: Dict[str, int] = {}
+    for start in range(0, len(phones), STAFF_IMPORT_CHUNK_SIZE):
+        batch = phones[start:start + STAFF_IMPORT_CHUNK_SIZE]
+        stmt = select(model.phone, id_column).where(model.phone.in_(batch)).order_by(id_column)
+        for phone, profile_id in (await session.execute(stmt)).all():
+            profile_ids.setdefault(phone, profile_id)
+    return profile_ids
+
+
+async def _write_staff_chunk(
+    session: AsyncSession,
+    chunk: List[StagedStaffRow],
+    password_hash: str,
+    doctor_ids: Dict[str, int],
+    nurse_ids: Dict[str, int],
+) -> None:
+    """Insert one chunk of accounts plus their doctor/nurse profiles; the caller commits.
+
+    Like ``_create_staff_account_record``, a profile that already exists for
+    the phone is updated instead of duplicated.
+    """
+    now = datetime.now()
+    await session.execute(insert(UserAccount), [
+        {
+            "phone": payload.phone,
+            "username": payload.username,
+            "password_hash": password_hash,
+            "role": payload.role,
+            "status": "启用",
+            "register_time": now,
+        }
+        for _, payload, _ in chunk
+    ])
+
+    new_doctors: List[Dict[str, Any]] = []
+    new_nurses: List[Dict[str, Any]] = []
+    for _, payload, doctor_title in chunk:
+        if payload.role == UserRole.DOCTOR:
+            values = {
+                "name": payload.doctor_name,
+                "gender": payload.doctor_gender if isinstance(payload.doctor_gender, Gender) else Gender(payload.doctor_gender),
+                "title": doctor_title or ALLOWED_DOCTOR_TITLES[0],
+                "dept_id": payload.dept_id,
+            }
+            if payload.phone in doctor_ids:
+                await session.execute(
+                    update(Doctor).where(Doctor.doctor_id == doctor_ids[payload.phone]).values(**values)
+                    .execution_options(synchronize_session=False)
+                )
+            else:
+                new_doctors.append({**values, "phone": payload.phone})
+        elif payload.role == UserRole.NURSE:
+            values = {
+                "name": payload.nurse_name,
+                "gender": payload.nurse_gender if isinstance(payload.nurse_gender, Gender) else Gender(payload.nurse_gender),
+            }
+            if payload.phone in nurse_ids:
+                await session.execute(
+                    update(Nurse).where(Nurse.nurse_id == nurse_ids[payload.phone]).values(**values)
+                    .execution_options(synchronize_session=False)
+                )
+            else:
+                new_nurses.append({**values, "phone": payload.phone, "is_head_nurse": False})
+    if new_doctors:
+        await session.execute(insert(Doctor), new_doctors)
+    if new_nurses:
+        await session.execute(insert(Nurse), new_nurses)
+
+
+async def _import_staff_rows(
+    rows: List[Tuple[int, Dict[str, Any]]],
+    session: AsyncSession,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Validate every row in memory, then insert the accepted ones in chunks.
+
+    Rows are checked in file order with the same rules and messages as
+    ``_create_staff_account_record``: a phone or username taken by the
+    database or by an earlier accepted row is rejected. Existence checks are
+    a few IN queries for the whole file, and the shared default password is
+    hashed once in a worker thread.
+    """
+    errors: List[Dict[str, Any]] = []
+    staged: List[StagedStaffRow] = []
+    for row_number, row_data in rows:
+        try:
+            payload = _row_to_payload(row_data)
+            staged.append((row_number, payload, _validate_staff_payload(payload)))
+        except ValueError as exc:
+            errors.append({"row_number": row_number, "message": str(exc)})
+        except HTTPException as exc:
+            errors.append({"row_number": row_number, "message": str(exc.detail)})
+
+    dept_ids = await _existing_values(
+        session, Department.dept_id, {payload.dept_id for _, payload, _ in staged if payload.role == UserRole.DOCTOR}
+    )
+    taken_phones = await _existing_values(session, UserAccount.phone, {payload.phone for _, payload, _ in staged})
+    taken_usernames = await _existing_values(session, UserAccount.username, {payload.username for _, payload, _ in staged})
+
+    accepted: List[StagedStaffRow] = []
+    for item in staged:
+        row_number, payload, _ = item
+        if payload.role == UserRole.DOCTOR and payload.dept_id not in dept_ids:
+            message = "指定的科室不存在"
+        elif payload.phone in taken_phones:
+            message = "该手机号已被注册"
+        elif payload.username in taken_usernames:
+            message = "该用户名已被占用"
+        else:
+            taken_phones.add(payload.phone)
+            taken_usernames.add(payload.username)
+            accepted.append(item)
+            continue
+        errors.append({"row_number": row_number, "message": message})
+
+    success_items: List[Dict[str, Any]] = []
+    if accepted:
+        doctor_ids = await _existing_profile_ids(
+            session, Doctor, Doctor.doctor_id, [payload.phone for _, payload, _ in accepted if payload.role == UserRole.DOCTOR]
+        )
+        nurse_ids = await _existing_profile_ids(
+            session, Nurse, Nurse.nurse_id, [payload.phone for _, payload, _ in accepted if payload.role == UserRole.NURSE]
+        )
+        password_hash = await asyncio.to_thread(get_password_hash, DEFAULT_PASSWORD)
+
+    for start in range(0, len(accepted), STAFF_IMPORT_CHUNK_SIZE):
+        chunk = accepted[start:start + STAFF_IMPORT_CHUNK_SIZE]
+        try:
+            await _write_staff_chunk(session, chunk, password_hash, doctor_ids, nurse_ids)
+            await session.commit()
+            written = chunk
+        except Exception:  # noqa: W0703
+            await session.rollback()
+            # 整批失败（如并发请求抢先创建了同一账号）时逐行重试，仍按行报告错误
+            written = []
+            for item in chunk:
+                try:
+                    await _write_staff_chunk(session, [item], password_hash, doctor_ids, nurse_ids)
+                    await session.commit()
+                    written.append(item)
+                except Exception as exc:  # noqa: W0703
+                    await session.rollback()
+                    errors.append({"row_number": item[0], "message": str(exc)})
+        for row_number, payload, _ in written:
+            invalidate_principal(payload.phone)
+            success_items.append({
+                "row_number": row_number,
+                "phone": payload.phone,
+                "username": payload.username,
+                "role": payload.role.value
+            })
+
+    errors.sort(key=lambda item: item["row_number"])
+    return success_items, errors
+
+
 @router.get("/admin/accounts", response_model=List[UserAccountSafe])
 async def list_staff_accounts(
     role: Optional[UserRole] = None,
@@ -484,6 +666,7 @@ async def delete_staff_account(
     account.status = "禁用"
     session.add(account)
     await session.commit()
+    invalidate_principal(phone)
 
 
 @router.get("/admin/accounts/template")
@@ -514,28 +697,7 @@ async def import_staff_accounts(
     if not rows:
         raise HTTPException(status_code=400, detail="导入文件为空或缺少数据")
 
-    success_items: List[Dict[str, Any]] = []
-    errors: List[Dict[str, Any]] = []
-
-    for row_number, row_data in rows:
-        try:
-            payload = _row_to_payload(row_data)
-        except ValueError as exc:
-            errors.append({"row_number": row_number, "message": str(exc)})
-            continue
-
-        try:
-            account = await _create_staff_account_record(payload, session)
-            success_items.append({
-                "row_number": row_number,
-                "phone": account.phone,
-                "username": account.username,
-                "role": account.role.value
-            })
-        except HTTPException as exc:
-            errors.append({"row_number": row_number, "message": str(exc.detail)})
-        except Exception as exc:  # noqa: W0703
-            errors.append({"row_number": row_number, "message": str(exc)})
+    success_items, errors = await _import_staff_rows(rows, session)
 
     return {
         "total_rows": len(rows),
@@ -552,7 +714,7 @@ async def list_action_logs(
     path_prefix: Optional[str] = None,
     limit: int = 200,
     _: UserAccount = Depends(get_current_admin_user),
-    session: AsyncSession = Depends(get_session),
+    session: AsyncSession = Depends(get_audit_session),
 ):
     max_limit = 500
     take = limit if 0 < limit <= max_limit else max_limit
@@ -569,6 +731,14 @@ async def list_action_logs(
     return result.scalars().all()
 
 
+@router.get("/admin/db/pool")
+async def get_db_pool_status(
+    _: UserAccount = Depends(get_current_admin_user),
+):
+    # 数据库连接池实时状态（已用/空闲/溢出连接数及配置上限），以及审计日志写入队列状态
+    return {**get_pool_status(), "audit_log": audit_log_writer.stats()}
+
+
 @router.get("/admin/doctors")
 async def list_doctors(
     _: UserAccount = Depends(get_current_admin_user),
@@ -615,6 +785,7 @@ async def update_doctor_title(
     doctor.title = payload.title
     session.add(doctor)
     await session.commit()
+    invalidate_principal(doctor.phone)
     await session.refresh(doctor)
     return doctor
 
@@ -648,6 +819,7 @@ async def update_nurse_head_status(
     nurse.is_head_nurse = payload.is_head_nurse
     session.add(nurse)
     await session.commit()
+    invalidate_principal(nurse.phone)
     await session.refresh(nurse)
     return nurse
 
@@ -13,6 +13,7 @@ from app.core.time_utils import now_bj
 from app.schemas.user import UserCreate, Token, UserAccountSafe
 from app.schemas.user import ChangePassword
 from app.api.deps import get_current_user
+from app.services.principal_cache import invalidate_principal
 from app.models.user import UserRole
 
 router = APIRouter()
@@ -137,12 +138,18 @@ async def change_password(
     current_user: UserAccount = Depends(get_current_user),
     session: AsyncSession = Depends(get_session)
 ):
+    # current_user 来自主体缓存，校验与修改都基于当前会话中重新加载的账号
+    account = await session.get(UserAccount, current_user.phone)
+    if not account:
+        raise HTTPException(status_code=401, detail="用户不存在或已失效")
+
     # 验证当前密码
-    if not verify_password(payload.current_password, current_user.password_hash):
+    if not verify_password(payload.current_password, account.password_hash):
         raise HTTPException(status_code=400, detail="当前密码不正确")
 
     # 更新密码
-    current_user.password_hash = get_password_hash(payload.new_password)
-    session.add(current_user)
+    account.password_hash = get_password_hash(payload.new_password)
+    session.add(account)
     await session.commit()
+    invalidate_principal(account.phone)
     return {"detail": "密码已更新"}
\ No newline at end of file
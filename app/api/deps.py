@@ -1,46 +1,96 @@
-from fastapi import Depends, HTTPException, status
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlmodel import select
 
 from app.core.security import SECRET_KEY, ALGORITHM
 from app.core.config import get_session
+from app.models.hospital import Patient
 from app.models.user import UserAccount, UserRole
+from app.services.principal_cache import Principal, load_principal, principal_cache
 
 # 1. 定义认证模式
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
-# 2. 核心依赖函数：从 Token 获取手机号
-async def get_current_user_phone(token: str = Depends(oauth2_scheme)) -> str:
+
+def decode_token_claims(request: Optional[Request], token: Optional[str]) -> Optional[dict]:
+    """Decode a JWT once per request; the result is memoised on ``request.state``."""
+    if not token:
+        return None
+    if request is not None:
+        cached = getattr(request.state, "auth_claims", None)
+        if cached is not None and cached[0] == token:
+            return cached[1]
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        payload = None
+    if request is not None:
+        request.state.auth_claims = (token, payload)
+    return payload
+
+
+def _decode_phone(token: Optional[str], request: Optional[Request] = None) -> str:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="无效的认证凭据",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        # 解码 Token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phone: str = payload.get("sub")
-        if phone is None:
-            raise credentials_exception
-        return phone
-    except JWTError:
+    payload = decode_token_claims(request, token)
+    if payload is None:
         raise credentials_exception
+    phone: str = payload.get("sub")
+    if phone is None:
+        raise credentials_exception
+    return phone
+
+
+# 2. 核心依赖函数：从 Token 获取手机号
+async def get_current_user_phone(request: Request, token: str = Depends(oauth2_scheme)) -> str:
+    return _decode_phone(token, request)
+
 
+# 2b. 长连接（SSE）场景：EventSource 无法设置请求头，允许通过 ?token= 传递
+async def get_stream_user_phone(request: Request, token: Optional[str] = None) -> str:
+    auth_header = request.headers.get("Authorization", "")
+    if auth_header.lower().startswith("bearer "):
+        return _decode_phone(auth_header.split(" ", 1)[1], request)
+    return _decode_phone(token, request)
 
-async def get_current_user(
+
+# 3. 当前登录主体（账号 + 患者/医生/护士档案），先查请求内缓存，再查进程级 TTL 缓存
+async def get_current_principal(
+    request: Request,
     phone: str = Depends(get_current_user_phone),
     session: AsyncSession = Depends(get_session)
-) -> UserAccount:
-    stmt = select(UserAccount).where(UserAccount.phone == phone)
-    user = (await session.execute(stmt)).scalars().first()
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="用户不存在或已失效")
-    return user
+) -> Principal:
+    principal = getattr(request.state, "principal", None)
+    if principal is not None and principal.phone == phone:
+        return principal
+    principal = principal_cache.get(phone)
+    if principal is None:
+        principal = await load_principal(session, phone)
+        if principal is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="用户不存在或已失效")
+        principal_cache.put(principal)
+    request.state.principal = principal
+    return principal
+
+
+async def get_current_user(principal: Principal = Depends(get_current_principal)) -> UserAccount:
+    return principal.account()
+
+
+async def get_current_patient(principal: Principal = Depends(get_current_principal)) -> Patient:
+    patient = principal.patient()
+    if not patient:
+        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
+    return patient
 
 
 async def get_current_admin_user(current_user: UserAccount = Depends(get_current_user)) -> UserAccount:
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="需要管理员权限")
-    return current_user
\ No newline at end of file
+    return current_user
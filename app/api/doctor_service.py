@@ -3,11 +3,11 @@ import os
 
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, update
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import func, or_
 from sqlalchemy.exc import IntegrityError
 from sqlmodel import select, SQLModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 import io
 import json
 from docx import Document
@@ -17,7 +17,7 @@ from docx.enum.text import WD_ALIGN_PARAGRAPH
 from app.core.config import get_session
 from app.core.time_utils import today_bj
 # --- 修改点：从 deps 导入，不再依赖 patient_service ---
-from app.api.deps import get_current_user_phone
+from app.api.deps import get_current_principal
 from app.models.user import UserAccount, UserRole
 from app.models.hospital import (
     Doctor,
@@ -32,14 +32,22 @@ from app.models.hospital import (
     PrescriptionDetail,
     Ward,
     Hospitalization,
+    HospitalizationCharge,
+    HospitalizationLedger,
     ExamResult,
     Medicine,
+    NurseCarePlan,
+    NursePlanMedicine,
     NurseTask,
 )
 from app.schemas.hospital import MedicalRecordCreate
 from app.schemas.hospital import ExaminationCreate, NurseTaskBatchCreate, NurseTaskPlan
 import random
+from app.services.bed_board import allocate_bed, free_beds, list_wards, release_bed
+from app.services.billing import ensure_ledger, plan_signature, record_task_charges
 from app.services.exam_price_catalog import exam_price_catalog
+from app.services.principal_cache import Principal
+from app.services.patient_events import EVENT_REGISTRATION_FINISHED, record_patient_event
 
 router = APIRouter()
 
@@ -51,16 +59,12 @@ class HospitalizePayload(SQLModel):
 
 # --- 辅助函数：获取当前登录的医生对象 ---
 async def get_current_doctor(
-        phone: str = Depends(get_current_user_phone),
-        session: AsyncSession = Depends(get_session)
+        principal: Principal = Depends(get_current_principal)
 ) -> Doctor:
-    user_stmt = select(UserAccount).where(UserAccount.phone == phone)
-    user = (await session.execute(user_stmt)).scalars().first()
-    if not user or user.role != UserRole.DOCTOR:
+    if principal.role != UserRole.DOCTOR:
         raise HTTPException(status_code=403, detail="无权访问：仅限医生操作")
 
-    doc_stmt = select(Doctor).where(Doctor.phone == phone)
-    doctor = (await session.execute(doc_stmt)).scalars().first()
+    doctor = principal.doctor()
     if not doctor:
         raise HTTPException(status_code=404, detail="未找到您的医生档案信息")
 
@@ -137,69 +141,74 @@ def estimate_service_fee(task_type: str) -> Optional[float]:
 EXAM_PRICE_FALLBACK = float(os.getenv("EXAM_PRICE_FALLBACK", "120"))
 
 
-async def _ensure_prescription_payments(
+async def _upsert_payments(
     session: AsyncSession,
     registration: Registration,
-    record: MedicalRecord,
+    payment_type: PaymentType,
+    ref_field: str,
+    amounts: Dict[int, float],
 ) -> None:
-    pres_stmt = select(Prescription).where(Prescription.record_id == record.record_id)
-    prescriptions = (await session.execute(pres_stmt)).scalars().all()
-    if not prescriptions:
+    """按关联的处方/检查批量补齐缴费：一次查询已有缴费，未缴费的更新金额，缺失的批量新增。"""
+    if not amounts:
         return
-
-    for pres in prescriptions:
-        amount = float(pres.total_amount or 0.0)
-        pay_stmt = select(Payment).where(Payment.pres_id == pres.pres_id)
-        existing = (await session.execute(pay_stmt)).scalars().first()
-        if existing:
-            existing.type = PaymentType.PRESCRIPTION
-            existing.patient_id = registration.patient_id
-            existing.reg_id = registration.reg_id
-            if getattr(existing, "status", "未缴费") != "已缴费":
-                existing.amount = amount
-            session.add(existing)
+    ref_column = getattr(Payment, ref_field)
+    existing_stmt = select(Payment).where(ref_column.in_(list(amounts))).order_by(Payment.payment_id)
+    existing: Dict[int, Payment] = {}
+    for payment in (await session.execute(existing_stmt)).scalars().all():
+        existing.setdefault(getattr(payment, ref_field), payment)
+
+    for ref_id, amount in amounts.items():
+        payment = existing.get(ref_id)
+        if payment:
+            payment.type = payment_type
+            payment.patient_id = registration.patient_id
+            payment.reg_id = registration.reg_id
+            if getattr(payment, "status", "未缴费") != "已缴费":
+                payment.amount = amount
+            session.add(payment)
         else:
             session.add(Payment(
-                type=PaymentType.PRESCRIPTION,
+                type=payment_type,
                 amount=amount,
                 patient_id=registration.patient_id,
                 reg_id=registration.reg_id,
-                pres_id=pres.pres_id,
                 status="未缴费",
+                **{ref_field: ref_id},
             ))
 
 
+async def _ensure_prescription_payments(
+    session: AsyncSession,
+    registration: Registration,
+    record: MedicalRecord,
+) -> None:
+    pres_stmt = select(Prescription.pres_id, Prescription.total_amount).where(Prescription.record_id == record.record_id)
+    amounts = {row.pres_id: float(row.total_amount or 0.0) for row in (await session.execute(pres_stmt)).all()}
+    await _upsert_payments(session, registration, PaymentType.PRESCRIPTION, "pres_id", amounts)
+
+
 async def _ensure_exam_payments(
     session: AsyncSession,
     registration: Registration,
     record: MedicalRecord,
 ) -> None:
+    # 价格已在开单时锁定在检查记录上；开单时未匹配到价格的检查在这里再按价格目录解析一次
     exam_stmt = select(Examination).where(Examination.record_id == record.record_id)
     exams = (await session.execute(exam_stmt)).scalars().all()
-    if not exams:
-        return
-
-    for exam in exams:
-        price_match = await exam_price_catalog.lookup_price(exam.type)
-        amount = price_match.price if price_match else EXAM_PRICE_FALLBACK
-        pay_stmt = select(Payment).where(Payment.exam_id == exam.exam_id)
-        existing = (await session.execute(pay_stmt)).scalars().first()
-        if existing:
-            existing.type = PaymentType.EXAM
-            existing.patient_id = registration.patient_id
-            existing.reg_id = registration.reg_id
-            if getattr(existing, "status", "未缴费") != "已缴费":
-                existing.amount = amount
-            session.add(existing)
-        else:
-            session.add(Payment(
-                type=PaymentType.EXAM,
-                amount=amount,
-                patient_id=registration.patient_id,
-                reg_id=registration.reg_id,
-                exam_id=exam.exam_id,
-                status="未缴费",
-            ))
+    unpriced = [exam for exam in exams if exam.price is None]
+    if unpriced:
+        matches = await exam_price_catalog.lookup_many(exam.type for exam in unpriced)
+        for exam in unpriced:
+            match = matches.get(exam.type)
+            if match is None:
+                continue
+            exam.price = match.price
+            exam.matched_name = match.matched_name
+            exam.catalog_version = match.catalog_version or None
+            session.add(exam)
+    # 仍未解析的检查暂按默认价计费，价格保持为空，由 backfill_exam_prices --sync-payments 修正未缴费金额
+    amounts = {exam.exam_id: exam.price if exam.price is not None else EXAM_PRICE_FALLBACK for exam in exams}
+    await _upsert_payments(session, registration, PaymentType.EXAM, "exam_id", amounts)
 
 
 # --- 接口 1: 医生排班 ---
@@ -209,42 +218,6 @@ async def get_my_schedule(
         session: AsyncSession = Depends(get_session)
 ):
     today = today_bj()
-    # Auto-expire overdue registrations (WAITING and visit_date has passed)
-    try:
-        overdue_stmt = select(Registration).where(
-            Registration.doctor_id == doctor.doctor_id,
-            Registration.status == RegStatus.WAITING,
-            Registration.visit_date < today,
-        )
-        overdue_regs = (await session.execute(overdue_stmt)).scalars().all()
-        for reg in overdue_regs:
-            reg.status = RegStatus.EXPIRED
-            session.add(reg)
-
-            pay_stmt = (
-                select(Payment)
-                .where(Payment.patient_id == reg.patient_id)
-                .where(
-                    or_(
-                        Payment.type == PaymentType.REGISTRATION,
-                        Payment.type == "挂号费",
-                        Payment.type == "REGISTRATION",
-                    )
-                )
-                .where(Payment.reg_id == reg.reg_id)
-                .order_by(Payment.time.desc(), Payment.payment_id.desc())
-            )
-            pay = (await session.execute(pay_stmt)).scalars().first()
-            if pay and getattr(pay, "status", "未缴费") != "已缴费":
-                pay.status = "已取消"
-                session.add(pay)
-
-        if overdue_regs:
-            await session.commit()
-    except Exception:
-        # best-effort; schedule should still load
-        pass
-
     # 返回排队中和办理中的挂号，医生在完成办理后挂号会被标记为已结束并从列表中消失
     stmt = select(Registration).where(
         Registration.doctor_id == doctor.doctor_id,
@@ -322,10 +295,15 @@ async def create_examination(
     choices = [r.value for r in ExamResult]
     result = random.choice(choices)
 
+    # 开单时锁定价格，完成办理时直接按此生成缴费
+    price_match = await exam_price_catalog.lookup_price(exam_in.type)
     new_exam = Examination(
         type=exam_in.type,
         result=result,
-        record_id=record.record_id
+        record_id=record.record_id,
+        price=price_match.price if price_match else None,
+        matched_name=price_match.matched_name if price_match else None,
+        catalog_version=(price_match.catalog_version or None) if price_match else None,
     )
     session.add(new_exam)
     await session.commit()
@@ -364,25 +342,18 @@ async def list_department_wards(
     doctor: Doctor = Depends(get_current_doctor),
     session: AsyncSession = Depends(get_session)
 ):
-    stmt = select(Ward).where(Ward.dept_id == doctor.dept_id)
-    wards = (await session.execute(stmt)).scalars().all()
-    out = []
-    for ward in wards:
-        count_stmt = select(func.count()).where(
-            Hospitalization.ward_id == ward.ward_id,
-            Hospitalization.status == "在院"
-        )
-        occupied = (await session.execute(count_stmt)).scalar_one() or 0
-        available = max(ward.bed_count - occupied, 0)
-        out.append({
+    wards = await list_wards(session, dept_id=doctor.dept_id)
+    return [
+        {
             "ward_id": ward.ward_id,
             "type": ward.type,
             "bed_count": ward.bed_count,
-            "occupied": occupied,
-            "available": available,
-            "is_full": occupied >= ward.bed_count
-        })
-    return out
+            "occupied": ward.occupied_beds,
+            "available": free_beds(ward),
+            "is_full": ward.occupied_beds >= ward.bed_count
+        }
+        for ward in wards
+    ]
 
 
 @router.get("/inpatients")
@@ -567,6 +538,9 @@ async def create_nurse_tasks(
     if not hospitalization.ward_id:
         raise HTTPException(status_code=400, detail="该住院记录缺少病房信息")
 
+    # 先确保台账存在（旧住院记录懒重建），再添加新任务，避免新任务被重复计入
+    await ensure_ledger(session, hospitalization)
+
     now = datetime.now()
     created_tasks: List[NurseTask] = []
     for plan in payload.plans:
@@ -577,8 +551,27 @@ async def create_nurse_tasks(
         if not schedule_times:
             raise HTTPException(status_code=400, detail=f"{plan.type} 未生成任何护理任务，请检查频次设置")
 
-        snapshot = json.dumps([item.dict() for item in plan.medicines], ensure_ascii=False) if plan.medicines else None
         detail_text = build_task_detail(plan)
+        # 药品明细只随计划存一份，展开出的各次任务通过 plan_id 引用
+        medicines_json = json.dumps([item.dict() for item in plan.medicines], ensure_ascii=False) if plan.medicines else None
+        care_plan = NurseCarePlan(
+            hosp_id=hosp_id,
+            type=plan.type,
+            detail=detail_text,
+            signature=plan_signature(medicines_json, detail_text) if medicines_json else None,
+        )
+        session.add(care_plan)
+        await session.flush()
+        session.add_all([
+            NursePlanMedicine(
+                plan_id=care_plan.plan_id,
+                medicine_id=item.medicine_id,
+                name=item.name,
+                quantity=item.quantity,
+                usage=item.usage,
+            )
+            for item in plan.medicines
+        ])
 
         for scheduled_time in schedule_times:
             if scheduled_time <= now:
@@ -589,8 +582,8 @@ async def create_nurse_tasks(
                 time=scheduled_time,
                 hosp_id=hosp_id,
                 detail=detail_text,
-                medicine_snapshot=snapshot,
                 service_fee=service_fee,
+                plan_id=care_plan.plan_id,
             )
             session.add(task)
             created_tasks.append(task)
@@ -598,6 +591,8 @@ async def create_nurse_tasks(
     if not created_tasks:
         raise HTTPException(status_code=400, detail="未生成任何护理任务，请检查任务计划配置")
 
+    await session.flush()
+    await record_task_charges(session, hosp_id, created_tasks)
     await session.commit()
     for task in created_tasks:
         await session.refresh(task)
@@ -667,6 +662,19 @@ async def list_my_department_doctors(
     ]
 
 
+async def _delete_stay_records(session: AsyncSession, hosp_id: int) -> None:
+    """Delete the rows that reference a stay, children first, so the stay itself can be deleted."""
+    plan_ids = select(NurseCarePlan.plan_id).where(NurseCarePlan.hosp_id == hosp_id)
+    for stmt in (
+        delete(HospitalizationCharge).where(HospitalizationCharge.hosp_id == hosp_id),
+        delete(NurseTask).where(NurseTask.hosp_id == hosp_id),
+        delete(NursePlanMedicine).where(NursePlanMedicine.plan_id.in_(plan_ids)),
+        delete(NurseCarePlan).where(NurseCarePlan.hosp_id == hosp_id),
+        delete(HospitalizationLedger).where(HospitalizationLedger.hosp_id == hosp_id),
+    ):
+        await session.execute(stmt.execution_options(synchronize_session=False))
+
+
 @router.post("/consultations/{reg_id}/hospitalize")
 async def hospitalize_patient(
     reg_id: int,
@@ -699,26 +707,38 @@ async def hospitalize_patient(
         active_hosp, active_record, active_reg = active_row
         if active_reg.reg_id != registration.reg_id:
             raise HTTPException(status_code=400, detail="该患者已有在院住院单，无法重复办理")
-        # 同一挂号更换病房：若尚未完成办理，删除旧住院单；否则标记出院再新建
+        # 先以“在院”为条件把旧住院单标记出院：并发换房时只有一个请求能命中并释放旧床位。
+        # 同时比对入院时间，防止命中复用了同一编号的新住院单（SQLite 会复用已删除的最大编号）
+        result = await session.execute(
+            update(Hospitalization)
+            .where(Hospitalization.hosp_id == active_hosp.hosp_id)
+            .where(Hospitalization.status == "在院")
+            .where(Hospitalization.in_date == active_hosp.in_date)
+            .values(status="已出院", out_date=datetime.now())
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            await session.rollback()
+            raise HTTPException(status_code=400, detail="住院信息已变更，请刷新后重试")
+        # 尚未完成办理的挂号直接删除旧住院单（连同其台账、护理计划与任务）；已完成的保留为出院记录
         if registration.status != RegStatus.FINISHED:
-            await session.delete(active_hosp)
-        else:
-            active_hosp.status = "已出院"
-            active_hosp.out_date = datetime.now()
-        await session.flush()
+            try:
+                await _delete_stay_records(session, active_hosp.hosp_id)
+                await session.execute(
+                    delete(Hospitalization)
+                    .where(Hospitalization.hosp_id == active_hosp.hosp_id)
+                    .execution_options(synchronize_session=False)
+                )
+            except IntegrityError:
+                await session.rollback()
+                raise HTTPException(status_code=400, detail="住院办理失败，请稍后再试")
+        session.expunge(active_hosp)
+        await release_bed(session, active_hosp.ward_id)
 
     ward = await session.get(Ward, payload.ward_id)
     if not ward or ward.dept_id != doctor.dept_id:
         raise HTTPException(status_code=400, detail="请选择当前科室的有效病房")
 
-    count_stmt = select(func.count()).where(
-        Hospitalization.ward_id == ward.ward_id,
-        Hospitalization.status == "在院"
-    )
-    occupied = (await session.execute(count_stmt)).scalar_one() or 0
-    if occupied >= ward.bed_count:
-        raise HTTPException(status_code=400, detail="该病房已满，请选择其他病房")
-
     target_doc_id = payload.hosp_doctor_id or doctor.doctor_id
     target_doc_stmt = (
         select(Doctor)
@@ -731,6 +751,11 @@ async def hospitalize_patient(
     if not target_doc:
         raise HTTPException(status_code=400, detail="请选择当前科室的有效住院医生")
 
+    # 条件更新占床：两位医生同时抢最后一张床时只有一个能成功
+    if not await allocate_bed(session, ward.ward_id):
+        await session.rollback()
+        raise HTTPException(status_code=400, detail="该病房已满，请选择其他病房")
+
     hosp = Hospitalization(
         ward_id=ward.ward_id,
         status="在院",
@@ -739,6 +764,9 @@ async def hospitalize_patient(
     )
     session.add(hosp)
     try:
+        await session.flush()
+        # 新住院记录直接建空台账，之后随护理任务增量记账
+        session.add(HospitalizationLedger(hosp_id=hosp.hosp_id))
         await session.commit()
     except IntegrityError as exc:
         await session.rollback()
@@ -872,6 +900,7 @@ async def finish_handling(
         await _ensure_prescription_payments(session, registration, record)
         await _ensure_exam_payments(session, registration, record)
 
+    record_patient_event(session, registration.patient_id, EVENT_REGISTRATION_FINISHED, reg_id=registration.reg_id)
     await session.commit()
     await session.refresh(registration)
     return registration
\ No newline at end of file
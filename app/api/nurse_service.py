@@ -1,15 +1,15 @@
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Query, status
-from sqlalchemy import delete, func
+from sqlalchemy import and_, case, delete, or_, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import select
 
 from app.core.config import get_session
 # 关键：从 deps 导入，防止循环引用
-from app.api.deps import get_current_user_phone
-from app.models.user import UserAccount, UserRole
+from app.api.deps import get_current_principal
+from app.models.user import UserRole
 from app.models.hospital import (
     Nurse,
     NurseSchedule,
@@ -37,23 +37,28 @@ from app.schemas.nurse import (
     WardTaskItem,
 )
 
+from app.services.bed_board import list_wards, release_bed
 from app.services.billing import (
     DEFAULT_HOSPITAL_HOURLY_RATE,
     compute_hospitalization_bill,
+    ensure_ledger,
+    record_task_completion,
 )
+from app.services.nurse_duty import MAX_SHIFT, MAX_SHIFT_HOURS, find_overlapping_shifts, load_duty_index
+from app.services.nurse_roster import build_slots, generate_roster, schedulable_nurse_ids
+from app.services.patient_events import EVENT_HOSPITALIZATION_DISCHARGED, record_patient_event
+from app.services.principal_cache import Principal
 
 router = APIRouter()
 
 
 async def get_current_nurse(
-        phone: str = Depends(get_current_user_phone),
-        session: AsyncSession = Depends(get_session)
+        principal: Principal = Depends(get_current_principal)
 ) -> Nurse:
-    user = (await session.execute(select(UserAccount).where(UserAccount.phone == phone))).scalars().first()
-    if not user or user.role != UserRole.NURSE:
+    if principal.role != UserRole.NURSE:
         raise HTTPException(status_code=403, detail="无权访问")
 
-    nurse = (await session.execute(select(Nurse).where(Nurse.phone == phone))).scalars().first()
+    nurse = principal.nurse()
     if not nurse:
         raise HTTPException(status_code=404, detail="未找到档案")
     return nurse
@@ -67,37 +72,6 @@ async def get_head_nurse(
     return nurse
 
 
-ScheduleEntry = Tuple[NurseSchedule, Nurse]
-ScheduleMap = Dict[int, List[ScheduleEntry]]
-
-
-async def load_schedule_map(session: AsyncSession, ward_ids: List[int]) -> ScheduleMap:
-    if not ward_ids:
-        return {}
-    stmt = (
-        select(NurseSchedule, Nurse)
-        .join(Nurse, NurseSchedule.nurse_id == Nurse.nurse_id)
-        .where(NurseSchedule.ward_id.in_(ward_ids))
-    )
-    rows = await session.execute(stmt)
-    schedule_map: ScheduleMap = {}
-    for schedule, nurse in rows.all():
-        bucket = schedule_map.setdefault(schedule.ward_id, [])
-        bucket.append((schedule, nurse))
-    for bucket in schedule_map.values():
-        bucket.sort(key=lambda entry: (entry[0].start_time, entry[0].end_time, entry[0].nurse_id))
-    return schedule_map
-
-
-def resolve_on_duty_nurse(schedule_map: ScheduleMap, ward_id: Optional[int], target_time: datetime) -> Optional[Nurse]:
-    if ward_id is None:
-        return None
-    for schedule, nurse in schedule_map.get(ward_id, []):
-        if schedule.start_time <= target_time <= schedule.end_time:
-            return nurse
-    return None
-
-
 async def nurse_has_assignment(
         session: AsyncSession,
         nurse: Nurse,
@@ -116,22 +90,6 @@ async def nurse_has_assignment(
     return assigned is not None
 
 
-async def _expire_overdue_tasks(session: AsyncSession, task_ids: list[int]) -> None:
-    if not task_ids:
-        return
-    now = datetime.now()
-    stmt = select(NurseTask).where(NurseTask.task_id.in_(task_ids))
-    tasks = (await session.execute(stmt)).scalars().all()
-    dirty = False
-    for task in tasks:
-        if task.status == "未完成" and task.time < now:
-            task.status = "已过期"
-            session.add(task)
-            dirty = True
-    if dirty:
-        await session.commit()
-
-
 @router.get("/profile", response_model=NurseProfile)
 async def get_nurse_profile(
     nurse: Nurse = Depends(get_current_nurse)
@@ -139,53 +97,94 @@ async def get_nurse_profile(
     return NurseProfile(nurse_id=nurse.nurse_id, name=nurse.name, is_head_nurse=nurse.is_head_nurse)
 
 
+def _task_status_column(now: datetime):
+    # 过期状态在查询时推导，不需要为读取而回写任务行
+    return case(
+        (and_(NurseTask.status == "未完成", NurseTask.time < now), "已过期"),
+        else_=NurseTask.status,
+    ).label("status")
+
+
 @router.get("/today_tasks", response_model=List[TodayTaskItem])
 async def list_today_tasks(
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="分页大小，不传则返回全部"),
+    after_time: Optional[datetime] = Query(None, description="上一页最后一条的任务时间"),
+    after_id: Optional[int] = Query(None, description="上一页最后一条的任务 ID"),
     nurse: Nurse = Depends(get_current_nurse),
     session: AsyncSession = Depends(get_session)
 ):
     today = datetime.now().date()
     start = datetime.combine(today, datetime.min.time())
     end = start + timedelta(days=1)
+    now = datetime.now()
 
     stmt = (
-        select(NurseTask, Patient, Hospitalization.ward_id)
+        select(
+            NurseTask.task_id,
+            NurseTask.type,
+            NurseTask.time,
+            _task_status_column(now),
+            Patient.name.label("patient_name"),
+            Hospitalization.ward_id,
+        )
         .join(Hospitalization, NurseTask.hosp_id == Hospitalization.hosp_id)
         .join(MedicalRecord, Hospitalization.record_id == MedicalRecord.record_id)
         .join(Registration, MedicalRecord.reg_id == Registration.reg_id)
         .join(Patient, Registration.patient_id == Patient.patient_id)
         .where(NurseTask.time >= start, NurseTask.time < end)
     )
+    if not nurse.is_head_nurse:
+        # 普通护士：先按自己今天的班次缩小到相关病房，再要求任务时间落在自己的某个班次内
+        my_wards = (
+            select(NurseSchedule.ward_id)
+            .where(NurseSchedule.nurse_id == nurse.nurse_id)
+            .where(NurseSchedule.start_time >= start - MAX_SHIFT)
+            .where(NurseSchedule.start_time < end)
+            .where(NurseSchedule.end_time >= start)
+        )
+        on_duty = (
+            select(NurseSchedule.schedule_id)
+            .where(NurseSchedule.nurse_id == nurse.nurse_id)
+            .where(NurseSchedule.ward_id == Hospitalization.ward_id)
+            .where(NurseSchedule.start_time <= NurseTask.time)
+            .where(NurseSchedule.end_time >= NurseTask.time)
+            .exists()
+        )
+        stmt = stmt.where(Hospitalization.ward_id.in_(my_wards)).where(on_duty)
+    if after_time is not None:
+        stmt = stmt.where(or_(
+            NurseTask.time > after_time,
+            and_(NurseTask.time == after_time, NurseTask.task_id > (after_id or 0)),
+        ))
+    stmt = stmt.order_by(NurseTask.time.asc(), NurseTask.task_id.asc())
+    if limit is not None:
+        stmt = stmt.limit(limit)
 
     rows = (await session.execute(stmt)).all()
-    task_ids = [t.task_id for t, _, _ in rows]
-    await _expire_overdue_tasks(session, task_ids)
+    if not rows:
+        return []
 
-    ward_ids = [ward_id for _, _, ward_id in rows if ward_id is not None]
-    schedule_map = await load_schedule_map(session, list(set(ward_ids)))
+    duty = None
+    if nurse.is_head_nurse:
+        # 护士长需要看到每条任务的值班护士，只为本页的病房和时间范围加载排班
+        ward_ids = {row.ward_id for row in rows if row.ward_id is not None}
+        duty = await load_duty_index(session, ward_ids, rows[0].time, rows[-1].time)
 
     payload: List[TodayTaskItem] = []
-    now = datetime.now()
-    for task, patient, ward_id in rows:
-        assigned_nurse = resolve_on_duty_nurse(schedule_map, ward_id, task.time)
-        if not nurse.is_head_nurse:
-            if not assigned_nurse or assigned_nurse.nurse_id != nurse.nurse_id:
-                continue
-
-        status = task.status
-        if status == "未完成" and task.time < now:
-            status = "已过期"
-        nurse_name = assigned_nurse.name if assigned_nurse else "未排班"
+    for row in rows:
+        if duty is None:
+            nurse_name = nurse.name
+        else:
+            assigned_nurse = duty.on_duty(row.ward_id, row.time)
+            nurse_name = assigned_nurse.name if assigned_nurse else "未排班"
         payload.append(TodayTaskItem(
-            task_id=task.task_id,
-            patient_name=patient.name,
-            type=task.type,
-            time=task.time,
-            status=status,
+            task_id=row.task_id,
+            patient_name=row.patient_name,
+            type=row.type,
+            time=row.time,
+            status=row.status,
             nurse_name=nurse_name,
         ))
-
-    payload.sort(key=lambda item: item.time)
     return payload
 
 
@@ -264,28 +263,14 @@ async def get_ward_overview(
         nurse: Nurse = Depends(get_current_nurse),
         session: AsyncSession = Depends(get_session)
 ):
-    if nurse.is_head_nurse:
-        ward_stmt = select(Ward)
-    else:
-        ward_stmt = select(Ward).join(NurseSchedule, NurseSchedule.ward_id == Ward.ward_id).where(
-            NurseSchedule.nurse_id == nurse.nurse_id
-        )
-    wards = (await session.execute(ward_stmt)).scalars().unique().all()
-
-    occupancy_stmt = (
-        select(Hospitalization.ward_id, func.count().label("occupied"))
-        .where(Hospitalization.status == "在院")
-        .group_by(Hospitalization.ward_id)
-    )
-    occupancy_rows = await session.execute(occupancy_stmt)
-    occupancy_map = {row.ward_id: row.occupied for row in occupancy_rows}
-
+    # 护士长看全部病房，普通护士只看排过班的病房；在院人数取自病床看板计数
+    wards = await list_wards(session, nurse_id=None if nurse.is_head_nurse else nurse.nurse_id)
     return [
         WardOverviewItem(
             ward_id=w.ward_id,
             ward_type=w.type,
             bed_count=w.bed_count,
-            occupied_count=int(occupancy_map.get(w.ward_id, 0)),
+            occupied_count=w.occupied_beds,
         )
         for w in wards
     ]
@@ -365,7 +350,14 @@ async def list_ward_tasks(
         return []
 
     stmt = (
-        select(NurseTask, Patient, Hospitalization.ward_id)
+        select(
+            NurseTask.task_id,
+            NurseTask.hosp_id,
+            NurseTask.type,
+            NurseTask.time,
+            _task_status_column(datetime.now()),
+            Patient.name.label("patient_name"),
+        )
         .join(Hospitalization, NurseTask.hosp_id == Hospitalization.hosp_id)
         .join(MedicalRecord, Hospitalization.record_id == MedicalRecord.record_id)
         .join(Registration, MedicalRecord.reg_id == Registration.reg_id)
@@ -375,24 +367,21 @@ async def list_ward_tasks(
     )
 
     rows = (await session.execute(stmt)).all()
-    task_ids = [t.task_id for t, _, _ in rows]
-    await _expire_overdue_tasks(session, task_ids)
+    if not rows:
+        return []
 
-    schedule_map = await load_schedule_map(session, [ward_id])
-    now = datetime.now()
+    # 只加载覆盖这些任务时间范围的排班
+    duty = await load_duty_index(session, [ward_id], rows[0].time, rows[-1].time)
     payload: List[WardTaskItem] = []
-    for task, patient, ward_ref in rows:
-        status = task.status
-        if status == "未完成" and task.time < now:
-            status = "已过期"
-        assigned_nurse = resolve_on_duty_nurse(schedule_map, ward_ref, task.time)
+    for row in rows:
+        assigned_nurse = duty.on_duty(ward_id, row.time)
         payload.append(WardTaskItem(
-            task_id=task.task_id,
-            hosp_id=task.hosp_id,
-            patient_name=patient.name,
-            type=task.type,
-            time=task.time,
-            status=status,
+            task_id=row.task_id,
+            hosp_id=row.hosp_id,
+            patient_name=row.patient_name,
+            type=row.type,
+            time=row.time,
+            status=row.status,
             nurse_name=assigned_nurse.name if assigned_nurse else "未排班",
         ))
     return payload
@@ -406,6 +395,8 @@ async def upsert_schedule_slot(
 ):
     if payload.end_time <= payload.start_time:
         raise HTTPException(status_code=400, detail="结束时间必须晚于开始时间")
+    if payload.end_time - payload.start_time > MAX_SHIFT:
+        raise HTTPException(status_code=400, detail=f"单个班次不能超过 {MAX_SHIFT_HOURS} 小时")
 
     ward = await session.get(Ward, payload.ward_id)
     if not ward:
@@ -432,6 +423,16 @@ async def upsert_schedule_slot(
         await session.commit()
         return {"detail": "排班已更新"}
 
+    # 被替换的原班次已在本事务中删除，剩下的重叠都是同一护士的其他班次
+    overlaps = await find_overlapping_shifts(session, sorted(set(payload.nurse_ids)), payload.start_time, payload.end_time)
+    if overlaps:
+        conflicts = "；".join(
+            f"{nurse.name}（病房 {schedule.ward_id}，{schedule.start_time:%m-%d %H:%M}~{schedule.end_time:%m-%d %H:%M}）"
+            for schedule, nurse in overlaps
+        )
+        await session.rollback()
+        raise HTTPException(status_code=400, detail=f"排班时间冲突：{conflicts}")
+
     for nurse_id in payload.nurse_ids:
         session.add(NurseSchedule(
             nurse_id=nurse_id,
@@ -464,54 +465,40 @@ async def auto_generate_schedules(
         session: AsyncSession = Depends(get_session)
 ):
     start_time = payload.start_time or datetime.now()
-    now = datetime.now()
     shift_hours = payload.shift_hours or 8
     shift_count = payload.shift_count or 3
+    days = payload.days or 1
+    if shift_hours > MAX_SHIFT_HOURS:
+        raise HTTPException(status_code=400, detail=f"单个班次不能超过 {MAX_SHIFT_HOURS} 小时")
+    if days > 1 and shift_hours * shift_count > 24:
+        raise HTTPException(status_code=400, detail="多天排班时每天的班次总时长不能超过 24 小时")
 
-    ward_stmt = (
-        select(Ward)
-        .join(Hospitalization, Hospitalization.ward_id == Ward.ward_id)
-        .where(Hospitalization.status == "在院")
-    )
+    wards = [ward for ward in await list_wards(session) if ward.occupied_beds > 0]
     if payload.ward_ids:
-        ward_stmt = ward_stmt.where(Ward.ward_id.in_(payload.ward_ids))
-    wards = (await session.execute(ward_stmt)).scalars().unique().all()
+        wanted = set(payload.ward_ids)
+        wards = [ward for ward in wards if ward.ward_id in wanted]
     if not wards:
         raise HTTPException(status_code=400, detail="未找到可排班的病房")
 
-    nurse_stmt = select(Nurse).where(Nurse.is_head_nurse == False)
-    nurses = (await session.execute(nurse_stmt)).scalars().all()
-    if not nurses:
-        nurses = (await session.execute(select(Nurse))).scalars().all()
-    if not nurses:
+    nurse_ids = await schedulable_nurse_ids(session)
+    if not nurse_ids:
         raise HTTPException(status_code=400, detail="暂无可排班的护士")
 
-    ward_ids = [w.ward_id for w in wards]
-    window_end = start_time + timedelta(hours=shift_hours * shift_count)
-    del_stmt = delete(NurseSchedule).where(
-        NurseSchedule.ward_id.in_(ward_ids),
-        NurseSchedule.start_time >= start_time,
-        NurseSchedule.start_time < window_end
-    )
-    await session.execute(del_stmt)
-
-    cursor = 0
-    for shift_index in range(shift_count):
-        slot_time = start_time + timedelta(hours=shift_hours * shift_index)
-        slot_end = slot_time + timedelta(hours=shift_hours)
-        for ward in wards:
-            nurse = nurses[cursor % len(nurses)]
-            session.add(NurseSchedule(
-                nurse_id=nurse.nurse_id,
-                ward_id=ward.ward_id,
-                start_time=slot_time,
-                end_time=slot_end
-            ))
-            cursor += 1
-
+    slots = build_slots(start_time, shift_hours, shift_count, days)
+    roster = await generate_roster(session, wards, nurse_ids, slots)
     await session.commit()
-    total_records = len(wards) * shift_count
-    return {"detail": f"已自动生成 {total_records} 条排班记录"}
+
+    detail = f"已自动生成 {len(roster.assignments)} 条排班记录"
+    if roster.unfilled:
+        detail += f"，{roster.unfilled} 个岗位因休息时间或每周班次上限未能排满"
+    if roster.uncovered:
+        detail += f"（其中 {roster.uncovered} 个病房班次无人值班）"
+    return {
+        "detail": detail,
+        "created": len(roster.assignments),
+        "unfilled": roster.unfilled,
+        "uncovered": roster.uncovered,
+    }
 
 
 @router.post("/tasks/{task_id}/complete")
@@ -534,19 +521,33 @@ async def complete_task(
     if task.status == "已完成":
         return {"detail": "任务已完成"}
 
-    # 若已过期，保持状态不变，仅提示；前端可自行隐藏
-    if task.status == "已过期":
-        return {"detail": "任务已过期", "status": task.status}
-
+    # 若已过期（已写入或按时间推导），保持状态不变，仅提示；过期状态由后台清扫统一落库
     now = datetime.now()
-    if task.time < now and task.status == "未完成":
-        task.status = "已过期"
-    else:
-        task.status = "已完成"
-
-    session.add(task)
+    if task.status == "已过期" or task.time < now:
+        return {"detail": "任务已过期", "status": "已过期"}
+
+    # 台账须在状态变化前就绪，懒重建时才不会提前计入本次服务费
+    if hospitalization:
+        await ensure_ledger(session, hospitalization)
+    # 条件更新：并发重复提交或恰好过期时只有满足条件的一次能生效，服务费不会重复计入
+    result = await session.execute(
+        update(NurseTask)
+        .where(NurseTask.task_id == task_id)
+        .where(NurseTask.status == "未完成")
+        .where(NurseTask.time >= now)
+        .values(status="已完成")
+        .execution_options(synchronize_session=False)
+    )
+    if (result.rowcount or 0) != 1:
+        await session.rollback()
+        current = (await session.execute(select(NurseTask.status).where(NurseTask.task_id == task_id))).scalar_one_or_none()
+        if current == "已完成":
+            return {"detail": "任务已完成"}
+        return {"detail": "任务已过期", "status": "已过期"}
+
+    await record_task_completion(session, task)
     await session.commit()
-    return {"detail": "任务状态已更新", "status": task.status}
+    return {"detail": "任务状态已更新", "status": "已完成"}
 
 
 @router.get("/head/inpatients")
@@ -612,9 +613,18 @@ async def discharge_inpatient(
     )
     amount = bill["total_fee"]
 
-    hospitalization.status = "已出院"
-    hospitalization.out_date = out_date
-    session.add(hospitalization)
+    # 条件更新出院状态：同一住院单并发出院时只有一次能命中，床位和账单也只处理一次
+    result = await session.execute(
+        update(Hospitalization)
+        .where(Hospitalization.hosp_id == hosp_id)
+        .where(Hospitalization.status == "在院")
+        .values(status="已出院", out_date=out_date)
+        .execution_options(synchronize_session=False)
+    )
+    if not result.rowcount:
+        await session.rollback()
+        raise HTTPException(status_code=400, detail="该患者已办理出院")
+    await release_bed(session, hospitalization.ward_id)
 
     payment = Payment(
         type=PaymentType.HOSPITAL,
@@ -625,6 +635,14 @@ async def discharge_inpatient(
         hosp_id=hospitalization.hosp_id
     )
     session.add(payment)
+    await session.flush()
+    record_patient_event(
+        session,
+        patient.patient_id,
+        EVENT_HOSPITALIZATION_DISCHARGED,
+        hosp_id=hospitalization.hosp_id,
+        payment_id=payment.payment_id,
+    )
 
     await session.commit()
     await session.refresh(payment)
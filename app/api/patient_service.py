@@ -1,20 +1,29 @@
 from datetime import datetime, timedelta, date
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import or_, func
+import json
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, case, or_, func
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import select
-from typing import List
+from typing import List, Optional
 
-from app.core.config import get_session
+from app.core.config import get_session, async_session
+from app.core.time_utils import now_bj, today_bj
 # --- 修改点：从 deps 导入 ---
-from app.api.deps import get_current_user_phone, get_current_user
+from app.api.deps import (
+    get_current_patient,
+    get_current_principal,
+    get_current_user,
+    get_current_user_phone,
+    get_stream_user_phone,
+)
 from app.models.hospital import (
     Patient,
     Department,
     Doctor,
     Registration,
     RegStatus,
-    RegType,
     MedicalRecord,
     PaymentType,
 )
@@ -31,90 +40,42 @@ from app.models.user import UserAccount, UserRole
 from app.schemas.hospital import PatientCreate, RegistrationCreate
 from app.services.billing import (
     DEFAULT_HOSPITAL_HOURLY_RATE,
-    compute_hospitalization_bill,
+    backfill_ledgers,
+    compute_hospitalization_bills,
+)
+from app.services.principal_cache import Principal, invalidate_principal
+from app.services.registration_slots import (
+    REGISTRATION_FEE,
+    cancel_and_release_slot,
+    department_availability,
+    normalize_reg_type,
+    reserve_slot,
+)
+from app.services.patient_events import (
+    EVENT_PAYMENT_PAID,
+    EVENT_PAYMENT_REFUNDED,
+    EVENT_REGISTRATION_CANCELLED,
+    SubscriberLimitExceeded,
+    patient_event_bus,
+    record_patient_event,
 )
 
 router = APIRouter()
 
-
-async def _apply_expired_registrations_for_patient(session: AsyncSession, patient_id: int) -> None:
-    """Mark overdue WAITING registrations as EXPIRED and sync registration fee payment status.
-
-    Rules:
-    - If today > visit_date and registration is WAITING, set registration.status = 已过期
-    - For an expired registration:
-        - if its registration fee payment is not 已缴费, set payment.status = 已取消
-        - if 已缴费, keep 已缴费 (no refund)
-    """
-
-    today = date.today()
-    stmt = select(Registration).where(
-        Registration.patient_id == patient_id,
-        Registration.status == RegStatus.WAITING,
-        Registration.visit_date < today,
-    )
-    regs = (await session.execute(stmt)).scalars().all()
-    if not regs:
-        return
-
-    for reg in regs:
-        with session.no_autoflush:
-            pay_stmt = (
-                select(Payment)
-                .where(Payment.patient_id == patient_id)
-                .where(
-                    or_(
-                        Payment.type == PaymentType.REGISTRATION,
-                        Payment.type == "挂号费",
-                        Payment.type == "REGISTRATION",
-                    )
-                )
-                .where(Payment.reg_id == reg.reg_id)
-                .order_by(Payment.time.desc(), Payment.payment_id.desc())
-            )
-            payment = (await session.execute(pay_stmt)).scalars().first()
-
-            # Backward compatibility: older rows may not have reg_id filled.
-            if not payment:
-                window_start = reg.reg_date - timedelta(hours=2)
-                window_end = reg.reg_date + timedelta(hours=2)
-                pay_stmt2 = (
-                    select(Payment)
-                    .where(Payment.patient_id == patient_id)
-                    .where(
-                        or_(
-                            Payment.type == PaymentType.REGISTRATION,
-                            Payment.type == "挂号费",
-                            Payment.type == "REGISTRATION",
-                        )
-                    )
-                    .where(Payment.pres_id.is_(None))
-                    .where(Payment.exam_id.is_(None))
-                    .where(Payment.hosp_id.is_(None))
-                    .where(Payment.time >= window_start)
-                    .where(Payment.time <= window_end)
-                    .order_by(Payment.time.desc(), Payment.payment_id.desc())
-                )
-                payment = (await session.execute(pay_stmt2)).scalars().first()
-
-        reg.status = RegStatus.EXPIRED
-        session.add(reg)
-
-        if payment and getattr(payment, "status", "未缴费") != "已缴费":
-            payment.status = "已取消"
-            session.add(payment)
-
-    await session.commit()
+# 提醒增量同步：游标回看窗口（覆盖 DATETIME 秒级截断与事务提交延迟），以及建议轮询间隔
+FEED_CURSOR_OVERLAP_SECONDS = 60
+FEED_POLL_ACTIVE_MS = 15000
+FEED_POLL_IDLE_MS = 60000
+# 事件推送：心跳间隔（保持代理/负载均衡不断开空闲连接）
+EVENT_STREAM_HEARTBEAT_SECONDS = 25
 
 
 # --- 接口 1: 查询患者档案 ---
 @router.get("/profile", response_model=Patient)
 async def get_patient_profile(
-        phone: str = Depends(get_current_user_phone),
-        session: AsyncSession = Depends(get_session)
+        principal: Principal = Depends(get_current_principal)
 ):
-    stmt = select(Patient).where(Patient.phone == phone)
-    patient = (await session.execute(stmt)).scalars().first()
+    patient = principal.patient()
     if not patient:
         raise HTTPException(status_code=404, detail="未找到档案")
     return patient
@@ -123,15 +84,9 @@ async def get_patient_profile(
 # --- 新：患者自查（基于登录 Token） ---
 @router.get("/medical_records", response_model=List[MedicalRecord])
 async def get_my_medical_records(
-    phone: str = Depends(get_current_user_phone),
+    patient: Patient = Depends(get_current_patient),
     session: AsyncSession = Depends(get_session)
 ):
-    # 通过登录手机号找到 Patient，再查病历
-    stmt = select(Patient).where(Patient.phone == phone)
-    patient = (await session.execute(stmt)).scalars().first()
-    if not patient:
-        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
-
     reg_stmt = select(Registration.reg_id).where(Registration.patient_id == patient.patient_id)
     reg_ids = (await session.execute(reg_stmt)).scalars().all()
     if not reg_ids:
@@ -193,12 +148,14 @@ async def create_or_update_patient_profile(
         for field, value in profile.dict().items():
             setattr(existing, field, value)
         await session.commit()
+        invalidate_principal(phone)
         await session.refresh(existing)
         return existing
 
     patient = Patient(phone=phone, **profile.dict())
     session.add(patient)
     await session.commit()
+    invalidate_principal(phone)
     await session.refresh(patient)
     return patient
 
@@ -225,6 +182,16 @@ async def get_doctors_by_dept(dept_id: int, session: AsyncSession = Depends(get_
     return result.scalars().all()
 
 
+# --- 科室号源余量：一次返回该科室所有医生当天各号别剩余号源 ---
+@router.get("/departments/{dept_id}/availability")
+async def get_department_availability(
+    dept_id: int,
+    visit_date: Optional[date] = None,
+    session: AsyncSession = Depends(get_session)
+):
+    return await department_availability(session, dept_id, visit_date or today_bj())
+
+
 @router.get("/doctors/id/{doctor_id}", response_model=Doctor)
 async def get_doctor_by_id(doctor_id: int, session: AsyncSession = Depends(get_session)):
     stmt = select(Doctor).where(Doctor.doctor_id == doctor_id)
@@ -238,14 +205,9 @@ async def get_doctor_by_id(doctor_id: int, session: AsyncSession = Depends(get_s
 @router.post("/registrations", response_model=Registration)
 async def create_registration(
         reg_in: RegistrationCreate,
-        phone: str = Depends(get_current_user_phone),  # 直接使用导入的函数
+        patient: Patient = Depends(get_current_patient),
         session: AsyncSession = Depends(get_session)
 ):
-    stmt = select(Patient).where(Patient.phone == phone)
-    patient = (await session.execute(stmt)).scalars().first()
-    if not patient:
-        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
-
     # 规则：患者同一时间只能有一个“未完成”的挂号（排队中/就诊中）。
     active_stmt = select(Registration.reg_id).where(
         Registration.patient_id == patient.patient_id,
@@ -258,19 +220,13 @@ async def create_registration(
     visit_date = getattr(reg_in, "visit_date", None) or datetime.now().date()
 
     # 挂号限额：同一医生当日，专家号最多30个，普通号最多50个（不含已取消）
-    limit = 30 if reg_in.reg_type in (RegType.EXPERT, RegType.EXPERT.value, "专家号") else 50
-    quota_stmt = (
-        select(func.count())
-        .where(Registration.doctor_id == reg_in.doctor_id)
-        .where(Registration.visit_date == visit_date)
-        .where(Registration.reg_type == reg_in.reg_type)
-        .where(Registration.status != RegStatus.CANCELLED)
-    )
-    current_count = (await session.execute(quota_stmt)).scalar_one() or 0
-    if current_count >= limit:
+    # 号源表上的条件 UPDATE 原子扣减，并发抢号也不会超卖
+    reg_type = normalize_reg_type(reg_in.reg_type)
+    if not await reserve_slot(session, reg_in.doctor_id, visit_date, reg_type):
+        await session.rollback()
         raise HTTPException(status_code=400, detail="该医生当天挂号已满")
 
-    fee = 50.0 if reg_in.reg_type in (RegType.EXPERT, RegType.EXPERT.value, "专家号") else 10.0
+    fee = REGISTRATION_FEE[reg_type]
 
     new_reg = Registration(
         patient_id=patient.patient_id,
@@ -304,15 +260,10 @@ async def create_registration(
 @router.post("/registrations/{reg_id}/cancel")
 async def cancel_registration(
     reg_id: int,
-    phone: str = Depends(get_current_user_phone),
+    patient: Patient = Depends(get_current_patient),
     session: AsyncSession = Depends(get_session)
 ):
     # 只允许在医生开始办理前由患者取消
-    stmt = select(Patient).where(Patient.phone == phone)
-    patient = (await session.execute(stmt)).scalars().first()
-    if not patient:
-        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
-
     reg = await session.get(Registration, reg_id)
     if not reg:
         raise HTTPException(status_code=404, detail="挂号单不存在")
@@ -399,8 +350,10 @@ async def cancel_registration(
         )
         payment = (await session.execute(pay_stmt2)).scalars().first()
 
-    reg.status = RegStatus.CANCELLED
-    session.add(reg)
+    # 条件更新为已取消并归还号源：并发取消同一挂号时只有一次生效
+    if not await cancel_and_release_slot(session, reg):
+        await session.rollback()
+        raise HTTPException(status_code=400, detail="只有未开始的挂号可以取消")
 
     # 取消挂号：
     # - 若挂号费未缴费：标记为“已取消”（保留记录，但不可再缴费）
@@ -413,6 +366,14 @@ async def cancel_registration(
             payment.status = "已取消"
             session.add(payment)
 
+    record_patient_event(
+        session,
+        patient.patient_id,
+        EVENT_REGISTRATION_CANCELLED,
+        reg_id=reg.reg_id,
+        payment_id=payment.payment_id if payment else None,
+        payment_status=payment.status if payment else None,
+    )
     await session.commit()
     await session.refresh(reg)
     return {"message": "挂号已取消", "registration": reg}
@@ -421,17 +382,11 @@ async def cancel_registration(
 # --- 新：查询当前患者的所有挂号记录 ---
 @router.get("/registrations", response_model=List[Registration])
 async def get_my_registrations(
-    phone: str = Depends(get_current_user_phone),
+    patient: Patient = Depends(get_current_patient),
     session: AsyncSession = Depends(get_session)
 ):
     try:
-        stmt = select(Patient).where(Patient.phone == phone)
-        patient = (await session.execute(stmt)).scalars().first()
-        if not patient:
-            raise HTTPException(status_code=400, detail="请先完善个人信息档案")
-
         reg_stmt = select(Registration).where(Registration.patient_id == patient.patient_id)
-        await _apply_expired_registrations_for_patient(session, patient.patient_id)
         result = await session.execute(reg_stmt)
         return result.scalars().all()
     except HTTPException:
@@ -448,17 +403,10 @@ async def get_my_registrations(
 @router.get("/registrations/{reg_id}/detail")
 async def get_registration_detail(
     reg_id: int,
-    phone: str = Depends(get_current_user_phone),
+    patient: Patient = Depends(get_current_patient),
     session: AsyncSession = Depends(get_session)
 ):
     # ensure the registration belongs to the current logged-in patient
-    stmt = select(Patient).where(Patient.phone == phone)
-    patient = (await session.execute(stmt)).scalars().first()
-    if not patient:
-        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
-
-    await _apply_expired_registrations_for_patient(session, patient.patient_id)
-
     reg_stmt = select(Registration).where(Registration.reg_id == reg_id)
     registration = (await session.execute(reg_stmt)).scalars().first()
     if not registration:
@@ -517,23 +465,74 @@ async def get_registration_detail(
     return {"registration": registration, "record": record, "prescriptions": pres_list, "exams": exams_list, "admissions": []}
 
 
+async def _load_payment_refs(session: AsyncSession, pays: List[Payment]) -> dict:
+    """Resolve everything the payment list references with a fixed number of IN queries.
+
+    Query count does not grow with history size: one query each for exams,
+    prescriptions, prescription details, medicines, hospitalizations, wards,
+    plus two for the hospitalization bills (ledger totals and charge lines).
+    """
+    exam_ids = {p.exam_id for p in pays if p.exam_id}
+    pres_ids = {p.pres_id for p in pays if p.pres_id}
+    hosp_ids = {p.hosp_id for p in pays if p.hosp_id}
+
+    exams = {}
+    if exam_ids:
+        rows = (await session.execute(select(Examination).where(Examination.exam_id.in_(exam_ids)))).scalars().all()
+        exams = {e.exam_id: e for e in rows}
+
+    prescriptions = {}
+    details_by_pres = {}
+    medicine_names = {}
+    if pres_ids:
+        rows = (await session.execute(select(Prescription).where(Prescription.pres_id.in_(pres_ids)))).scalars().all()
+        prescriptions = {pres.pres_id: pres for pres in rows}
+        if prescriptions:
+            detail_stmt = select(PrescriptionDetail).where(PrescriptionDetail.pres_id.in_(list(prescriptions.keys())))
+            for ds in (await session.execute(detail_stmt)).scalars().all():
+                details_by_pres.setdefault(ds.pres_id, []).append(ds)
+        med_ids = {ds.medicine_id for bucket in details_by_pres.values() for ds in bucket}
+        if med_ids:
+            med_stmt = select(Medicine.medicine_id, Medicine.name).where(Medicine.medicine_id.in_(med_ids))
+            medicine_names = {med_id: name for med_id, name in (await session.execute(med_stmt)).all()}
+
+    hosps = {}
+    wards = {}
+    bills = {}
+    if hosp_ids:
+        rows = (await session.execute(select(Hospitalization).where(Hospitalization.hosp_id.in_(hosp_ids)))).scalars().all()
+        hosps = {h.hosp_id: h for h in rows}
+        ward_ids = {h.ward_id for h in rows if h.ward_id}
+        if ward_ids:
+            ward_rows = (await session.execute(select(Ward).where(Ward.ward_id.in_(ward_ids)))).scalars().all()
+            wards = {w.ward_id: w for w in ward_rows}
+        # 台账已由迁移回填；只有绕过应用写入的住院记录才会在此补建，此时才需要提交
+        if await backfill_ledgers(session, rows):
+            await session.commit()
+        bills = await compute_hospitalization_bills(session, rows, DEFAULT_HOSPITAL_HOURLY_RATE)
+
+    return {
+        "exams": exams,
+        "prescriptions": prescriptions,
+        "details_by_pres": details_by_pres,
+        "medicine_names": medicine_names,
+        "hosps": hosps,
+        "wards": wards,
+        "bills": bills,
+    }
+
+
 # --- 新：查询当前患者的缴费记录 ---
 @router.get("/payments")
 async def get_my_payments(
-    phone: str = Depends(get_current_user_phone),
+    patient: Patient = Depends(get_current_patient),
     session: AsyncSession = Depends(get_session)
 ):
-    stmt = select(Patient).where(Patient.phone == phone)
-    patient = (await session.execute(stmt)).scalars().first()
-    if not patient:
-        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
-
-    # Ensure overdue registrations are marked expired and registration fee payment status updated.
-    await _apply_expired_registrations_for_patient(session, patient.patient_id)
-
     pay_stmt = select(Payment).where(Payment.patient_id == patient.patient_id)
     result = await session.execute(pay_stmt)
     pays = result.scalars().all()
+    # 批量加载关联的检查/处方/住院信息，避免逐条查询
+    refs = await _load_payment_refs(session, pays)
     out = []
     for p in pays:
         entry = {
@@ -550,7 +549,7 @@ async def get_my_payments(
         }
 
         if p.exam_id:
-            exam = await session.get(Examination, p.exam_id)
+            exam = refs["exams"].get(p.exam_id)
             entry["exam_info"] = {
                 "exam_id": exam.exam_id,
                 "type": exam.type,
@@ -559,15 +558,13 @@ async def get_my_payments(
             } if exam else None
 
         if p.pres_id:
-            pres = await session.get(Prescription, p.pres_id)
+            pres = refs["prescriptions"].get(p.pres_id)
             details = []
             if pres:
-                detail_stmt = select(PrescriptionDetail).where(PrescriptionDetail.pres_id == pres.pres_id)
-                for ds in (await session.execute(detail_stmt)).scalars().all():
-                    med = await session.get(Medicine, ds.medicine_id)
+                for ds in refs["details_by_pres"].get(pres.pres_id, []):
                     details.append({
                         "medicine_id": ds.medicine_id,
-                        "medicine_name": med.name if med else None,
+                        "medicine_name": refs["medicine_names"].get(ds.medicine_id),
                         "quantity": ds.quantity,
                         "usage": ds.usage
                     })
@@ -578,9 +575,9 @@ async def get_my_payments(
             }
 
         if p.hosp_id:
-            hosp = await session.get(Hospitalization, p.hosp_id)
+            hosp = refs["hosps"].get(p.hosp_id)
             if hosp:
-                ward = await session.get(Ward, hosp.ward_id) if hosp.ward_id else None
+                ward = refs["wards"].get(hosp.ward_id) if hosp.ward_id else None
                 reference_out = hosp.out_date or datetime.now()
                 duration_hours = max((reference_out - hosp.in_date).total_seconds() / 3600, 0.0)
                 entry["hospitalization_info"] = {
@@ -593,11 +590,7 @@ async def get_my_payments(
                     "duration_hours": duration_hours,
                     "duration_days": round(duration_hours / 24, 2)
                 }
-                entry["hospitalization_bill"] = await compute_hospitalization_bill(
-                    session,
-                    hosp,
-                    DEFAULT_HOSPITAL_HOURLY_RATE,
-                )
+                entry["hospitalization_bill"] = refs["bills"].get(hosp.hosp_id)
 
         out.append(entry)
     return out
@@ -607,14 +600,9 @@ async def get_my_payments(
 @router.post("/payments/{payment_id}/pay")
 async def pay_payment(
     payment_id: int,
-    phone: str = Depends(get_current_user_phone),
+    patient: Patient = Depends(get_current_patient),
     session: AsyncSession = Depends(get_session)
 ):
-    stmt = select(Patient).where(Patient.phone == phone)
-    patient = (await session.execute(stmt)).scalars().first()
-    if not patient:
-        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
-
     payment = await session.get(Payment, payment_id)
     if not payment:
         raise HTTPException(status_code=404, detail="缴费记录不存在")
@@ -630,6 +618,7 @@ async def pay_payment(
     # 标记为已缴费
     payment.status = '已缴费'
     session.add(payment)
+    record_patient_event(session, patient.patient_id, EVENT_PAYMENT_PAID, payment_id=payment.payment_id)
 
     await session.commit()
     await session.refresh(payment)
@@ -642,14 +631,9 @@ async def pay_payment(
 @router.post("/payments/{payment_id}/refund")
 async def refund_payment(
     payment_id: int,
-    phone: str = Depends(get_current_user_phone),
+    patient: Patient = Depends(get_current_patient),
     session: AsyncSession = Depends(get_session)
 ):
-    stmt = select(Patient).where(Patient.phone == phone)
-    patient = (await session.execute(stmt)).scalars().first()
-    if not patient:
-        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
-
     payment = await session.get(Payment, payment_id)
     if not payment:
         raise HTTPException(status_code=404, detail="缴费记录不存在")
@@ -664,6 +648,7 @@ async def refund_payment(
 
     payment.status = '已退费'
     session.add(payment)
+    record_patient_event(session, patient.patient_id, EVENT_PAYMENT_REFUNDED, payment_id=payment.payment_id)
     await session.commit()
     await session.refresh(payment)
     return {"message": "已退费", "payment": {
@@ -674,15 +659,9 @@ async def refund_payment(
 
 @router.get("/examinations")
 async def get_my_examinations(
-    phone: str = Depends(get_current_user_phone),
+    patient: Patient = Depends(get_current_patient),
     session: AsyncSession = Depends(get_session)
 ):
-    # 通过登录手机号找到 Patient，再查该患者所有挂号对应的病历的检查记录
-    stmt = select(Patient).where(Patient.phone == phone)
-    patient = (await session.execute(stmt)).scalars().first()
-    if not patient:
-        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
-
     # 查找该患者的所有挂号 id
     reg_stmt = select(Registration.reg_id).where(Registration.patient_id == patient.patient_id)
     reg_ids = (await session.execute(reg_stmt)).scalars().all()
@@ -715,4 +694,151 @@ async def get_my_examinations(
             "reg_id": rec_map.get(e.record_id)
         })
 
-    return out
\ No newline at end of file
+    return out
+
+def _notice_payment_filter():
+    """Payments that should raise a reminder: unpaid, or a registration fee awaiting refund."""
+    return or_(
+        Payment.status == "未缴费",
+        and_(Payment.status == "待退费", Payment.type == PaymentType.REGISTRATION),
+    )
+
+
+def _parse_feed_cursor(cursor: Optional[str]) -> Optional[datetime]:
+    if not cursor:
+        return None
+    try:
+        return datetime.fromisoformat(cursor)
+    except ValueError:
+        return None
+
+
+def _feed_payment_item(p: Payment) -> dict:
+    return {
+        "payment_id": p.payment_id,
+        "type": p.type.value if hasattr(p.type, "value") else p.type,
+        "amount": p.amount,
+        "time": p.time,
+        "status": getattr(p, "status", "未缴费"),
+        "reg_id": p.reg_id,
+    }
+
+
+def _feed_registration_item(r: Registration) -> dict:
+    return {
+        "reg_id": r.reg_id,
+        "visit_date": r.visit_date,
+        "status": r.status.value if hasattr(r.status, "value") else r.status,
+        "doctor_id": r.doctor_id,
+    }
+
+
+# --- 新：提醒增量同步（替代前端对 /payments + /registrations 的整表轮询） ---
+@router.get("/notifications/feed")
+async def get_notification_feed(
+    cursor: Optional[str] = None,
+    patient: Patient = Depends(get_current_patient),
+    session: AsyncSession = Depends(get_session)
+):
+    """Return reminder-relevant changes since ``cursor`` plus badge counts.
+
+    Without a (valid) cursor the response is a full snapshot of the items that
+    currently need a reminder. With a cursor only payments/registrations whose
+    ``updated_at`` moved since then are returned, in any status, so the client
+    can both add and drop reminders. Re-delivered items inside the overlap
+    window are harmless because the client applies them idempotently.
+    """
+    server_time = now_bj()
+    today = today_bj()
+    since = _parse_feed_cursor(cursor)
+    full = since is None
+
+    pay_stmt = select(Payment).where(Payment.patient_id == patient.patient_id)
+    reg_stmt = select(Registration).where(Registration.patient_id == patient.patient_id)
+    if full:
+        pay_stmt = pay_stmt.where(_notice_payment_filter())
+        reg_stmt = reg_stmt.where(
+            Registration.visit_date == today,
+            Registration.status == RegStatus.WAITING,
+        )
+    else:
+        window_start = since - timedelta(seconds=FEED_CURSOR_OVERLAP_SECONDS)
+        pay_stmt = pay_stmt.where(Payment.updated_at >= window_start)
+        reg_stmt = reg_stmt.where(Registration.updated_at >= window_start)
+    pay_stmt = pay_stmt.order_by(Payment.time.desc(), Payment.payment_id.desc())
+
+    payments = (await session.execute(pay_stmt)).scalars().all()
+    registrations = (await session.execute(reg_stmt)).scalars().all()
+
+    unpaid_stmt = select(
+        func.coalesce(func.sum(case((Payment.status == "未缴费", 1), else_=0)), 0),
+        func.coalesce(func.sum(case((Payment.status == "待退费", 1), else_=0)), 0),
+    ).where(Payment.patient_id == patient.patient_id, _notice_payment_filter())
+    unpaid_count, refundable_count = (await session.execute(unpaid_stmt)).one()
+
+    active_stmt = select(
+        func.coalesce(func.sum(case((Registration.visit_date == today, 1), else_=0)), 0),
+        func.count(),
+    ).where(
+        Registration.patient_id == patient.patient_id,
+        Registration.status.in_([RegStatus.WAITING, RegStatus.IN_PROGRESS]),
+    )
+    today_visit_count, active_count = (await session.execute(active_stmt)).one()
+
+    # 有待缴费或进行中的挂号时保持较快轮询，否则放慢
+    busy = bool(unpaid_count or refundable_count or active_count)
+    return {
+        "cursor": server_time.isoformat(),
+        "full": full,
+        "payments": [_feed_payment_item(p) for p in payments],
+        "registrations": [_feed_registration_item(r) for r in registrations],
+        "badges": {
+            "unpaid": int(unpaid_count or 0),
+            "refundable": int(refundable_count or 0),
+            "today_visits": int(today_visit_count or 0),
+        },
+        "next_poll_ms": FEED_POLL_ACTIVE_MS if busy else FEED_POLL_IDLE_MS,
+    }
+
+
+# --- 新：缴费/挂号状态变更推送（SSE），客户端收到后调用 /notifications/feed 增量同步 ---
+@router.get("/events/stream")
+async def stream_patient_events(
+    request: Request,
+    phone: str = Depends(get_stream_user_phone),
+):
+    # 不使用 get_session 依赖：其连接会被长连接一直占用
+    async with async_session() as session:
+        stmt = select(Patient.patient_id).where(Patient.phone == phone)
+        patient_id = (await session.execute(stmt)).scalars().first()
+    if not patient_id:
+        raise HTTPException(status_code=400, detail="请先完善个人信息档案")
+
+    try:
+        subscription = patient_event_bus.subscribe(patient_id)
+    except SubscriberLimitExceeded:
+        raise HTTPException(status_code=503, detail="推送连接数已达上限，请改用轮询")
+
+    async def event_source():
+        try:
+            yield "retry: 5000\nevent: ready\ndata: {}\n\n"
+            while True:
+                if await request.is_disconnected():
+                    break
+                batch = await subscription.next_batch(EVENT_STREAM_HEARTBEAT_SECONDS)
+                if batch is None:
+                    yield ": ping\n\n"
+                    continue
+                for item in batch:
+                    data = json.dumps(item, ensure_ascii=False)
+                    event_id = item.get("event_id")
+                    prefix = f"id: {event_id}\n" if event_id else ""
+                    yield f"{prefix}event: {item['kind']}\ndata: {data}\n\n"
+        finally:
+            patient_event_bus.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,15 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import func
+from sqlalchemy import update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import select
 from typing import Dict, List, Tuple
-from datetime import date, datetime, timedelta
+from datetime import date, timedelta
 import math
 
 from app.core.config import get_session
-from app.api.deps import get_current_user, get_current_user_phone
+from app.api.deps import get_current_principal, get_current_user
+from app.services.principal_cache import Principal
 from app.models.hospital import Doctor, Medicine, Prescription, PrescriptionDetail, MedicalRecord, Registration, RegStatus
 from app.models.user import UserAccount, UserRole
+from app.services.medicine_usage import load_daily_usage, load_monthly_usage, record_usage, usage_deltas
 from app.schemas.pharmacy import (
     PrescriptionCreate,
     PrescriptionRead,
@@ -87,62 +89,37 @@ async def _load_usage_stats(
     Dict[int, List[Dict[str, int]]],
     List[str],
 ]:
-    cutoff = datetime.now() - timedelta(days=USAGE_WINDOW_DAYS - 1)
-    stmt = (
-        select(
-            PrescriptionDetail.medicine_id,
-            func.date(Prescription.create_time).label("usage_date"),
-            func.coalesce(func.sum(PrescriptionDetail.quantity), 0).label("qty"),
-        )
-        .join(Prescription, PrescriptionDetail.pres_id == Prescription.pres_id)
-        .where(Prescription.create_time >= cutoff)
-        .group_by(PrescriptionDetail.medicine_id, "usage_date")
-    )
-    rows = await session.execute(stmt)
+    # 读取每日用量汇总表（开方时维护），不再扫描处方明细
+    date_labels = _build_date_labels()
+    rows = await load_daily_usage(session, date.fromisoformat(date_labels[0]))
     usage_totals: Dict[int, int] = {}
     usage_daily: Dict[int, Dict[str, int]] = {}
-    for med_id, usage_date, qty in rows.all():
-        qty_int = int(qty or 0)
-        usage_totals[med_id] = usage_totals.get(med_id, 0) + qty_int
-        usage_daily.setdefault(med_id, {})[usage_date.isoformat() if hasattr(usage_date, "isoformat") else str(usage_date)] = qty_int
+    for med_id, usage_date, qty in rows:
+        usage_totals[med_id] = usage_totals.get(med_id, 0) + qty
+        usage_daily.setdefault(med_id, {})[usage_date.isoformat()] = qty
 
-    date_labels = _build_date_labels()
     trend_map: Dict[int, List[Dict[str, int]]] = {}
     for med_id, day_map in usage_daily.items():
         trend_map[med_id] = [{"date": label, "quantity": day_map.get(label, 0)} for label in date_labels]
 
     # 近 12 个月按月用量
     month_labels = _build_month_labels(12)
-    month_cutoff = datetime.combine(_shift_month(date.today().year, date.today().month, -11), datetime.min.time())
-    stmt_month = (
-        select(
-            PrescriptionDetail.medicine_id,
-            func.date_format(Prescription.create_time, "%Y-%m").label("usage_month"),
-            func.coalesce(func.sum(PrescriptionDetail.quantity), 0).label("qty"),
-        )
-        .join(Prescription, PrescriptionDetail.pres_id == Prescription.pres_id)
-        .where(Prescription.create_time >= month_cutoff)
-        .group_by(PrescriptionDetail.medicine_id, "usage_month")
-    )
-    month_rows = await session.execute(stmt_month)
-    month_series_map: Dict[int, Dict[str, int]] = {}
-    for med_id, usage_month, qty in month_rows.all():
-        qty_int = int(qty or 0)
-        month_series_map.setdefault(med_id, {})[str(usage_month)] = qty_int
+    month_starts = [date.fromisoformat(f"{label}-01") for label in month_labels]
+    next_month = _shift_month(month_starts[-1].year, month_starts[-1].month, 1)
+    month_totals = await load_monthly_usage(session, month_starts, next_month)
 
     monthly_trend_map: Dict[int, List[Dict[str, int]]] = {}
-    for med_id, month_map in month_series_map.items():
-        monthly_trend_map[med_id] = [{"date": label, "quantity": month_map.get(label, 0)} for label in month_labels]
+    for med_id, totals in month_totals.items():
+        monthly_trend_map[med_id] = [{"date": label, "quantity": qty} for label, qty in zip(month_labels, totals)]
 
     return usage_totals, trend_map, date_labels, monthly_trend_map, month_labels
 
 
 # 简单的医生验证
 async def get_current_doctor(
-        phone: str = Depends(get_current_user_phone),
-        session: AsyncSession = Depends(get_session)
+        principal: Principal = Depends(get_current_principal)
 ) -> Doctor:
-    doc = (await session.execute(select(Doctor).where(Doctor.phone == phone))).scalars().first()
+    doc = principal.doctor()
     if not doc:
         raise HTTPException(status_code=403, detail="无权操作")
     return doc
@@ -177,12 +154,17 @@ async def replenish_medicines(
     for med in meds:
         view = _build_inventory_view(med, usage_map, trend_map, date_labels, monthly_trend_map, month_labels)
         if view.suggested_restock > 0:
-            med.stock += view.suggested_restock
-            session.add(med)
+            # 原子累加，避免覆盖同时发生的开方扣减
+            await session.execute(
+                update(Medicine)
+                .where(Medicine.medicine_id == med.medicine_id)
+                .values(stock=Medicine.stock + view.suggested_restock)
+                .execution_options(synchronize_session=False)
+            )
             restocked = True
     if restocked:
         await session.commit()
-        meds = (await session.execute(select(Medicine))).scalars().all()
+        meds = (await session.execute(select(Medicine).execution_options(populate_existing=True))).scalars().all()
     else:
         await session.rollback()
     return [
@@ -202,8 +184,12 @@ async def purchase_medicine(
     med = await session.get(Medicine, payload.medicine_id)
     if not med:
         raise HTTPException(status_code=404, detail="药品不存在")
-    med.stock += payload.quantity
-    session.add(med)
+    await session.execute(
+        update(Medicine)
+        .where(Medicine.medicine_id == med.medicine_id)
+        .values(stock=Medicine.stock + payload.quantity)
+        .execution_options(synchronize_session=False)
+    )
     await session.commit()
     await session.refresh(med)
     return med
@@ -236,6 +222,32 @@ async def create_medicine(
     return med
 
 
+async def _apply_stock_deltas(session: AsyncSession, deltas: Dict[int, int], medicines: Dict[int, Medicine]) -> List[str]:
+    """Apply stock changes as conditional UPDATEs; return the names that ran short.
+
+    Each decrement only succeeds while ``stock >= delta``, so concurrent
+    prescriptions can never oversell. Rows are touched in medicine_id order to
+    keep lock order consistent; the caller rolls back if anything ran short.
+    """
+    insufficient: List[str] = []
+    for med_id in sorted(deltas):
+        delta = deltas[med_id]
+        med = medicines.get(med_id)
+        if med is None:
+            if delta > 0:
+                insufficient.append("该药品")
+            continue
+        stmt = update(Medicine).where(Medicine.medicine_id == med_id)
+        if delta > 0:
+            stmt = stmt.where(Medicine.stock >= delta)
+        result = await session.execute(
+            stmt.values(stock=Medicine.stock - delta).execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            insufficient.append(med.name)
+    return insufficient
+
+
 @router.post("/prescriptions", response_model=PrescriptionRead)
 async def create_prescription(
         pres_in: PrescriptionCreate,
@@ -257,94 +269,57 @@ async def create_prescription(
 
     # 检查是否已有处方：如果有则执行“修改处方”的逻辑；否则创建新处方
     existing = (await session.execute(select(Prescription).where(Prescription.record_id == pres_in.record_id))).scalars().first()
-    # Helper: load existing details mapping med_id -> qty
-    async def _load_existing_details(pres: Prescription):
-        stmt = select(PrescriptionDetail).where(PrescriptionDetail.pres_id == pres.pres_id)
-        res = await session.execute(stmt)
-        rows = res.scalars().all()
-        return {r.medicine_id: r.quantity for r in rows}, rows
-
-    total = 0.0
-
+    old_rows: List[PrescriptionDetail] = []
     if existing:
-        # 处理库存差异：计算每个 medicine 的 delta = new_qty - old_qty
-        old_map, old_rows = await _load_existing_details(existing)
-        # build new map
-        new_map = {item.medicine_id: item.quantity for item in pres_in.items}
-
-        # first, check stock availability for increases; collect all不足
-        insufficient: list[str] = []
-        for med_id, new_qty in new_map.items():
-            old_qty = old_map.get(med_id, 0)
-            delta = new_qty - old_qty
-            if delta > 0:
-                med = await session.get(Medicine, med_id)
-                if not med or med.stock < delta:
-                    name = med.name if med else "该药品"
-                    insufficient.append(name)
-        if insufficient:
-            raise HTTPException(status_code=400, detail=f"库存不足: {', '.join(insufficient)}")
-
-        # apply stock adjustments
-        for med_id, new_qty in new_map.items():
-            old_qty = old_map.get(med_id, 0)
-            delta = new_qty - old_qty
-            med = await session.get(Medicine, med_id)
-            if delta > 0:
-                med.stock -= delta
-            elif delta < 0:
-                med.stock += (-delta)
-            session.add(med)
-
-        # 对于旧处方中有但新处方没有的药品，退回库存
-        for med_id, old_qty in old_map.items():
-            if med_id not in new_map:
-                med = await session.get(Medicine, med_id)
-                med.stock += old_qty
-                session.add(med)
+        old_rows = (await session.execute(
+            select(PrescriptionDetail).where(PrescriptionDetail.pres_id == existing.pres_id)
+        )).scalars().all()
+
+    old_usage: Dict[int, int] = {}
+    for r in old_rows:
+        old_usage[r.medicine_id] = old_usage.get(r.medicine_id, 0) + r.quantity
+    new_usage: Dict[int, int] = {}
+    for item in pres_in.items:
+        new_usage[item.medicine_id] = new_usage.get(item.medicine_id, 0) + item.quantity
+    # 修改处方只按差额增减库存；新处方的差额即全部用量
+    deltas = usage_deltas(old_usage, new_usage)
+
+    med_ids = set(old_usage) | set(new_usage)
+    medicines: Dict[int, Medicine] = {}
+    if med_ids:
+        medicines = {
+            med.medicine_id: med
+            for med in (await session.execute(select(Medicine).where(Medicine.medicine_id.in_(med_ids)))).scalars().all()
+        }
+
+    insufficient = await _apply_stock_deltas(session, deltas, medicines)
+    if insufficient:
+        # 任一药品扣减失败则整张处方回滚，已扣减的库存一并撤销
+        await session.rollback()
+        raise HTTPException(status_code=400, detail=f"库存不足: {', '.join(insufficient)}")
 
+    if existing:
         # 删除旧明细并插入新明细
         for r in old_rows:
             await session.delete(r)
+        pres = existing
+    else:
+        pres = Prescription(record_id=pres_in.record_id, total_amount=0.0)
+        session.add(pres)
+        await session.flush()
 
-        for item in pres_in.items:
-            session.add(PrescriptionDetail(pres_id=existing.pres_id, medicine_id=item.medicine_id, quantity=item.quantity, usage=item.usage))
-            med = await session.get(Medicine, item.medicine_id)
-            total += med.price * item.quantity
-
-        existing.total_amount = total
-        session.add(existing)
-        await session.commit()
-        await session.refresh(existing)
-        return existing
-
-    # 创建新处方
-    new_pres = Prescription(record_id=pres_in.record_id, total_amount=0.0)
-    session.add(new_pres)
-    await session.flush()
-
-    insufficient_new: list[str] = []
+    total = 0.0
     for item in pres_in.items:
-        med = await session.get(Medicine, item.medicine_id)
-        if not med or med.stock < item.quantity:
-            name = med.name if med else "该药品"
-            insufficient_new.append(name)
-            continue
-    if insufficient_new:
-        raise HTTPException(status_code=400, detail=f"库存不足: {', '.join(insufficient_new)}")
+        session.add(PrescriptionDetail(pres_id=pres.pres_id, medicine_id=item.medicine_id, quantity=item.quantity, usage=item.usage))
+        total += medicines[item.medicine_id].price * item.quantity
 
-    for item in pres_in.items:
-        med = await session.get(Medicine, item.medicine_id)
-        med.stock -= item.quantity
-        session.add(med)
-        total += med.price * item.quantity
-        session.add(PrescriptionDetail(pres_id=new_pres.pres_id, medicine_id=item.medicine_id, quantity=item.quantity, usage=item.usage))
-
-    new_pres.total_amount = total
-    session.add(new_pres)
+    pres.total_amount = total
+    session.add(pres)
+    # 用量汇总按处方开具日期记差额
+    await record_usage(session, pres.create_time.date(), deltas)
     await session.commit()
-    await session.refresh(new_pres)
-    return new_pres
+    await session.refresh(pres)
+    return pres
 
 
 @router.get("/prescriptions/by_record/{record_id}")
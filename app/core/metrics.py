@@ -0,0 +1,322 @@
+"""In-process request / database metrics in the Prometheus text format.
+
+SQLAlchemy cursor events attribute every statement (count, DB time, rows
+reported by the driver) to the FastAPI route that issued it, through a
+context variable set by ``MetricsMiddleware``. Statements issued outside a
+request (relay, sweeper, audit writer) are reported under
+``route="background"``. Requests issuing more than
+``METRICS_QUERY_THRESHOLD`` statements are counted and logged, because that
+is how N+1 loops show up.
+
+No client library is required: the collectors below keep plain dicts on the
+event-loop thread and ``render_metrics`` writes the exposition format.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+METRICS_QUERY_THRESHOLD = int(os.getenv("METRICS_QUERY_THRESHOLD", "20"))
+METRICS_LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("METRICS_LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200)
+WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+BACKGROUND_ROUTE = "background"
+UNMATCHED_ROUTE = "unmatched"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_fmt(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.labelnames = tuple(labelnames)
+        # labels -> [per-bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        state = self._values.get(labels)
+        if state is None:
+            state = [0] * len(self.buckets) + [0.0, 0]
+            self._values[labels] = state
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self) -> Iterable[str]:
+        for labels, state in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="%s"' % _fmt(bound)
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_fmt(state[-2])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {state[-1]}"
+
+
+HTTP_REQUESTS = Counter("hms_http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status"))
+HTTP_LATENCY = Histogram("hms_http_request_duration_seconds", "HTTP request latency.", LATENCY_BUCKETS, ("route", "method"))
+HTTP_IN_FLIGHT = Gauge("hms_http_requests_in_flight", "Requests currently being handled.")
+DB_STATEMENTS = Counter("hms_db_statements_total", "SQL statements executed, by originating route.", ("route",))
+DB_TIME = Counter("hms_db_time_seconds_total", "Time spent in cursor execution, by originating route.", ("route",))
+DB_ROWS = Counter("hms_db_rows_total", "Rows reported by the driver (fetched or affected), by originating route.", ("route",))
+DB_QUERIES_PER_REQUEST = Histogram(
+    "hms_db_queries_per_request", "SQL statements issued per HTTP request.", QUERY_COUNT_BUCKETS, ("route",)
+)
+DB_QUERY_THRESHOLD_EXCEEDED = Counter(
+    "hms_db_query_threshold_exceeded_total", "Requests that issued more than METRICS_QUERY_THRESHOLD statements.", ("route",)
+)
+POOL_CHECKOUT_WAIT = Histogram("hms_db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection.", WAIT_BUCKETS)
+LOOP_LAG = Histogram("hms_event_loop_lag_seconds", "Event-loop scheduling delay.", LAG_BUCKETS)
+LOOP_LAG_LAST = Gauge("hms_event_loop_lag_last_seconds", "Most recent event-loop scheduling delay.")
+HTTP_IN_FLIGHT.set(0)
+
+COLLECTORS = (
+    HTTP_REQUESTS, HTTP_LATENCY, HTTP_IN_FLIGHT,
+    DB_STATEMENTS, DB_TIME, DB_ROWS, DB_QUERIES_PER_REQUEST, DB_QUERY_THRESHOLD_EXCEEDED,
+    POOL_CHECKOUT_WAIT, LOOP_LAG, LOOP_LAG_LAST,
+)
+
+
+@dataclass
+class RequestMetrics:
+    queries: int = 0
+    db_time: float = 0.0
+    rows: int = 0
+
+
+_request_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar("hms_request_metrics", default=None)
+
+
+def current_request_metrics() -> Optional[RequestMetrics]:
+    return _request_metrics.get()
+
+
+# ---- database hooks ----
+
+def install_engine_metrics(target_engine) -> None:
+    sync_engine = target_engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._hms_metrics_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_hms_metrics_started", None)
+        elapsed = time.perf_counter() - started if started is not None else 0.0
+        rows = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+        current = _request_metrics.get()
+        if current is None:
+            route = BACKGROUND_ROUTE
+            DB_STATEMENTS.inc(route)
+            DB_TIME.inc(route, amount=elapsed)
+            DB_ROWS.inc(route, amount=rows)
+            return
+        # 路由名要等路由匹配后才知道，请求内先累加，结束时再按路由汇总
+        current.queries += 1
+        current.db_time += elapsed
+        current.rows += rows
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Async queue pool that records how long each checkout waited."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+# ---- HTTP ----
+
+def route_label(scope) -> str:
+    """Route template for a handled request, e.g. ``/api/payments/{payment_id}/pay``.
+
+    Taken from the matched route's path. FastAPI versions that include
+    routers lazily keep the prefixed path on the effective route context in
+    ``scope["fastapi"]``; older ones copy the prefix into ``route.path``.
+    Routes without a path fall back to rebuilding the template from the
+    request path and the matched path params.
+    """
+    # 未匹配的路径（404 扫描等）归为一类，避免标签无限增长
+    route = scope.get("route")
+    if route is None:
+        return UNMATCHED_ROUTE
+    context = (scope.get("fastapi") or {}).get("effective_route_context")
+    for template in (getattr(context, "path", None), getattr(route, "path", None)):
+        if isinstance(template, str) and template:
+            return template
+    path = scope.get("path", "")
+    params = scope.get("path_params") or {}
+    if not params:
+        return path
+    names_by_value = {str(value): name for name, value in params.items()}
+    return "/".join(
+        "{%s}" % names_by_value[segment] if segment in names_by_value else segment
+        for segment in path.split("/")
+    )
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware: latency, in-flight gauge and per-route DB attribution."""
+
+    def __init__(self, app, skip_paths: Sequence[str] = ("/metrics",)):
+        self.app = app
+        self.skip_paths = tuple(skip_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestMetrics()
+        token = _request_metrics.set(stats)
+        status_holder = {"status": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_holder["status"] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.dec()
+            _request_metrics.reset(token)
+            label = route_label(scope)
+            method = scope.get("method", "GET")
+            HTTP_REQUESTS.inc(label, method, str(status_holder["status"]))
+            HTTP_LATENCY.observe(elapsed, label, method)
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, label)
+            if stats.queries:
+                DB_STATEMENTS.inc(label, amount=stats.queries)
+                DB_TIME.inc(label, amount=stats.db_time)
+                DB_ROWS.inc(label, amount=stats.rows)
+            if METRICS_QUERY_THRESHOLD > 0 and stats.queries > METRICS_QUERY_THRESHOLD:
+                DB_QUERY_THRESHOLD_EXCEEDED.inc(label)
+                print(
+                    f"WARN: {method} {label} issued {stats.queries} SQL statements "
+                    f"(threshold {METRICS_QUERY_THRESHOLD}, db {stats.db_time * 1000:.1f}ms, total {elapsed * 1000:.1f}ms)"
+                )
+
+
+# ---- event loop ----
+
+class EventLoopLagMonitor:
+    """Sleeps for a fixed interval and records how late the loop woke it up."""
+
+    def __init__(self, interval: float = METRICS_LOOP_LAG_INTERVAL_SECONDS):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - expected, 0.0)
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(lag)
+
+
+loop_lag_monitor = EventLoopLagMonitor()
+
+
+# ---- exposition ----
+
+def render_metrics(extra_gauges: Optional[Dict[str, Tuple[str, float]]] = None) -> str:
+    """Render all collectors, plus point-in-time gauges given as ``name -> (help, value)``."""
+    lines: List[str] = []
+    for collector in COLLECTORS:
+        lines.append(f"# HELP {collector.name} {collector.help}")
+        lines.append(f"# TYPE {collector.name} {collector.kind}")
+        lines.extend(collector.samples())
+    for name, (help_text, value) in (extra_gauges or {}).items():
+        if value is None:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {_fmt(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,351 @@
+"""Versioned schema migrations.
+
+``SQLModel.metadata.create_all`` builds missing tables (with every column and
+index declared on the models). The migrations below bring databases created
+by older versions up to date. Each step checks the live schema before
+changing it, so running one against an already-current database only records
+its version. Applied versions are stored in ``schema_migrations``.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Sequence, Set
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, column, inspect, table, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.core.time_utils import now_bj
+
+_version_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _version_metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+
+
+def _is_mysql(conn: AsyncConnection) -> bool:
+    return conn.dialect.name == "mysql"
+
+
+async def _columns(conn: AsyncConnection, table: str) -> Dict[str, dict]:
+    def _load(sync_conn):
+        return {col["name"]: col for col in inspect(sync_conn).get_columns(table)}
+
+    return await conn.run_sync(_load)
+
+
+async def _index_names(conn: AsyncConnection, table: str) -> Set[str]:
+    def _load(sync_conn):
+        return {idx["name"] for idx in inspect(sync_conn).get_indexes(table)}
+
+    return await conn.run_sync(_load)
+
+
+async def _add_column_if_missing(conn: AsyncConnection, table: str, column: str, ddl: str) -> None:
+    if column not in await _columns(conn, table):
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+async def _create_index_if_missing(conn: AsyncConnection, table: str, name: str, columns: Sequence[str]) -> None:
+    if name not in await _index_names(conn, table):
+        await conn.execute(text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+
+
+# ---- migrations ----
+
+async def _m0001_registration_visit_date(conn: AsyncConnection) -> None:
+    default = "DEFAULT (CURRENT_DATE)" if _is_mysql(conn) else "DEFAULT CURRENT_DATE"
+    await _add_column_if_missing(conn, "registration", "visit_date", f"DATE NOT NULL {default}")
+
+
+async def _m0002_registration_symptoms(conn: AsyncConnection) -> None:
+    await _add_column_if_missing(conn, "registration", "symptoms", "VARCHAR(500) NULL")
+
+
+async def _m0003_registration_status_expired(conn: AsyncConnection) -> None:
+    # Only MySQL stores the status as a native ENUM that needs extending.
+    if not _is_mysql(conn):
+        return
+    col = await conn.execute(
+        text(
+            """
+            SELECT COLUMN_TYPE
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE()
+              AND table_name = 'registration'
+              AND column_name = 'status'
+            """
+        )
+    )
+    column_type = col.scalar() or ""
+    if not (isinstance(column_type, str) and column_type.lower().startswith("enum(")):
+        return
+    values = re.findall(r"'([^']*)'", column_type)
+    # Decide whether DB stores enum names (WAITING/...) or Chinese values.
+    wants_name = any(v in ("WAITING", "IN_PROGRESS", "FINISHED", "CANCELLED") for v in values)
+    expired_token = "EXPIRED" if wants_name else "已过期"
+    if expired_token in values:
+        return
+    new_values = values + [expired_token]
+    # Preserve default when possible
+    default_token = "WAITING" if "WAITING" in values else ("排队中" if "排队中" in values else (values[0] if values else expired_token))
+    enum_sql = ",".join([f"'{v}'" for v in new_values])
+    await conn.execute(
+        text(f"ALTER TABLE registration MODIFY COLUMN status ENUM({enum_sql}) NOT NULL DEFAULT '{default_token}'")
+    )
+
+
+async def _m0004_payment_reg_id(conn: AsyncConnection) -> None:
+    await _add_column_if_missing(conn, "payment", "reg_id", "INTEGER NULL")
+
+
+async def _m0005_updated_at(conn: AsyncConnection) -> None:
+    # Used by the notification feed (delta sync).
+    for table in ("registration", "payment"):
+        await _add_column_if_missing(conn, table, "updated_at", "DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP")
+        await _create_index_if_missing(conn, table, f"ix_{table}_patient_updated", ("patient_id", "updated_at"))
+
+
+HOT_PATH_INDEXES = (
+    ("registration", "ix_registration_doctor_date_status", ("doctor_id", "visit_date", "status")),
+    ("registration", "ix_registration_patient_status", ("patient_id", "status")),
+    ("payment", "ix_payment_patient_type_reg", ("patient_id", "type", "reg_id")),
+    ("payment", "ix_payment_pres_id", ("pres_id",)),
+    ("payment", "ix_payment_exam_id", ("exam_id",)),
+    ("nursetask", "ix_nursetask_hosp_time", ("hosp_id", "time")),
+    ("nursetask", "ix_nursetask_time", ("time",)),
+    ("hospitalization", "ix_hospitalization_status_ward", ("status", "ward_id")),
+    ("nurseschedule", "ix_nurseschedule_ward_start", ("ward_id", "start_time")),
+    ("prescription", "ix_prescription_create_time", ("create_time",)),
+)
+
+
+async def _m0006_hot_path_indexes(conn: AsyncConnection) -> None:
+    for table, name, columns in HOT_PATH_INDEXES:
+        await _create_index_if_missing(conn, table, name, columns)
+
+
+async def _m0007_examination_price(conn: AsyncConnection) -> None:
+    # Price resolved when the exam is ordered; rows from older versions stay NULL until backfilled.
+    await _add_column_if_missing(conn, "examination", "price", "FLOAT NULL")
+    await _add_column_if_missing(conn, "examination", "matched_name", "VARCHAR(200) NULL")
+    await _add_column_if_missing(conn, "examination", "catalog_version", "VARCHAR(32) NULL")
+
+
+async def _m0008_nurse_care_plans(conn: AsyncConnection) -> None:
+    """Move the per-task medicine JSON into nursecareplan / nurseplanmedicine.
+
+    Tasks of one stay that carry the same snapshot and detail were expanded
+    from one plan (billing already charged them once), so they share one plan
+    row. Their JSON copies are cleared once the task points at its plan.
+    """
+    await _add_column_if_missing(conn, "nursetask", "plan_id", "INTEGER NULL")
+    await _create_index_if_missing(conn, "nursetask", "ix_nursetask_plan", ("plan_id",))
+
+    medicine_ids = set((await conn.execute(text("SELECT medicine_id FROM medicine"))).scalars().all())
+    rows = (await conn.execute(text(
+        "SELECT task_id, hosp_id, type, detail, medicine_snapshot FROM nursetask "
+        "WHERE medicine_snapshot IS NOT NULL AND plan_id IS NULL ORDER BY hosp_id, time, task_id"
+    ))).all()
+    plans: Dict[tuple, int] = {}
+    updates: List[dict] = []
+    for row in rows:
+        # 与 billing.plan_signature 相同的签名规则
+        signature = hashlib.sha1(f"{row.medicine_snapshot}::{row.detail or ''}".encode("utf-8")).hexdigest()
+        plan_id = plans.get((row.hosp_id, signature))
+        if plan_id is None:
+            try:
+                entries = json.loads(row.medicine_snapshot)
+            except ValueError:
+                entries = []
+            result = await conn.execute(
+                text(
+                    "INSERT INTO nursecareplan (hosp_id, type, detail, signature, created_at) "
+                    "VALUES (:hosp_id, :type, :detail, :signature, :created_at)"
+                ),
+                {"hosp_id": row.hosp_id, "type": row.type, "detail": row.detail, "signature": signature, "created_at": now_bj()},
+            )
+            plan_id = plans[(row.hosp_id, signature)] = result.lastrowid
+            lines = [
+                {
+                    "plan_id": plan_id,
+                    "medicine_id": item["medicine_id"],
+                    "name": item.get("name"),
+                    "quantity": item["quantity"],
+                    "usage": str(item.get("usage") or "")[:200],
+                }
+                for item in (entries if isinstance(entries, list) else [])
+                if isinstance(item, dict) and item.get("medicine_id") in medicine_ids and item.get("quantity")
+            ]
+            if lines:
+                # usage 是 MySQL 保留字，用表达式构造以便按方言加引号
+                plan_medicine = table(
+                    "nurseplanmedicine", column("plan_id"), column("medicine_id"), column("name"), column("quantity"), column("usage")
+                )
+                await conn.execute(plan_medicine.insert(), lines)
+        updates.append({"plan_id": plan_id, "task_id": row.task_id})
+        if len(updates) >= 1000:
+            await conn.execute(text("UPDATE nursetask SET plan_id = :plan_id, medicine_snapshot = NULL WHERE task_id = :task_id"), updates)
+            updates = []
+    if updates:
+        await conn.execute(text("UPDATE nursetask SET plan_id = :plan_id, medicine_snapshot = NULL WHERE task_id = :task_id"), updates)
+
+
+async def _m0009_medicine_usage_daily(conn: AsyncConnection) -> None:
+    # 表由 create_all 建好；这里按历史处方一次性回填，之后由开方事务增量维护
+    from app.services.medicine_usage import rebuild_usage_rollup
+
+    await rebuild_usage_rollup(conn)
+
+
+async def _m0010_ward_occupied_beds(conn: AsyncConnection) -> None:
+    # 计数在启动时由 init_bed_board 按住院表重新统计
+    await _add_column_if_missing(conn, "ward", "occupied_beds", "INTEGER NOT NULL DEFAULT 0")
+
+
+async def _m0011_nurseschedule_nurse_index(conn: AsyncConnection) -> None:
+    # 排班冲突检查与“我的排班”按护士 + 开始时间范围查询
+    await _create_index_if_missing(conn, "nurseschedule", "ix_nurseschedule_nurse_start", ("nurse_id", "start_time"))
+
+
+async def _m0012_nursetask_status_time_index(conn: AsyncConnection) -> None:
+    # 过期清扫按 status='未完成' AND time < now 范围更新
+    await _create_index_if_missing(conn, "nursetask", "ix_nursetask_status_time", ("status", "time"))
+
+
+async def _m0013_hospitalization_ledger_backfill(conn: AsyncConnection) -> None:
+    # 为台账上线前的住院记录一次性建账，读账单的接口因此不必再写库
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from sqlmodel import select
+
+    from app.models.hospital import Hospitalization, HospitalizationLedger
+    from app.services.billing import rebuild_ledgers
+
+    session = AsyncSession(bind=conn, expire_on_commit=False)
+    try:
+        while True:
+            stmt = (
+                select(Hospitalization)
+                .outerjoin(HospitalizationLedger, HospitalizationLedger.hosp_id == Hospitalization.hosp_id)
+                .where(HospitalizationLedger.hosp_id.is_(None))
+                .where(Hospitalization.in_date.is_not(None))
+                .order_by(Hospitalization.hosp_id)
+                .limit(500)
+            )
+            hosps = (await session.execute(stmt)).scalars().all()
+            if not hosps or not await rebuild_ledgers(session, hosps):
+                break
+            session.expunge_all()
+    finally:
+        await session.close()
+
+
+async def _m0014_nurseschedule_split_long_shifts(conn: AsyncConnection) -> None:
+    """Split shifts longer than ``NURSE_SHIFT_MAX_HOURS`` into back-to-back pieces.
+
+    Duty lookups only look ``MAX_SHIFT`` back from the window they load, so a
+    longer shift created before the limit existed would silently drop out of
+    "who is on duty". Each piece keeps the nurse and ward of the original.
+    """
+    from app.services.nurse_duty import MAX_SHIFT, MAX_SHIFT_HOURS
+
+    schedule = table(
+        "nurseschedule",
+        column("schedule_id", Integer),
+        column("nurse_id", Integer),
+        column("ward_id", Integer),
+        column("start_time", DateTime),
+        column("end_time", DateTime),
+    )
+    last_id, split, added = 0, 0, 0
+    while True:
+        rows = (await conn.execute(
+            schedule.select()
+            .where(schedule.c.schedule_id > last_id)
+            .order_by(schedule.c.schedule_id)
+            .limit(5000)
+        )).all()
+        if not rows:
+            break
+        last_id = rows[-1].schedule_id
+        pieces: List[dict] = []
+        for row in rows:
+            if row.end_time - row.start_time <= MAX_SHIFT:
+                continue
+            await conn.execute(
+                schedule.update()
+                .where(schedule.c.schedule_id == row.schedule_id)
+                .values(end_time=row.start_time + MAX_SHIFT)
+            )
+            start = row.start_time + MAX_SHIFT
+            while start < row.end_time:
+                end = min(start + MAX_SHIFT, row.end_time)
+                pieces.append({"nurse_id": row.nurse_id, "ward_id": row.ward_id, "start_time": start, "end_time": end})
+                start = end
+            split += 1
+        if pieces:
+            await conn.execute(schedule.insert(), pieces)
+            added += len(pieces)
+    if split:
+        print(f"INFO: 已将 {split} 个超过 {MAX_SHIFT_HOURS} 小时的护士班次拆分为连续班次（新增 {added} 条）")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "registration.visit_date", _m0001_registration_visit_date),
+    Migration(2, "registration.symptoms", _m0002_registration_symptoms),
+    Migration(3, "registration.status EXPIRED", _m0003_registration_status_expired),
+    Migration(4, "payment.reg_id", _m0004_payment_reg_id),
+    Migration(5, "registration/payment updated_at", _m0005_updated_at),
+    Migration(6, "hot-path composite indexes", _m0006_hot_path_indexes),
+    Migration(7, "examination price snapshot", _m0007_examination_price),
+    Migration(8, "nurse care plans replace task medicine JSON", _m0008_nurse_care_plans),
+    Migration(9, "medicine_usage_daily rollup backfill", _m0009_medicine_usage_daily),
+    Migration(10, "ward.occupied_beds", _m0010_ward_occupied_beds),
+    Migration(11, "nurseschedule nurse/start index", _m0011_nurseschedule_nurse_index),
+    Migration(12, "nursetask status/time index", _m0012_nursetask_status_time_index),
+    Migration(13, "hospitalization ledger backfill", _m0013_hospitalization_ledger_backfill),
+    Migration(14, "nurseschedule split shifts over the max length", _m0014_nurseschedule_split_long_shifts),
+]
+
+
+# ---- runner ----
+
+async def applied_versions(conn: AsyncConnection) -> Set[int]:
+    await conn.run_sync(_version_metadata.create_all)
+    rows = await conn.execute(schema_migrations.select())
+    return {row.version for row in rows}
+
+
+async def pending_migrations(conn: AsyncConnection) -> List[Migration]:
+    done = await applied_versions(conn)
+    return [m for m in MIGRATIONS if m.version not in done]
+
+
+async def run_migrations(conn: AsyncConnection) -> List[Migration]:
+    """Apply pending migrations in version order and record each one.
+
+    MySQL commits DDL implicitly, so every step is written to be re-runnable
+    in case the process dies between the DDL and the version insert.
+    """
+    applied: List[Migration] = []
+    for migration in await pending_migrations(conn):
+        await migration.apply(conn)
+        await conn.execute(
+            schema_migrations.insert().values(version=migration.version, name=migration.name, applied_at=now_bj())
+        )
+        applied.append(migration)
+    return applied
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List, Sequence, Union
+
+from sqlalchemy import Table
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def _dialect_name(session: AsyncSession) -> str:
+    return session.bind.dialect.name if session.bind is not None else ""
+
+
+async def insert_ignore(
+    session: AsyncSession,
+    table: Table,
+    rows: Union[Dict[str, Any], List[Dict[str, Any]]],
+    conflict_columns: Sequence[str],
+) -> int:
+    """Insert rows, silently skipping those that hit a unique constraint.
+
+    Uses the dialect's native form (MySQL ``INSERT IGNORE``, SQLite/PostgreSQL
+    ``ON CONFLICT DO NOTHING``) so concurrent callers never see an
+    IntegrityError; other dialects fall back to a savepoint. Returns how many
+    rows were actually inserted, so callers can tell whether they won a race.
+    MySQL's ``ON DUPLICATE KEY UPDATE`` no-op is not used because, with the
+    FOUND_ROWS client flag SQLAlchemy sets, a skipped row also counts as one.
+    """
+    if not rows:
+        return 0
+    dialect = _dialect_name(session)
+    if dialect == "mysql":
+        stmt = table.insert().prefix_with("IGNORE")
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+        stmt = sqlite_insert(table).on_conflict_do_nothing(index_elements=list(conflict_columns))
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+        stmt = pg_insert(table).on_conflict_do_nothing(index_elements=list(conflict_columns))
+    else:
+        inserted = 0
+        for row in rows if isinstance(rows, list) else [rows]:
+            try:
+                async with session.begin_nested():
+                    await session.execute(table.insert().values(**row))
+                inserted += 1
+            except IntegrityError:
+                pass
+        return inserted
+    if isinstance(rows, list):
+        result = await session.execute(stmt, rows)
+    else:
+        result = await session.execute(stmt.values(**rows))
+    return max(result.rowcount or 0, 0)
@@ -1,11 +1,19 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
 from sqlmodel import select
 from sqlalchemy import text
-from app.core.config import init_db, async_session
-from app.core.security import get_password_hash, SECRET_KEY, ALGORITHM
-from jose import jwt, JWTError
+from app.core.config import init_db, async_session, get_pool_status
+from app.core.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, loop_lag_monitor, render_metrics
+from app.core.security import get_password_hash
+from app.api.deps import decode_token_claims
 from app.core.time_utils import now_bj
+from app.services.patient_events import patient_event_relay
+from app.services.maintenance import nurse_task_expiry_sweeper, registration_expiry_sweeper
+from app.services.audit_log import audit_log_writer
+from app.services.exam_price_catalog import exam_price_catalog
+from app.services.registration_slots import resync_slots
+from app.services.bed_board import resync_beds
 
 # 导入所有模块
 from app.api import auth, patient_service, doctor_service, nurse_service, pharmacy_service, admin_service
@@ -66,14 +74,49 @@ async def init_triggers():
 
 
 
+async def init_registration_slots():
+    """Reconcile slot counters with the registration table (covers rows written before the slot table existed)."""
+    try:
+        async with async_session() as session:
+            await resync_slots(session)
+    except Exception as exc:  # noqa: W0703
+        print(f"WARN: failed to resync registration slots: {exc}")
+
+
+
+async def init_bed_board():
+    """Reconcile ward occupancy counters with active hospitalizations."""
+    try:
+        async with async_session() as session:
+            await resync_beds(session)
+    except Exception as exc:  # noqa: W0703
+        print(f"WARN: failed to resync ward occupancy: {exc}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("初始化表结构...")
     await init_db()
     await init_data()
     await init_triggers()
+    await init_registration_slots()
+    await init_bed_board()
+    patient_event_relay.start(async_session)
+    registration_expiry_sweeper.start(async_session)
+    nurse_task_expiry_sweeper.start(async_session)
+    await audit_log_writer.start(async_session)
+    loop_lag_monitor.start()
+    # 后台加载价格目录快照，过期则异步刷新，不阻塞启动
+    exam_price_catalog.start()
     print("启动完成！")
     yield
+    await exam_price_catalog.stop()
+    await loop_lag_monitor.stop()
+    await nurse_task_expiry_sweeper.stop()
+    await registration_expiry_sweeper.stop()
+    await patient_event_relay.stop()
+    # 关闭前把队列中剩余的审计日志写完
+    await audit_log_writer.stop()
 
 
 app = FastAPI(title="医院管理系统 API", lifespan=lifespan)
@@ -84,7 +127,7 @@ async def audit_log_middleware(request: Request, call_next):
     response = await call_next(request)
 
     path = request.url.path
-    skip_prefixes = ("/docs", "/openapi.json", "/redoc", "/static")
+    skip_prefixes = ("/docs", "/openapi.json", "/redoc", "/static", "/metrics")
     if path == "/" or any(path.startswith(prefix) for prefix in skip_prefixes):
         return response
 
@@ -93,33 +136,30 @@ async def audit_log_middleware(request: Request, call_next):
     role = None
     if auth_header.lower().startswith("bearer "):
         token = auth_header.split(" ", 1)[1]
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        # 认证依赖已解码过的 Token 会缓存在 request.state 上，这里直接复用
+        payload = decode_token_claims(request, token)
+        if payload:
             user_phone = payload.get("sub")
             role = payload.get("role")
-        except JWTError:
-            pass
 
     if user_phone:
-        try:
-            async with async_session() as session:
-                log = UserActionLog(
-                    user_phone=user_phone,
-                    role=str(role or ""),
-                    method=request.method,
-                    path=path,
-                    action=f"{request.method} {path}",
-                    status_code=response.status_code,
-                    ip_address=request.client.host if request.client else "unknown",
-                    created_at=now_bj(),
-                )
-                session.add(log)
-                await session.commit()
-        except Exception as exc:  # noqa: W0703
-            print(f"WARN: failed to record user action log: {exc}")
+        # 仅入队，由后台任务批量写库，不占用请求路径上的连接与事务
+        audit_log_writer.enqueue(
+            user_phone=user_phone,
+            role=str(role or ""),
+            method=request.method,
+            path=path,
+            action=f"{request.method} {path}",
+            status_code=response.status_code,
+            ip_address=request.client.host if request.client else "unknown",
+            created_at=now_bj(),
+        )
 
     return response
 
+# 最外层：统计各路由耗时、并发数及 SQL 语句数
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(auth.router, prefix="/auth", tags=["认证模块"])
 app.include_router(patient_service.router, prefix="/api", tags=["患者服务"])
 app.include_router(doctor_service.router, prefix="/api/doctor", tags=["医生工作站"])
@@ -130,4 +170,24 @@ app.include_router(admin_service.router, prefix="/api", tags=["管理员"])
 
 @app.get("/")
 async def root():
-    return {"message": "HMS Running on Port 8001"}
\ No newline at end of file
+    return {"message": "HMS Running on Port 8001"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus 抓取入口（文本格式）。"""
+    pool = get_pool_status()
+    audit = audit_log_writer.stats()
+    catalog = exam_price_catalog.stats()
+    body = render_metrics({
+        "hms_db_pool_size": ("Configured pool size.", pool.get("size")),
+        "hms_db_pool_checked_out": ("Connections currently checked out.", pool.get("checkedout")),
+        "hms_db_pool_checked_in": ("Idle connections in the pool.", pool.get("checkedin")),
+        "hms_db_pool_overflow": ("Connections opened beyond pool_size.", pool.get("overflow")),
+        "hms_audit_log_queue_depth": ("Audit log rows waiting to be written.", audit.get("queued")),
+        "hms_audit_log_dropped": ("Audit log rows dropped since start.", audit.get("dropped")),
+        "hms_exam_catalog_entries": ("Entries in the active exam price catalog.", catalog.get("entries")),
+        "hms_exam_catalog_age_seconds": ("Seconds since the exam price catalog was fetched.", catalog.get("age_seconds")),
+        "hms_exam_catalog_breaker_open": ("1 while the exam price source circuit breaker is open.", 1 if catalog.get("breaker_open_until") else 0),
+    })
+    return PlainTextResponse(body, media_type=METRICS_CONTENT_TYPE)
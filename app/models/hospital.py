@@ -1,3 +1,4 @@
+from sqlalchemy import Index, UniqueConstraint
 from sqlmodel import SQLModel, Field, Relationship
 from datetime import date, datetime
 from typing import Optional, List
@@ -65,6 +66,12 @@ class Patient(SQLModel, table=True):
 
 # --- 4. 挂号表 (Registration) ---
 class Registration(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_registration_patient_updated", "patient_id", "updated_at"),
+        Index("ix_registration_doctor_date_status", "doctor_id", "visit_date", "status"),
+        Index("ix_registration_patient_status", "patient_id", "status"),
+    )
+
     reg_id: Optional[int] = Field(default=None, primary_key=True)
     reg_date: datetime = Field(default_factory=now_bj)
     visit_date: date = Field(default_factory=today_bj, description="就诊日期（具体到日）")
@@ -72,12 +79,32 @@ class Registration(SQLModel, table=True):
     fee: float = Field(default=0.0)
     status: RegStatus = Field(default=RegStatus.WAITING)
     symptoms: Optional[str] = Field(default=None, max_length=500, description="患者自述症状")
+    updated_at: datetime = Field(
+        default_factory=now_bj,
+        sa_column_kwargs={"onupdate": now_bj},
+        description="最近一次状态变更时间（用于提醒增量同步）",
+    )
 
     # 外键
     patient_id: int = Field(foreign_key="patient.patient_id")
     doctor_id: int = Field(foreign_key="doctor.doctor_id")
 
 
+# --- 4b. 号源库存表 (RegistrationSlot) ---
+class RegistrationSlot(SQLModel, table=True):
+    """每位医生每天每种号别一行；挂号时用条件 UPDATE 原子扣减，避免超卖。"""
+    __table_args__ = (
+        UniqueConstraint("doctor_id", "visit_date", "reg_type", name="uq_registrationslot_doctor_date_type"),
+    )
+
+    slot_id: Optional[int] = Field(default=None, primary_key=True)
+    doctor_id: int = Field(foreign_key="doctor.doctor_id")
+    visit_date: date = Field(description="就诊日期")
+    reg_type: RegType = Field(description="号别")
+    capacity: int = Field(description="号源总数")
+    used: int = Field(default=0, description="已占用号源（不含已取消）")
+
+
 # --- 5. 病历表 (MedicalRecord) ---
 class MedicalRecord(SQLModel, table=True):
     record_id: Optional[int] = Field(default=None, primary_key=True)
@@ -110,11 +137,18 @@ class Ward(SQLModel, table=True):
     bed_count: int = Field(gt=0)
     type: str = Field(max_length=50)
     dept_id: int = Field(foreign_key="department.dept_id")
+    # 当前“在院”人数，由 app.services.bed_board 原子维护
+    occupied_beds: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
     schedules: List["NurseSchedule"] = Relationship(back_populates="ward")
 
 
 # --- 11. 排班表 ---
 class NurseSchedule(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_nurseschedule_ward_start", "ward_id", "start_time"),
+        Index("ix_nurseschedule_nurse_start", "nurse_id", "start_time"),
+    )
+
     schedule_id: Optional[int] = Field(default=None, primary_key=True)
     nurse_id: int = Field(foreign_key="nurse.nurse_id")
     ward_id: int = Field(foreign_key="ward.ward_id")
@@ -125,16 +159,54 @@ class NurseSchedule(SQLModel, table=True):
     ward: Optional[Ward] = Relationship(back_populates="schedules")
 
 
-# --- 11b. 护士代办表 (NurseTask) ---
+# --- 11b. 护理计划 (NurseCarePlan / NursePlanMedicine) ---
+class NurseCarePlan(SQLModel, table=True):
+    """One plan a doctor orders for a stay; its occurrences are NurseTask rows with this plan_id."""
+
+    __table_args__ = (
+        Index("ix_nursecareplan_hosp", "hosp_id"),
+    )
+
+    plan_id: Optional[int] = Field(default=None, primary_key=True)
+    hosp_id: int = Field(foreign_key="hospitalization.hosp_id")
+    type: str = Field(max_length=100, description="检查/任务类型")
+    detail: Optional[str] = Field(default=None, description="任务详情/备注")
+    signature: Optional[str] = Field(default=None, max_length=64, description="药品 + 详情签名，同一住院内相同计划的药品只计费一次")
+    created_at: datetime = Field(default_factory=now_bj)
+
+
+class NursePlanMedicine(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_nurseplanmedicine_plan", "plan_id"),
+    )
+
+    line_id: Optional[int] = Field(default=None, primary_key=True)
+    plan_id: int = Field(foreign_key="nursecareplan.plan_id")
+    medicine_id: int = Field(foreign_key="medicine.medicine_id")
+    name: Optional[str] = Field(default=None, max_length=100)
+    quantity: int = Field(gt=0)
+    usage: str = Field(max_length=200)
+
+
+# --- 11c. 护士代办表 (NurseTask) ---
 class NurseTask(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_nursetask_hosp_time", "hosp_id", "time"),
+        Index("ix_nursetask_time", "time"),
+        Index("ix_nursetask_plan", "plan_id"),
+        Index("ix_nursetask_status_time", "status", "time"),
+    )
+
     task_id: Optional[int] = Field(default=None, primary_key=True)
     type: str = Field(max_length=100, description="检查/任务类型")
     time: datetime = Field(description="需要完成的时间")
     status: str = Field(default="未完成", max_length=20, description="任务状态：未完成/已完成/已过期")
     hosp_id: int = Field(foreign_key="hospitalization.hosp_id")
     detail: Optional[str] = Field(default=None, description="任务详情/备注")
-    medicine_snapshot: Optional[str] = Field(default=None, description="药品 + 用法 JSON 快照")
+    # 旧版本每条任务复制一份药品 JSON；迁移后药品明细在 NursePlanMedicine，此列留空
+    medicine_snapshot: Optional[str] = Field(default=None, description="药品 + 用法 JSON 快照（已废弃）")
     service_fee: Optional[float] = Field(default=None, description="针灸/手术等额外服务费用")
+    plan_id: Optional[int] = Field(default=None, foreign_key="nursecareplan.plan_id")
 
     hospitalization: Optional["Hospitalization"] = Relationship()
 
@@ -148,6 +220,10 @@ class Medicine(SQLModel, table=True):
 
 # --- 13. 处方表 ---
 class Prescription(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_prescription_create_time", "create_time"),
+    )
+
     pres_id: Optional[int] = Field(default=None, primary_key=True)
     record_id: int = Field(foreign_key="medicalrecord.record_id", unique=True)
     create_time: datetime = Field(default_factory=now_bj)
@@ -164,6 +240,16 @@ class PrescriptionDetail(SQLModel, table=True):
     prescription: Optional[Prescription] = Relationship(back_populates="details")
 
 
+# --- 14.1 药品每日用量汇总（开方时事务内维护，供药房库存页读取） ---
+class MedicineUsageDaily(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_medicineusagedaily_date", "usage_date", "medicine_id", "quantity"),
+    )
+
+    medicine_id: int = Field(foreign_key="medicine.medicine_id", primary_key=True)
+    usage_date: date = Field(primary_key=True, description="按处方开具日期汇总")
+    quantity: int = Field(default=0)
+
 # --- 15. 检查表 (Examination) ---
 class ExamResult(str, Enum):
     VERY_LOW = "极低"
@@ -178,6 +264,10 @@ class Examination(SQLModel, table=True):
     type: str = Field(max_length=100, description="检查类型，由医生填写")
     result: str = Field(default=None, max_length=10, description="检查结果：极低/偏低/正常/偏高/极高")
     date: _datetime = Field(default_factory=now_bj)
+    # 开单时从价格目录锁定的价格；未匹配到目录项时为空，缴费按默认价
+    price: Optional[float] = Field(default=None, description="开单时锁定的检查价格")
+    matched_name: Optional[str] = Field(default=None, max_length=200, description="匹配到的价格目录项目名称")
+    catalog_version: Optional[str] = Field(default=None, max_length=32, description="价格目录版本")
 
     # 外键：关联病历（n:1）
     record_id: int = Field(foreign_key="medicalrecord.record_id")
@@ -193,11 +283,23 @@ class PaymentType(str, Enum):
 
 
 class Payment(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_payment_patient_updated", "patient_id", "updated_at"),
+        Index("ix_payment_patient_type_reg", "patient_id", "type", "reg_id"),
+        Index("ix_payment_pres_id", "pres_id"),
+        Index("ix_payment_exam_id", "exam_id"),
+    )
+
     payment_id: Optional[int] = Field(default=None, primary_key=True)
     type: PaymentType
     amount: float = Field(default=0.0, ge=0)
     status: str = Field(default="未缴费")
     time: _datetime = Field(default_factory=now_bj)
+    updated_at: _datetime = Field(
+        default_factory=now_bj,
+        sa_column_kwargs={"onupdate": now_bj},
+        description="最近一次状态变更时间（用于提醒增量同步）",
+    )
 
     # 关联外键（可选）
     patient_id: int = Field(foreign_key="patient.patient_id")
@@ -209,6 +311,10 @@ class Payment(SQLModel, table=True):
 
 # --- 16b. 住院表 (Hospitalization) ---
 class Hospitalization(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_hospitalization_status_ward", "status", "ward_id"),
+    )
+
     hosp_id: Optional[int] = Field(default=None, primary_key=True)
     status: str = Field(default="在院")
     in_date: datetime = Field(default_factory=now_bj)
@@ -219,4 +325,42 @@ class Hospitalization(SQLModel, table=True):
     record_id: Optional[int] = Field(default=None, foreign_key="medicalrecord.record_id")
 
     # 关系（可选）
-    # record: Optional[MedicalRecord] = Relationship()
\ No newline at end of file
+    # record: Optional[MedicalRecord] = Relationship()
+
+# --- 16b. 住院费用台账 (HospitalizationLedger / HospitalizationCharge) ---
+class HospitalizationLedger(SQLModel, table=True):
+    """Running totals of a stay's task charges; the current bill is this row plus base hours."""
+
+    hosp_id: int = Field(foreign_key="hospitalization.hosp_id", primary_key=True)
+    medicine_fee: float = Field(default=0.0)
+    service_fee: float = Field(default=0.0)
+    updated_at: datetime = Field(default_factory=now_bj)
+
+
+class HospitalizationCharge(SQLModel, table=True):
+    """One charge line of the ledger: a task's medicines (once per plan) or its service fee once completed."""
+
+    __table_args__ = (
+        UniqueConstraint("task_id", "kind", name="uq_hospitalizationcharge_task_kind"),
+        Index("ix_hospitalizationcharge_hosp", "hosp_id", "charge_id"),
+    )
+
+    charge_id: Optional[int] = Field(default=None, primary_key=True)
+    hosp_id: int = Field(foreign_key="hospitalization.hosp_id")
+    task_id: Optional[int] = Field(default=None, foreign_key="nursetask.task_id")
+    kind: str = Field(max_length=20, description="药品费/服务费")
+    amount: float = Field(default=0.0)
+    signature: Optional[str] = Field(default=None, max_length=64, description="药品计划签名，同一计划只计费一次")
+    items: Optional[str] = Field(default=None, description="计费时的药品明细 JSON（含单价）")
+    created_at: datetime = Field(default_factory=now_bj)
+
+
+# --- 17. 患者事件发件箱 (PatientEvent) ---
+class PatientEvent(SQLModel, table=True):
+    """Transactional outbox: written in the same transaction as the state change it describes."""
+
+    event_id: Optional[int] = Field(default=None, primary_key=True)
+    patient_id: int = Field(foreign_key="patient.patient_id", index=True)
+    kind: str = Field(max_length=50, description="事件类型，如 payment.paid")
+    payload: Optional[str] = Field(default=None, description="事件内容 JSON")
+    created_at: datetime = Field(default_factory=now_bj, index=True)
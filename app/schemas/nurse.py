@@ -97,4 +97,5 @@ class AutoScheduleRequest(SQLModel):
     start_time: Optional[datetime] = None
     shift_hours: int = Field(default=8, gt=0, le=24)
     shift_count: int = Field(default=3, gt=0, le=24)
+    days: int = Field(default=1, gt=0, le=31)
     ward_ids: Optional[List[int]] = None
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""Fill examination.price / matched_name / catalog_version for existing rows.
+
+Rows created before prices were locked at order time have NULL prices. This
+script resolves them in batches with ``exam_price_catalog.lookup_many``. With
+``--sync-payments`` it also updates the amount of their still-unpaid exam
+payments. ``--all`` re-resolves every row against the current catalog.
+
+Usage:
+    python -m app.scripts.backfill_exam_prices
+    python -m app.scripts.backfill_exam_prices --sync-payments --batch-size 2000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+from dotenv import load_dotenv
+
+
+async def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Backfill locked exam prices")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--all", action="store_true", help="Re-resolve rows that already have a price")
+    parser.add_argument("--sync-payments", action="store_true", help="Also update amounts of unpaid exam payments")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    from sqlalchemy import bindparam, update
+    from sqlmodel import select
+
+    from app.core.config import async_session, engine
+    from app.models.hospital import Examination, Payment, PaymentType
+    from app.services.exam_price_catalog import exam_price_catalog
+
+    snapshot = await exam_price_catalog.load_snapshot()
+    if not len(snapshot):
+        await exam_price_catalog.refresh(force=True)
+        snapshot = exam_price_catalog.snapshot
+    if not len(snapshot):
+        print("Catalog empty; nothing to resolve against")
+        await engine.dispose()
+        return
+    print(f"Catalog version {snapshot.version}: {len(snapshot)} entries")
+
+    exam_update = (
+        update(Examination)
+        .where(Examination.exam_id == bindparam("b_exam_id"))
+        .values(price=bindparam("b_price"), matched_name=bindparam("b_name"), catalog_version=bindparam("b_version"))
+    )
+    payment_update = (
+        update(Payment)
+        .where(Payment.exam_id == bindparam("b_exam_id"))
+        .where(Payment.type == PaymentType.EXAM)
+        .where(Payment.status != "已缴费")
+        .values(amount=bindparam("b_price"))
+    )
+
+    last_id = 0
+    scanned = resolved = unmatched = 0
+    while True:
+        async with async_session() as session:
+            stmt = select(Examination.exam_id, Examination.type).where(Examination.exam_id > last_id)
+            if not args.all:
+                stmt = stmt.where(Examination.price.is_(None))
+            rows = (await session.execute(stmt.order_by(Examination.exam_id).limit(args.batch_size))).all()
+            if not rows:
+                break
+            last_id = rows[-1].exam_id
+            scanned += len(rows)
+
+            matches = await exam_price_catalog.lookup_many(row.type for row in rows)
+            params = []
+            for row in rows:
+                match = matches.get(row.type)
+                if match is None:
+                    unmatched += 1
+                    continue
+                params.append({
+                    "b_exam_id": row.exam_id,
+                    "b_price": match.price,
+                    "b_name": match.matched_name,
+                    "b_version": match.catalog_version or None,
+                })
+            resolved += len(params)
+            if params and not args.dry_run:
+                conn = await session.connection()
+                await conn.execute(exam_update, params)
+                if args.sync_payments:
+                    await conn.execute(payment_update, [{"b_exam_id": p["b_exam_id"], "b_price": p["b_price"]} for p in params])
+                await session.commit()
+        print(f"scanned {scanned}, resolved {resolved}, unmatched {unmatched}")
+
+    print(f"Done: scanned {scanned}, resolved {resolved}, unmatched {unmatched}{' (dry run)' if args.dry_run else ''}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
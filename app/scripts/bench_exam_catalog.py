@@ -0,0 +1,166 @@
+"""Benchmark exam price lookups: linear scan vs. the n-gram index.
+
+Builds a catalog from the real price sheet (``--xls``) or from a synthetic
+one of ``--size`` medical service names. It resolves a realistic mix of
+doctor-entered exam names with both the previous linear algorithm and
+``CatalogIndex``, checks that every answer is identical, and prints the
+latency of each (plus the LRU-cached path).
+
+Usage:
+    python -m app.scripts.bench_exam_catalog --size 5000 --queries 2000
+    python -m app.scripts.bench_exam_catalog --xls app/data/exam_price_catalog.xls
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import difflib
+import random
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.services.exam_price_catalog import CatalogSnapshot, ExamPriceCatalog
+
+REGIONS = ["头颅", "胸部", "腹部", "盆腔", "颈椎", "腰椎", "膝关节", "肩关节", "甲状腺", "乳腺", "心脏", "肝胆胰脾", "泌尿系", "下肢血管", "颈部血管"]
+MODALITIES = ["CT平扫", "CT增强扫描", "磁共振平扫", "磁共振增强", "X线摄影", "彩色多普勒超声", "B超检查", "数字化摄影(DR)", "核素显像"]
+LAB_ITEMS = [
+    "血常规", "尿常规", "便常规", "肝功能", "肾功能", "血脂四项", "血糖测定", "糖化血红蛋白", "凝血四项", "甲状腺功能",
+    "C反应蛋白", "降钙素原", "血气分析", "电解质", "心肌酶谱", "肌钙蛋白", "乙肝五项", "丙肝抗体", "梅毒抗体", "HIV抗体",
+]
+LAB_METHODS = ["测定", "(化学发光法)", "(酶联免疫法)", "(干化学法)", "(仪器法)", "检测", "定量", "(流式细胞术)"]
+MISC = ["常规心电图检查", "动态心电图", "动态血压监测", "胃镜检查", "肠镜检查", "肺功能检查", "骨密度测定", "脑电图", "肌电图", "眼底检查"]
+DOCTOR_INPUTS = [
+    "血常规", "尿常规", "肝功能", "肾功能", "心电图", "胸部CT", "头颅CT", "腹部B超", "胸片", "甲功", "凝血", "血糖",
+    "胸部ct平扫", "头颅核磁", "腰椎磁共振平扫", "甲状腺彩超", "乳腺B超", "胃镜", "肠镜", "肺功能", "骨密度", "动态心电图",
+    "C反应蛋白测定", "血气分析", "乙肝五项定量", "心肌酶", "肌钙蛋白测定", "糖化血红蛋白测定",
+]
+
+
+def synthetic_catalog(size: int, rng: random.Random) -> Dict[str, float]:
+    names: List[str] = []
+    for region in REGIONS:
+        for modality in MODALITIES:
+            names.append(f"{region}{modality}")
+    for item in LAB_ITEMS:
+        for method in LAB_METHODS:
+            names.append(f"{item}{method}")
+    names.extend(MISC)
+    # 收费目录中同一项目常按部位/人群/加收方式拆成多条
+    suffixes = ["(每部位)", "(每次)", "(加收)", "(床旁)", "(急诊)", "(三维重建)", "(每增加一个部位)", "(儿童)"]
+    bases = list(names)
+    variants = [f"{base}{suffix}" for base in bases for suffix in suffixes]
+    variants += [f"{base}{first}{second}" for base in bases for first in suffixes for second in suffixes if first < second]
+    rng.shuffle(variants)
+    names.extend(variants[: max(size - len(names), 0)])
+    return {name: round(rng.uniform(5, 2000), 2) for name in names[:size]}
+
+
+def doctor_queries(count: int, catalog_names: List[str], rng: random.Random) -> List[str]:
+    queries = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.5:
+            queries.append(rng.choice(DOCTOR_INPUTS))
+        elif roll < 0.75:
+            queries.append(rng.choice(catalog_names))
+        else:
+            # 手工录入的错别字/漏字
+            name = list(rng.choice(catalog_names))
+            if len(name) > 3:
+                del name[rng.randrange(len(name))]
+            queries.append("".join(name))
+    return queries
+
+
+def legacy_lookup(price_map: Dict[str, float], normalized: str) -> Optional[str]:
+    """The previous linear algorithm, kept here for comparison."""
+    if normalized in price_map:
+        return normalized
+    candidate_key = None
+    longest = 0
+    for key in price_map:
+        if key in normalized or normalized in key:
+            if len(key) > longest:
+                longest = len(key)
+                candidate_key = key
+    if candidate_key:
+        return candidate_key
+    closest = difflib.get_close_matches(normalized, list(price_map.keys()), n=1, cutoff=0.8)
+    return closest[0] if closest else None
+
+
+def timed(fn, items) -> List[float]:
+    samples = []
+    for item in items:
+        started = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def summary(label: str, samples: List[float]) -> None:
+    ordered = sorted(samples)
+    p = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000  # noqa: E731
+    print(f"{label:<22} mean={sum(ordered) / len(ordered) * 1000:8.3f}ms  p50={p(0.5):8.3f}ms  p99={p(0.99):8.3f}ms  max={ordered[-1] * 1000:8.3f}ms")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Exam price lookup benchmark")
+    parser.add_argument("--xls", default=None, help="Real price sheet to index instead of a synthetic catalog")
+    parser.add_argument("--size", type=int, default=5000, help="Synthetic catalog size")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=13)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    catalog = ExamPriceCatalog()
+    started = time.perf_counter()
+    if args.xls:
+        data = Path(args.xls).read_bytes()
+        snapshot = catalog._build_snapshot(data, datetime.utcnow())
+    else:
+        snapshot = CatalogSnapshot(synthetic_catalog(args.size, rng).items(), version="synthetic", fetched_at=datetime.utcnow())
+    # 基准测试不触发加载与下载：直接换入构建好的快照
+    catalog._snapshot = snapshot
+    catalog._loaded = True
+    print(f"Catalog: {len(snapshot)} entries, index built in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    queries = [catalog._normalize(q) for q in doctor_queries(args.queries, list(snapshot.raw_names.values()), rng)]
+    legacy_results = {q: legacy_lookup(snapshot.price_map, q) for q in set(queries)}
+    mismatches = 0
+    for q in set(queries):
+        result = snapshot.match(q)
+        key = None
+        if result is not None:
+            key = next(k for k in (q, legacy_results[q]) if k and snapshot.raw_names.get(k) == result.matched_name)
+        if key != legacy_results[q]:
+            mismatches += 1
+            print(f"MISMATCH {q!r}: legacy={legacy_results[q]!r} indexed={result.matched_name if result else None!r}")
+
+    legacy = timed(lambda q: legacy_lookup(snapshot.price_map, q), queries)
+    indexed = timed(snapshot.match, queries)
+    snapshot.lookup_cache.clear()
+    cached_samples = []
+    for q in queries:
+        started = time.perf_counter()
+        await catalog.lookup_price(q)
+        cached_samples.append(time.perf_counter() - started)
+
+    hit_rate = sum(1 for q in set(queries) if legacy_results[q]) / len(set(queries))
+    print(f"Queries: {len(queries)} ({len(set(queries))} distinct, {hit_rate:.0%} resolvable)")
+    summary("linear scan", legacy)
+    summary("n-gram index", indexed)
+    summary("index + LRU", cached_samples)
+    print(f"Speed-up (mean): {sum(legacy) / max(sum(indexed), 1e-9):.0f}x")
+    if mismatches:
+        print(f"FAIL: {mismatches} lookups differ from the linear algorithm")
+        sys.exit(1)
+    print("OK: indexed lookups match the linear algorithm")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""Benchmark on-duty nurse resolution: full-history scan vs. the windowed interval index.
+
+Builds a year of three-shift rosters for ``--wards`` wards, plus some
+overlapping support shifts, and resolves the on-duty nurse for one day of
+tasks the way ``list_today_tasks`` does. The legacy path loads every shift of
+the wards and scans them per task. The new path keeps only the shifts that
+overlap the day (the rows ``load_duty_index`` would fetch) and uses
+``DutyIndex``. Every answer is checked against the legacy result.
+
+Usage:
+    python -m app.scripts.bench_nurse_duty --wards 40 --days 365 --tasks-per-ward 60
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from app.models.hospital import Nurse, NurseSchedule
+from app.services.nurse_duty import MAX_SHIFT, DutyIndex
+
+
+def build_roster(wards: int, days: int, nurses: List[Nurse], start: datetime, rng: random.Random) -> List[Tuple[NurseSchedule, Nurse]]:
+    rows = []
+    for ward_id in range(1, wards + 1):
+        for day in range(days):
+            base = start + timedelta(days=day)
+            for shift in range(3):
+                nurse = rng.choice(nurses)
+                shift_start = base + timedelta(hours=8 * shift)
+                rows.append((NurseSchedule(nurse_id=nurse.nurse_id, ward_id=ward_id, start_time=shift_start, end_time=shift_start + timedelta(hours=8)), nurse))
+            if rng.random() < 0.2:
+                # 临时支援班次，与常规班次重叠
+                nurse = rng.choice(nurses)
+                support_start = base + timedelta(hours=rng.randint(6, 18))
+                rows.append((NurseSchedule(nurse_id=nurse.nurse_id, ward_id=ward_id, start_time=support_start, end_time=support_start + timedelta(hours=4)), nurse))
+    return rows
+
+
+def legacy_resolve(schedule_map: Dict[int, list], ward_id: int, target: datetime) -> Optional[Nurse]:
+    """The previous linear scan, kept here for comparison."""
+    for schedule, nurse in schedule_map.get(ward_id, []):
+        if schedule.start_time <= target <= schedule.end_time:
+            return nurse
+    return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="On-duty nurse resolution benchmark")
+    parser.add_argument("--wards", type=int, default=40)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--nurses", type=int, default=120)
+    parser.add_argument("--tasks-per-ward", type=int, default=60, help="Tasks per ward on the queried day")
+    parser.add_argument("--seed", type=int, default=21)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    nurses = [Nurse(nurse_id=i, name=f"护士{i}", gender="女", phone=f"137{i:08d}") for i in range(1, args.nurses + 1)]
+    year_start = datetime(2025, 1, 1)
+    rows = build_roster(args.wards, args.days, nurses, year_start, rng)
+    day_start = year_start + timedelta(days=args.days - 30)
+    day_end = day_start + timedelta(days=1)
+    tasks = [
+        (ward_id, day_start + timedelta(minutes=rng.randrange(24 * 60)) if rng.random() < 0.9 else day_start + timedelta(hours=rng.choice((8, 16))))
+        for ward_id in range(1, args.wards + 1)
+        for _ in range(args.tasks_per_ward)
+    ]
+    print(f"Roster: {len(rows):,} shifts over {args.days} days for {args.wards} wards; {len(tasks):,} tasks on {day_start:%Y-%m-%d}")
+
+    # 旧实现：加载这些病房的全部排班，按任务逐一线性扫描
+    started = time.perf_counter()
+    schedule_map: Dict[int, list] = {}
+    for schedule, nurse in rows:
+        schedule_map.setdefault(schedule.ward_id, []).append((schedule, nurse))
+    for bucket in schedule_map.values():
+        bucket.sort(key=lambda entry: (entry[0].start_time, entry[0].end_time, entry[0].nurse_id))
+    legacy_build = time.perf_counter() - started
+    started = time.perf_counter()
+    legacy = [legacy_resolve(schedule_map, ward_id, at) for ward_id, at in tasks]
+    legacy_resolve_time = time.perf_counter() - started
+
+    # 新实现：只保留与查询时间窗重叠的排班（即 load_duty_index 的 WHERE 条件），再建区间索引
+    started = time.perf_counter()
+    window = [
+        (schedule, nurse) for schedule, nurse in rows
+        if day_start - MAX_SHIFT <= schedule.start_time <= day_end and schedule.end_time >= day_start
+    ]
+    duty = DutyIndex(window)
+    indexed_build = time.perf_counter() - started
+    started = time.perf_counter()
+    indexed = [duty.on_duty(ward_id, at) for ward_id, at in tasks]
+    indexed_resolve_time = time.perf_counter() - started
+
+    mismatches = sum(1 for a, b in zip(legacy, indexed) if (a.nurse_id if a else None) != (b.nurse_id if b else None))
+    print(f"{'full history + scan':<24} rows={len(rows):>9,}  build={legacy_build * 1000:8.1f}ms  resolve={legacy_resolve_time * 1000:8.1f}ms")
+    print(f"{'window + interval index':<24} rows={len(window):>9,}  build={indexed_build * 1000:8.1f}ms  resolve={indexed_resolve_time * 1000:8.1f}ms")
+    print(f"Speed-up (resolve): {legacy_resolve_time / max(indexed_resolve_time, 1e-9):.0f}x, rows loaded: {len(rows) / max(len(window), 1):.0f}x fewer")
+    if mismatches:
+        print(f"FAIL: {mismatches} tasks resolved to a different nurse")
+        sys.exit(1)
+    print("OK: interval index matches the linear scan")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Benchmark the nurse auto-scheduler on a month-long roster.
+
+Generates ``--wards`` wards with random occupancy and task volume and
+``--nurses`` nurses. Some nurses already have shifts in other wards. It then
+builds a ``--days`` roster of ``--shift-count`` shifts per day twice: once
+with the previous round-robin assignment and once with ``build_roster``.
+The engine's roster is checked for:
+
+* no nurse in two places at once;
+* at least the minimum rest between shifts, including pre-existing ones;
+* the weekly shift cap;
+* every ward with inpatients or tasks has a nurse on every shift.
+
+It also reports how evenly the load is spread. Unless ``--skip-db`` is
+given, the same roster is then generated end to end through the
+``/api/nurse/head/schedules/auto`` handler on a temporary SQLite database
+(or ``--database-url``), which times the queries and bulk insert.
+
+Usage:
+    python -m app.scripts.bench_nurse_roster --wards 100 --nurses 500 --days 30
+    python -m app.scripts.bench_nurse_roster --skip-db
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Nurse auto-scheduler benchmark")
+    parser.add_argument("--wards", type=int, default=100)
+    parser.add_argument("--nurses", type=int, default=500)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--shift-hours", type=int, default=8)
+    parser.add_argument("--shift-count", type=int, default=3, help="Shifts per day")
+    parser.add_argument("--tasks-per-shift", type=float, default=6.0, help="Average nurse tasks per ward and shift")
+    parser.add_argument("--existing-ratio", type=float, default=0.1, help="Share of nurses with a shift already booked elsewhere")
+    parser.add_argument("--seed", type=int, default=24)
+    parser.add_argument("--skip-db", action="store_true", help="Only benchmark the in-memory engine")
+    parser.add_argument("--database-url", default=None, help="Database URL (defaults to a temporary SQLite file; requires aiosqlite)")
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+if ARGS.database_url:
+    os.environ["DATABASE_URL"] = ARGS.database_url
+else:
+    _tmp_dir = tempfile.mkdtemp(prefix="hms_roster_")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(_tmp_dir) / 'bench.db'}?timeout=60"
+
+from sqlalchemy import func, insert  # noqa: E402
+from sqlmodel import SQLModel, select  # noqa: E402
+
+from app.core.config import async_session, engine  # noqa: E402
+from app.models.hospital import (  # noqa: E402
+    Department,
+    Gender,
+    Hospitalization,
+    Nurse,
+    NurseSchedule,
+    NurseTask,
+    Ward,
+)
+from app.schemas.nurse import AutoScheduleRequest  # noqa: E402
+from app.services.nurse_roster import RosterRules, bucket_tasks, build_roster, build_slots  # noqa: E402
+
+
+def make_dataset(rng: random.Random, start: datetime, slots: list):
+    wards = []
+    for ward_id in range(1, ARGS.wards + 1):
+        beds = rng.randint(4, 10)
+        wards.append((ward_id, beds, rng.randint(beds // 2, beds)))
+    tasks = []
+    for ward_id, _, occupied in wards:
+        for slot_start, _ in slots:
+            count = max(0, int(rng.gauss(ARGS.tasks_per_shift * occupied / 7, 2)))
+            for _ in range(count):
+                tasks.append((ward_id, slot_start + timedelta(minutes=rng.randrange(ARGS.shift_hours * 60))))
+    nurse_ids = list(range(1, ARGS.nurses + 1))
+    # 部分护士在其他病房（编号在本次排班范围之外）已有班次
+    existing = []
+    for nurse_id in rng.sample(nurse_ids, int(len(nurse_ids) * ARGS.existing_ratio)):
+        busy_start = start + timedelta(days=rng.randrange(ARGS.days), hours=rng.choice((0, 8, 16)))
+        existing.append((nurse_id, busy_start, busy_start + timedelta(hours=8)))
+    return wards, tasks, nurse_ids, existing
+
+
+def round_robin(wards: list, nurse_ids: list, slots: list) -> list:
+    """The previous assignment: one nurse per ward and shift, cycling through the nurse list."""
+    assignments, cursor = [], 0
+    for slot_start, slot_end in slots:
+        for ward_id, _, _ in wards:
+            assignments.append((nurse_ids[cursor % len(nurse_ids)], ward_id, slot_start, slot_end))
+            cursor += 1
+    return assignments
+
+
+def shift_loads(assignments: list, wards: list, buckets: dict, slots: list, rules: RosterRules) -> dict:
+    """Per-nurse share of ward load, splitting each ward-shift evenly over its nurses."""
+    occupied = {ward_id: occ for ward_id, _, occ in wards}
+    index_of = {slot[0]: index for index, slot in enumerate(slots)}
+    staff = defaultdict(list)
+    for nurse_id, ward_id, slot_start, _ in assignments:
+        staff[(ward_id, index_of[slot_start])].append(nurse_id)
+    loads = defaultdict(float)
+    for (ward_id, index), nurses in staff.items():
+        load = occupied[ward_id] / rules.patients_per_nurse + buckets.get((ward_id, index), 0) / rules.tasks_per_nurse
+        for nurse_id in nurses:
+            loads[nurse_id] += load / len(nurses)
+    return loads
+
+
+def check(assignments: list, existing: list, wards: list, buckets: dict, slots: list, rules: RosterRules, start: datetime) -> list:
+    problems = []
+    by_nurse = defaultdict(list)
+    for nurse_id, _, shift_start, shift_end in assignments:
+        by_nurse[nurse_id].append((shift_start, shift_end, True))
+    for nurse_id, shift_start, shift_end in existing:
+        by_nurse[nurse_id].append((shift_start, shift_end, False))
+    short_rest = overlaps = over_cap = 0
+    for nurse_id, shifts in by_nurse.items():
+        shifts.sort()
+        for (_, prev_end, _), (next_start, _, _) in zip(shifts, shifts[1:]):
+            if next_start < prev_end:
+                overlaps += 1
+            elif next_start - prev_end < rules.min_rest:
+                short_rest += 1
+        weeks = defaultdict(int)
+        for shift_start, _, _ in shifts:
+            if shift_start >= start:
+                weeks[(shift_start - start) // timedelta(days=7)] += 1
+        over_cap += sum(1 for count in weeks.values() if count > rules.max_shifts_per_week)
+    covered = {(ward_id, shift_start) for _, ward_id, shift_start, _ in assignments}
+    uncovered = sum(
+        1 for ward_id, _, occupied in wards for index, (slot_start, _) in enumerate(slots)
+        if (occupied or buckets.get((ward_id, index))) and (ward_id, slot_start) not in covered
+    )
+    for label, count in (("overlapping shifts", overlaps), ("shifts without minimum rest", short_rest),
+                         ("nurse-weeks over the cap", over_cap), ("ward-shifts without a nurse", uncovered)):
+        if count:
+            problems.append(f"{count} {label}")
+    return problems
+
+
+def describe(label: str, assignments: list, loads: dict, nurse_ids: list, elapsed: float, problems: list) -> None:
+    values = [loads.get(nurse_id, 0.0) for nurse_id in nurse_ids]
+    print(
+        f"{label:<12} shifts={len(assignments):>6,}  time={elapsed * 1000:8.1f}ms  "
+        f"load min/mean/max={min(values):.1f}/{statistics.mean(values):.1f}/{max(values):.1f}  "
+        f"stdev={statistics.pstdev(values):.2f}  {'; '.join(problems) or 'no rule violations'}"
+    )
+
+
+async def seed_database(wards: list, tasks: list, nurse_ids: list, existing: list) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with async_session() as session:
+        dept = Department(dept_name="内科")
+        session.add(dept)
+        await session.flush()
+        # 额外一个病房承载已有班次，不在自动排班范围内
+        await session.execute(insert(Ward), [
+            {"ward_id": ward_id, "bed_count": beds, "type": "普通病房", "dept_id": dept.dept_id, "occupied_beds": occupied}
+            for ward_id, beds, occupied in wards + [(ARGS.wards + 1, 10, 0)]
+        ])
+        await session.execute(insert(Nurse), [
+            {"nurse_id": nurse_id, "name": f"护士{nurse_id}", "gender": Gender.FEMALE, "phone": f"137{nurse_id:08d}", "is_head_nurse": False}
+            for nurse_id in nurse_ids
+        ] + [{"nurse_id": ARGS.nurses + 1, "name": "护士长", "gender": Gender.FEMALE, "phone": "13699999999", "is_head_nurse": True}])
+        hosp_rows, hosp_of_ward = [], {}
+        for ward_id, _, occupied in wards:
+            for _ in range(occupied):
+                hosp_rows.append({"hosp_id": len(hosp_rows) + 1, "ward_id": ward_id, "status": "在院", "in_date": datetime(2025, 1, 1)})
+                hosp_of_ward.setdefault(ward_id, []).append(len(hosp_rows))
+        await session.execute(insert(Hospitalization), hosp_rows)
+        task_rows = [
+            {"type": "巡视", "time": at, "status": "未完成", "hosp_id": hosp_of_ward[ward_id][i % len(hosp_of_ward[ward_id])]}
+            for i, (ward_id, at) in enumerate(tasks) if hosp_of_ward.get(ward_id)
+        ]
+        for offset in range(0, len(task_rows), 5000):
+            await session.execute(insert(NurseTask), task_rows[offset:offset + 5000])
+        if existing:
+            await session.execute(insert(NurseSchedule), [
+                {"nurse_id": nurse_id, "ward_id": ARGS.wards + 1, "start_time": shift_start, "end_time": shift_end}
+                for nurse_id, shift_start, shift_end in existing
+            ])
+        await session.commit()
+    print(f"Seeded {len(wards)} wards, {len(hosp_rows):,} inpatients, {len(task_rows):,} tasks, {len(existing)} existing shifts")
+
+
+async def run_database(wards: list, tasks: list, nurse_ids: list, existing: list, start: datetime) -> bool:
+    from app.api.nurse_service import auto_generate_schedules
+
+    print(f"Database: {os.environ['DATABASE_URL']}")
+    await seed_database(wards, tasks, nurse_ids, existing)
+    payload = AutoScheduleRequest(start_time=start, shift_hours=ARGS.shift_hours, shift_count=ARGS.shift_count, days=ARGS.days)
+    ok = True
+    for attempt in ("first run", "re-run"):
+        async with async_session() as session:
+            head = await session.get(Nurse, ARGS.nurses + 1)
+            started = time.perf_counter()
+            result = await auto_generate_schedules(payload, head, session)
+            elapsed = time.perf_counter() - started
+        async with async_session() as session:
+            stored = (await session.execute(
+                select(func.count()).select_from(NurseSchedule).where(NurseSchedule.ward_id <= ARGS.wards)
+            )).scalar()
+        print(f"Endpoint {attempt}: {elapsed:.2f}s, {result['detail']}; {stored:,} rows stored")
+        # 重复生成应替换原排班，而不是叠加
+        ok = ok and stored == result["created"]
+    await engine.dispose()
+    return ok
+
+
+def main() -> None:
+    rng = random.Random(ARGS.seed)
+    rules = RosterRules()
+    start = datetime(2025, 3, 1, 0, 0)
+    slots = build_slots(start, ARGS.shift_hours, ARGS.shift_count, ARGS.days)
+    wards, tasks, nurse_ids, existing = make_dataset(rng, start, slots)
+    buckets = bucket_tasks(slots, [(ward_id, at, 1) for ward_id, at in tasks])
+    print(
+        f"{ARGS.days}-day roster, {len(slots)} shifts, {len(wards)} wards, {len(nurse_ids)} nurses, {len(tasks):,} tasks; "
+        f"rest >= {rules.min_rest}, <= {rules.max_shifts_per_week} shifts/week"
+    )
+
+    started = time.perf_counter()
+    baseline = round_robin(wards, nurse_ids, slots)
+    baseline_time = time.perf_counter() - started
+    describe("round-robin", baseline, shift_loads(baseline, wards, buckets, slots, rules), nurse_ids, baseline_time,
+             check(baseline, existing, wards, buckets, slots, rules, start))
+
+    started = time.perf_counter()
+    roster = build_roster([(ward_id, occupied) for ward_id, _, occupied in wards], nurse_ids, slots, buckets, existing, rules)
+    engine_time = time.perf_counter() - started
+    problems = check(roster.assignments, existing, wards, buckets, slots, rules, start)
+    describe("engine", roster.assignments, shift_loads(roster.assignments, wards, buckets, slots, rules), nurse_ids, engine_time, problems)
+    if roster.unfilled:
+        print(f"  {roster.unfilled} extra positions left unfilled by the rest/cap rules")
+
+    ok = not problems
+    if not ARGS.skip_db:
+        ok = asyncio.run(run_database(wards, tasks, nurse_ids, existing, start)) and ok
+    if not ok:
+        print("FAIL: roster breaks a scheduling rule or the stored roster differs")
+        sys.exit(1)
+    print("OK: roster respects rest, weekly caps and overlaps, and covers every staffed ward-shift")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Benchmark GET /api/payments: SQL statements issued vs. payment history size.
+
+Seeds a throwaway database with one patient whose history grows (registration,
+exam and prescription payments per visit, plus periodic hospital stays with
+nursing tasks) and calls the endpoint directly, counting statements on the
+engine. The query count should stay flat as the history grows.
+
+Usage:
+    python -m app.scripts.bench_payments_queries --sizes 10 100 500
+    python -m app.scripts.bench_payments_queries --database-url sqlite+aiosqlite:///./bench.db
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Count queries issued by GET /api/payments")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500], help="Number of visits to seed per run")
+    parser.add_argument("--database-url", default=None, help="Database URL (defaults to a temporary SQLite file; requires aiosqlite)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed calls per size")
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+_tmp_dir = None
+if ARGS.database_url:
+    os.environ["DATABASE_URL"] = ARGS.database_url
+else:
+    _tmp_dir = tempfile.mkdtemp(prefix="hms_bench_")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(_tmp_dir) / 'bench.db'}"
+
+from sqlalchemy import event  # noqa: E402
+from sqlmodel import SQLModel, select  # noqa: E402
+
+from app.api.patient_service import get_my_payments  # noqa: E402
+from app.core.config import async_session, engine  # noqa: E402
+from app.core.time_utils import now_bj  # noqa: E402
+from app.models.hospital import (  # noqa: E402
+    Department,
+    Doctor,
+    Examination,
+    Gender,
+    Hospitalization,
+    MedicalRecord,
+    Medicine,
+    NurseCarePlan,
+    NursePlanMedicine,
+    NurseTask,
+    Patient,
+    Payment,
+    PaymentType,
+    Prescription,
+    PrescriptionDetail,
+    RegStatus,
+    Registration,
+    Ward,
+)
+from app.models.user import UserAccount, UserRole  # noqa: E402
+from app.services.billing import plan_signature, rebuild_ledgers  # noqa: E402
+
+PATIENT_PHONE = "13900000000"
+HOSPITAL_EVERY = 10
+TASKS_PER_STAY = 20
+
+
+class QueryCounter:
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, *args, **kwargs) -> None:
+        self.count += 1
+
+
+async def reset_schema() -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+
+async def seed(visits: int) -> int:
+    """Seed one patient with ``visits`` finished visits; returns the payment count."""
+    async with async_session() as session:
+        session.add(UserAccount(phone=PATIENT_PHONE, username="bench", password_hash="x", role=UserRole.PATIENT))
+        dept = Department(dept_name="内科")
+        session.add(dept)
+        await session.flush()
+        doctor = Doctor(name="医生", gender=Gender.MALE, title="普通医师", phone="13800000000", dept_id=dept.dept_id)
+        ward = Ward(bed_count=4, type="双人房", dept_id=dept.dept_id)
+        patient = Patient(name="患者", gender=Gender.MALE, birth_date=date(1990, 1, 1), id_number="110000199001010000", phone=PATIENT_PHONE)
+        medicines = [Medicine(name=f"药品{i}", price=10.0 + i, stock=10000, unit="盒") for i in range(20)]
+        session.add_all([doctor, ward, patient, *medicines])
+        await session.flush()
+
+        payments = 0
+        stays = []
+        base = now_bj() - timedelta(days=visits)
+        for i in range(visits):
+            visit_time = base + timedelta(days=i)
+            reg = Registration(
+                reg_date=visit_time,
+                visit_date=visit_time.date(),
+                fee=10.0,
+                status=RegStatus.FINISHED,
+                patient_id=patient.patient_id,
+                doctor_id=doctor.doctor_id,
+            )
+            session.add(reg)
+            await session.flush()
+            record = MedicalRecord(complaint="c", diagnosis="d", reg_id=reg.reg_id)
+            session.add(record)
+            await session.flush()
+            exam = Examination(type="血常规", result="正常", record_id=record.record_id)
+            pres = Prescription(record_id=record.record_id, total_amount=60.0)
+            session.add_all([exam, pres])
+            await session.flush()
+            for k in range(3):
+                med = medicines[(i + k) % len(medicines)]
+                session.add(PrescriptionDetail(pres_id=pres.pres_id, medicine_id=med.medicine_id, quantity=2, usage="口服"))
+            session.add_all([
+                Payment(type=PaymentType.REGISTRATION, amount=10.0, status="已缴费", patient_id=patient.patient_id, reg_id=reg.reg_id),
+                Payment(type=PaymentType.EXAM, amount=25.0, status="已缴费", patient_id=patient.patient_id, exam_id=exam.exam_id),
+                Payment(type=PaymentType.PRESCRIPTION, amount=60.0, status="已缴费", patient_id=patient.patient_id, pres_id=pres.pres_id),
+            ])
+            payments += 3
+
+            if i % HOSPITAL_EVERY == 0:
+                hosp = Hospitalization(
+                    status="已出院",
+                    in_date=visit_time,
+                    out_date=visit_time + timedelta(days=3),
+                    patient_id=patient.patient_id,
+                    ward_id=ward.ward_id,
+                    record_id=record.record_id,
+                )
+                session.add(hosp)
+                await session.flush()
+                for t in range(TASKS_PER_STAY):
+                    med = medicines[t % len(medicines)]
+                    items = [{"medicine_id": med.medicine_id, "name": med.name, "quantity": 1, "usage": "口服"}]
+                    plan = NurseCarePlan(
+                        hosp_id=hosp.hosp_id,
+                        type="吃药",
+                        signature=plan_signature(json.dumps(items, ensure_ascii=False), None),
+                    )
+                    session.add(plan)
+                    await session.flush()
+                    session.add(NursePlanMedicine(plan_id=plan.plan_id, **items[0]))
+                    session.add(NurseTask(
+                        type="吃药",
+                        time=visit_time + timedelta(hours=3 * t),
+                        status="已完成",
+                        hosp_id=hosp.hosp_id,
+                        plan_id=plan.plan_id,
+                    ))
+                session.add(Payment(type=PaymentType.HOSPITAL, amount=500.0, status="已缴费", patient_id=patient.patient_id, hosp_id=hosp.hosp_id))
+                payments += 1
+                stays.append(hosp)
+        # 与线上一致：住院记录从入院起就有费用台账，测量的是稳态读取
+        await rebuild_ledgers(session, stays)
+        await session.commit()
+    return payments
+
+
+async def measure(repeat: int) -> tuple[int, float]:
+    async with async_session() as session:
+        patient = (await session.execute(select(Patient).where(Patient.phone == PATIENT_PHONE))).scalars().one()
+
+    counter = QueryCounter()
+    event.listen(engine.sync_engine, "before_cursor_execute", counter)
+    try:
+        async with async_session() as session:
+            await get_my_payments(patient=patient, session=session)
+        queries = counter.count
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", counter)
+
+    elapsed = []
+    for _ in range(repeat):
+        async with async_session() as session:
+            start = time.perf_counter()
+            await get_my_payments(patient=patient, session=session)
+            elapsed.append(time.perf_counter() - start)
+    return queries, min(elapsed) * 1000 if elapsed else 0.0
+
+
+async def main() -> None:
+    print(f"Database: {os.environ['DATABASE_URL']}")
+    print(f"{'visits':>8} {'payments':>9} {'queries':>8} {'best_ms':>9}")
+    counts = []
+    for visits in ARGS.sizes:
+        await reset_schema()
+        payments = await seed(visits)
+        queries, best_ms = await measure(ARGS.repeat)
+        counts.append(queries)
+        print(f"{visits:>8} {payments:>9} {queries:>8} {best_ms:>9.1f}")
+    await engine.dispose()
+
+    if len(set(counts)) > 1:
+        print("FAIL: query count grows with payment history")
+        sys.exit(1)
+    print("OK: query count is independent of payment history size")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,6 +3,7 @@ from __future__ import annotations
 import argparse
 import asyncio
 import os
+import time
 from datetime import datetime
 from pathlib import Path
 
@@ -30,24 +31,36 @@ async def main() -> None:
     cache_path = Path(os.getenv("EXAM_PRICE_CACHE_PATH", CACHE_FILE))
     print(f"Source URL: {os.getenv('EXAM_PRICE_URL', PRICE_SOURCE_URL)}")
     print(f"Cache file: {cache_path}")
+    print(f"Snapshot file: {catalog.snapshot_file}")
     print(f"Cache TTL (seconds): {CACHE_TTL_SECONDS}")
     if cache_path.exists():
         print(f"Cache exists: yes (size={cache_path.stat().st_size} bytes, mtime={human_ts(cache_path)})")
     else:
         print("Cache exists: no")
+    if catalog.snapshot_file.exists():
+        print(f"Snapshot exists: yes (size={catalog.snapshot_file.stat().st_size} bytes, mtime={human_ts(catalog.snapshot_file)})")
+    else:
+        print("Snapshot exists: no")
+
+    snapshot = await catalog.load_snapshot()
+    stats = catalog.stats()
+    print(f"Snapshot load time: {stats['snapshot_load_ms']}ms ({len(snapshot)} entries, version {stats['version'] or '-'})")
+    if stats["age_seconds"] is not None:
+        print(f"Snapshot age: {stats['age_seconds'] / 3600:.1f}h ({'stale' if stats['stale'] else 'fresh'})")
 
     try:
-        await catalog.lookup_price(args.sample, force_refresh=args.force_refresh)
-        print("Download/parse: OK")
-        if catalog._price_map:
-            print(f"Loaded entries: {len(catalog._price_map)}")
-            match = catalog._price_map.get(catalog._normalize(args.sample))
-            print(f"Sample lookup '{args.sample}': {'found' if match is not None else 'not found'}")
+        if args.force_refresh or catalog.is_stale():
+            started = time.perf_counter()
+            ok = await catalog.refresh(force=True)
+            print(f"Download/parse: {'OK' if ok else 'failed: ' + str(catalog.stats()['last_error'])} ({(time.perf_counter() - started) * 1000:.0f}ms)")
+        if len(catalog.snapshot):
+            print(f"Loaded entries: {len(catalog.snapshot)}")
+            match = await catalog.lookup_price(args.sample)
+            print(f"Sample lookup '{args.sample}': {f'{match.matched_name} = {match.price}' if match is not None else 'not found'}")
         else:
             print("Catalog empty; using fallback in application paths")
     except Exception as exc:  # noqa: W0703
         print(f"Download/parse failed: {exc}")
 
-
 if __name__ == "__main__":
     asyncio.run(main())
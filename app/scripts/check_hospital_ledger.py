@@ -0,0 +1,179 @@
+"""Check hospitalization charge ledgers.
+
+By default, each stay's ``hospitalizationcharge`` lines are compared with the
+lines a full recomputation from its nurse tasks would write: medicines once
+per plan signature, a service fee per completed task. Missing lines, extra or
+duplicate lines (e.g. a plan charged twice) and amounts that differ are
+reported, and so are ledger totals that differ from the expected lines. A
+medicine line is expected at the unit prices saved with it when the task was
+created, so a later medicine price change is not reported as drift. ``--fix``
+builds missing ledgers, deletes extra lines, adds missing ones, corrects
+amounts and resets the totals.
+
+``--reprice`` compares the totals against ``recompute_hospitalization_bills``
+instead, which prices medicines at today's prices. With ``--fix`` it drops the
+differing ledgers and their lines and rebuilds them at current prices. Only
+use it when stays should really be re-billed.
+
+Usage:
+    python -m app.scripts.check_hospital_ledger
+    python -m app.scripts.check_hospital_ledger --fix
+    python -m app.scripts.check_hospital_ledger --reprice --fix
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+
+from dotenv import load_dotenv
+
+
+async def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Hospitalization ledger consistency check")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Allowed difference per fee (yuan)")
+    parser.add_argument("--reprice", action="store_true", help="Compare with a full recomputation at current medicine prices")
+    parser.add_argument("--fix", action="store_true", help="Rebuild missing ledgers and repair inconsistent ones")
+    parser.add_argument("--verbose", action="store_true", help="Print every inconsistent stay")
+    args = parser.parse_args()
+
+    from sqlalchemy import delete, update
+    from sqlmodel import select
+
+    from app.core.config import async_session, engine
+    from app.core.time_utils import now_bj
+    from app.models.hospital import Hospitalization, HospitalizationCharge, HospitalizationLedger
+    from app.services.billing import (
+        MEDICINE_CHARGE,
+        charge_line_key,
+        order_time_amount,
+        rebuild_ledgers,
+        recompute_charge_lines,
+        recompute_hospitalization_bills,
+    )
+
+    reference = "recomputed at current prices" if args.reprice else "recomputed charge lines"
+    last_id = 0
+    checked = missing = mismatched = fixed = 0
+    while True:
+        async with async_session() as session:
+            stmt = (
+                select(Hospitalization)
+                .where(Hospitalization.hosp_id > last_id)
+                .where(Hospitalization.in_date.is_not(None))
+                .order_by(Hospitalization.hosp_id)
+                .limit(args.batch_size)
+            )
+            hosps = (await session.execute(stmt)).scalars().all()
+            if not hosps:
+                break
+            last_id = hosps[-1].hosp_id
+            checked += len(hosps)
+
+            hosp_ids = [h.hosp_id for h in hosps]
+            ledger_stmt = select(HospitalizationLedger).where(HospitalizationLedger.hosp_id.in_(hosp_ids))
+            ledgers = {row.hosp_id: row for row in (await session.execute(ledger_stmt)).scalars().all()}
+            absent = [h for h in hosps if h.hosp_id not in ledgers]
+            missing += len(absent)
+
+            if args.reprice:
+                bills = await recompute_hospitalization_bills(session, hosps)
+                drifted = []
+                for hosp in hosps:
+                    ledger = ledgers.get(hosp.hosp_id)
+                    if ledger is None:
+                        continue
+                    bill = bills[hosp.hosp_id]
+                    if (abs(ledger.medicine_fee - bill["medicine_fee"]) > args.tolerance
+                            or abs(ledger.service_fee - bill["service_fee"]) > args.tolerance):
+                        mismatched += 1
+                        drifted.append(hosp)
+                        if args.verbose:
+                            print(
+                                f"hosp {hosp.hosp_id}: ledger medicine={ledger.medicine_fee:.2f} service={ledger.service_fee:.2f}, "
+                                f"{reference} medicine={bill['medicine_fee']:.2f} service={bill['service_fee']:.2f}"
+                            )
+                if args.fix and (absent or drifted):
+                    rebuild_ids = [h.hosp_id for h in absent + drifted]
+                    await session.execute(delete(HospitalizationCharge).where(HospitalizationCharge.hosp_id.in_(rebuild_ids)))
+                    await session.execute(delete(HospitalizationLedger).where(HospitalizationLedger.hosp_id.in_(rebuild_ids)))
+                    fixed += await rebuild_ledgers(session, absent + drifted)
+                    await session.commit()
+                continue
+
+            expected_lines = await recompute_charge_lines(session, [h for h in hosps if h.hosp_id in ledgers])
+            stored_stmt = (
+                select(HospitalizationCharge)
+                .where(HospitalizationCharge.hosp_id.in_(list(ledgers)))
+                .order_by(HospitalizationCharge.charge_id)
+            )
+            stored_by_hosp = {}
+            for line in (await session.execute(stored_stmt)).scalars().all():
+                stored_by_hosp.setdefault(line.hosp_id, {}).setdefault(charge_line_key(line), []).append(line)
+
+            repairs = []
+            for hosp_id, ledger in ledgers.items():
+                expected = {charge_line_key(line): line for line in expected_lines[hosp_id]}
+                stored = stored_by_hosp.get(hosp_id, {})
+                extra = [line for key, lines in stored.items() for line in (lines if key not in expected else lines[1:])]
+                absent_lines = [line for key, line in expected.items() if key not in stored]
+                amounts = {}
+                medicine = service = 0.0
+                for key, line in expected.items():
+                    kept = stored.get(key)
+                    # 药品按下单时保存的单价计算，服务费来自任务本身
+                    amount = order_time_amount(kept[0]) if kept and line.kind == MEDICINE_CHARGE else line.amount
+                    if kept and abs(kept[0].amount - amount) > args.tolerance:
+                        amounts[kept[0].charge_id] = amount
+                    if line.kind == MEDICINE_CHARGE:
+                        medicine += amount
+                    else:
+                        service += amount
+                totals_off = (abs(ledger.medicine_fee - medicine) > args.tolerance
+                              or abs(ledger.service_fee - service) > args.tolerance)
+                if not (extra or absent_lines or amounts or totals_off):
+                    continue
+                mismatched += 1
+                repairs.append((ledger, extra, absent_lines, amounts, medicine, service))
+                if args.verbose:
+                    print(
+                        f"hosp {hosp_id}: {len(absent_lines)} missing, {len(extra)} extra, {len(amounts)} wrong-amount lines; "
+                        f"ledger medicine={ledger.medicine_fee:.2f} service={ledger.service_fee:.2f}, "
+                        f"expected medicine={medicine:.2f} service={service:.2f}"
+                    )
+
+            if args.fix and (absent or repairs):
+                fixed += await rebuild_ledgers(session, absent)
+                for ledger, extra, absent_lines, amounts, medicine, service in repairs:
+                    if extra:
+                        await session.execute(
+                            delete(HospitalizationCharge)
+                            .where(HospitalizationCharge.charge_id.in_([line.charge_id for line in extra]))
+                        )
+                    for charge_id, amount in amounts.items():
+                        await session.execute(
+                            update(HospitalizationCharge).where(HospitalizationCharge.charge_id == charge_id).values(amount=amount)
+                        )
+                    session.add_all(absent_lines)
+                    await session.execute(
+                        update(HospitalizationLedger)
+                        .where(HospitalizationLedger.hosp_id == ledger.hosp_id)
+                        .values(medicine_fee=round(medicine, 2), service_fee=round(service, 2), updated_at=now_bj())
+                    )
+                    fixed += 1
+                await session.commit()
+
+    print(
+        f"Checked {checked} stays against {reference}: {missing} without ledger, {mismatched} inconsistent"
+        + (f", {fixed} repaired" if args.fix else "")
+    )
+    await engine.dispose()
+    if (missing or mismatched) and not args.fix:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
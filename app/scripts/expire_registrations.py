@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+from datetime import date
+
+from dotenv import load_dotenv
+
+from app.services.maintenance import expire_overdue_registrations
+
+
+async def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Expire overdue WAITING registrations hospital-wide")
+    parser.add_argument("--today", type=date.fromisoformat, default=None, help="Treat this date (YYYY-MM-DD) as today")
+    args = parser.parse_args()
+
+    from app.core.config import async_session, engine
+
+    async with async_session() as session:
+        counts = await expire_overdue_registrations(session, today=args.today)
+    await engine.dispose()
+    print(f"Expired registrations: {counts['registrations']}")
+    print(f"Cancelled registration-fee payments: {counts['payments']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
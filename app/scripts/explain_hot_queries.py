@@ -0,0 +1,149 @@
+"""EXPLAIN the hot-path queries and check each one is served by its index.
+
+Run after ``python -m app.scripts.migrate upgrade``. On MySQL the ``key``
+column of ``EXPLAIN`` is checked. On SQLite the ``EXPLAIN QUERY PLAN`` detail
+is checked. On a nearly empty MySQL table the optimizer may prefer a full
+scan even though the index exists. Such rows are reported as "candidate"
+(the index is listed in ``possible_keys``) rather than failing.
+
+Usage:
+    python -m app.scripts.explain_hot_queries
+"""
+
+from __future__ import annotations
+
+import asyncio
+import sys
+from datetime import timedelta
+
+from dotenv import load_dotenv
+
+
+def hot_queries():
+    from sqlmodel import select
+
+    from app.core.time_utils import now_bj, today_bj
+    from app.models.hospital import (
+        Hospitalization,
+        NurseSchedule,
+        NurseTask,
+        Payment,
+        PaymentType,
+        Prescription,
+        RegStatus,
+        Registration,
+    )
+
+    now = now_bj()
+    return [
+        (
+            "doctor schedule (registration by doctor/day/status)",
+            "ix_registration_doctor_date_status",
+            select(Registration)
+            .where(Registration.doctor_id == 1)
+            .where(Registration.visit_date == today_bj())
+            .where(Registration.status.in_([RegStatus.WAITING, RegStatus.IN_PROGRESS])),
+        ),
+        (
+            "active registration check (patient/status)",
+            "ix_registration_patient_status",
+            select(Registration.reg_id)
+            .where(Registration.patient_id == 1)
+            .where(Registration.status.in_([RegStatus.WAITING, RegStatus.IN_PROGRESS])),
+        ),
+        (
+            "registration fee lookup (payment by patient/type/reg)",
+            "ix_payment_patient_type_reg",
+            select(Payment)
+            .where(Payment.patient_id == 1)
+            .where(Payment.type == PaymentType.REGISTRATION)
+            .where(Payment.reg_id == 1),
+        ),
+        (
+            "prescription payment (payment by pres_id)",
+            "ix_payment_pres_id",
+            select(Payment).where(Payment.pres_id == 1),
+        ),
+        (
+            "exam payment (payment by exam_id)",
+            "ix_payment_exam_id",
+            select(Payment).where(Payment.exam_id == 1),
+        ),
+        (
+            "hospitalization tasks (nursetask by hosp ordered by time)",
+            "ix_nursetask_hosp_time",
+            select(NurseTask).where(NurseTask.hosp_id == 1).order_by(NurseTask.time),
+        ),
+        (
+            "due tasks window (nursetask by time)",
+            "ix_nursetask_time",
+            select(NurseTask).where(NurseTask.time >= now).where(NurseTask.time < now + timedelta(hours=2)),
+        ),
+        (
+            "ward inpatients (hospitalization by status/ward)",
+            "ix_hospitalization_status_ward",
+            select(Hospitalization).where(Hospitalization.status == "在院").where(Hospitalization.ward_id == 1),
+        ),
+        (
+            "ward duty roster (nurseschedule by ward/start)",
+            "ix_nurseschedule_ward_start",
+            select(NurseSchedule)
+            .where(NurseSchedule.ward_id == 1)
+            .where(NurseSchedule.start_time >= now - timedelta(hours=24))
+            .where(NurseSchedule.start_time <= now + timedelta(days=1)),
+        ),
+        (
+            "nurse shift overlap check (nurseschedule by nurse/start)",
+            "ix_nurseschedule_nurse_start",
+            select(NurseSchedule)
+            .where(NurseSchedule.nurse_id == 1)
+            .where(NurseSchedule.start_time >= now - timedelta(hours=24))
+            .where(NurseSchedule.start_time < now + timedelta(hours=8)),
+        ),
+        (
+            "recent prescriptions (prescription by create_time)",
+            "ix_prescription_create_time",
+            select(Prescription).where(Prescription.create_time >= now - timedelta(days=30)),
+        ),
+    ]
+
+
+async def main() -> None:
+    load_dotenv()
+    from sqlalchemy import text
+
+    from app.core.config import engine
+
+    failures = 0
+    async with engine.connect() as conn:
+        dialect = conn.dialect
+        for label, index_name, stmt in hot_queries():
+            sql = str(stmt.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+            if dialect.name == "mysql":
+                rows = (await conn.execute(text(f"EXPLAIN {sql}"))).mappings().all()
+                keys = {row.get("key") for row in rows}
+                possible = ",".join(str(row.get("possible_keys") or "") for row in rows)
+                if index_name in keys:
+                    verdict = "index"
+                elif index_name in possible:
+                    verdict = "candidate"
+                else:
+                    verdict = "SCAN"
+                plan = "; ".join(f"{row.get('table')}: type={row.get('type')} key={row.get('key')} rows={row.get('rows')}" for row in rows)
+            else:
+                rows = (await conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))).all()
+                plan = "; ".join(str(row[-1]) for row in rows)
+                verdict = "index" if index_name in plan else "SCAN"
+            if verdict == "SCAN":
+                failures += 1
+            print(f"[{verdict:^9}] {label}\n            expected {index_name}\n            {plan}")
+    await engine.dispose()
+
+    if failures:
+        print(f"FAIL: {failures} hot queries do not use their index")
+        sys.exit(1)
+    print("OK: every hot query is served by an index")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
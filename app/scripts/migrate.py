@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+from dotenv import load_dotenv
+
+
+async def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument("command", choices=["status", "upgrade"], help="status: list migrations; upgrade: create tables and apply pending migrations")
+    args = parser.parse_args()
+
+    from sqlmodel import SQLModel
+
+    import app.models.hospital  # noqa: F401  (register tables on the metadata)
+    import app.models.user  # noqa: F401
+    from app.core.config import engine
+    from app.core.migrations import MIGRATIONS, applied_versions, run_migrations
+
+    async with engine.begin() as conn:
+        if args.command == "upgrade":
+            await conn.run_sync(SQLModel.metadata.create_all)
+            applied = await run_migrations(conn)
+            for migration in applied:
+                print(f"applied  {migration.version:04d} {migration.name}")
+            if not applied:
+                print("Database is up to date")
+        else:
+            done = await applied_versions(conn)
+            for migration in MIGRATIONS:
+                state = "applied" if migration.version in done else "pending"
+                print(f"{state:<8} {migration.version:04d} {migration.name}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
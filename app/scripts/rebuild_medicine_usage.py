@@ -0,0 +1,56 @@
+"""Rebuild the ``medicineusagedaily`` rollup from prescription history.
+
+The rollup is kept up to date by ``create_prescription``. Run this after
+importing prescriptions directly into the database, or if ``--check`` reports
+drift. ``--since`` rebuilds only the days from that date on.
+
+Usage:
+    python -m app.scripts.rebuild_medicine_usage --check
+    python -m app.scripts.rebuild_medicine_usage
+    python -m app.scripts.rebuild_medicine_usage --since 2025-01-01
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+import time
+from datetime import date
+
+from dotenv import load_dotenv
+
+
+async def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Rebuild the daily medicine usage rollup")
+    parser.add_argument("--since", type=date.fromisoformat, default=None, help="Only rebuild days from this date (YYYY-MM-DD)")
+    parser.add_argument("--check", action="store_true", help="Compare with prescription history without writing")
+    args = parser.parse_args()
+
+    from app.core.config import engine
+    from app.services.medicine_usage import load_history_usage, load_rollup, rebuild_usage_rollup
+
+    started = time.perf_counter()
+    if not args.check:
+        async with engine.begin() as conn:
+            rows = await rebuild_usage_rollup(conn, since=args.since)
+        print(f"Rebuilt {rows} medicine/day rows in {time.perf_counter() - started:.1f}s")
+        await engine.dispose()
+        return
+
+    async with engine.connect() as conn:
+        expected = await load_history_usage(conn, since=args.since)
+        actual = await load_rollup(conn, since=args.since)
+    await engine.dispose()
+
+    drift = sorted(key for key in set(expected) | set(actual) if expected.get(key, 0) != actual.get(key, 0))
+    for medicine_id, day in drift[:20]:
+        print(f"medicine {medicine_id} {day}: rollup={actual.get((medicine_id, day), 0)} history={expected.get((medicine_id, day), 0)}")
+    print(f"Checked {len(expected)} medicine/day rows: {len(drift)} differ")
+    if drift:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from collections import deque
+from itertools import islice
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+
+from sqlalchemy import Column, MetaData, Table, insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.core.config import async_session
+from app.core.time_utils import now_bj
+from app.models.user import UserActionLog
+
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.getenv("AUDIT_FLUSH_INTERVAL_SECONDS", "1.0"))
+# 队列满时的丢弃策略：drop_newest 丢弃新日志，drop_oldest 丢弃最早的日志
+AUDIT_DROP_POLICY = os.getenv("AUDIT_DROP_POLICY", "drop_newest")
+AUDIT_MAX_RETRIES = 3
+# 同一批次连续失败这么多个周期后放弃（避免个别坏行，如账号已删除触发外键错误，阻塞整条队列）
+AUDIT_MAX_FAILED_CYCLES = 5
+# 可选：审计日志单独落库（为空则与业务库共用连接池）
+AUDIT_DATABASE_URL = os.getenv("AUDIT_DATABASE_URL") or None
+
+# 独立审计库不包含 useraccount 表，因此使用不带外键约束的同名表结构
+_standalone_metadata = MetaData()
+standalone_action_log_table = Table(
+    UserActionLog.__tablename__,
+    _standalone_metadata,
+    *[
+        Column(col.name, col.type, primary_key=col.primary_key, nullable=col.nullable, index=col.index)
+        for col in UserActionLog.__table__.columns
+    ],
+)
+
+
+class AuditLogWriter:
+    """Write-behind buffer for ``UserActionLog`` rows.
+
+    Requests only append to a bounded in-memory queue; a background task
+    bulk-inserts rows in batches of ``AUDIT_BATCH_SIZE`` or every
+    ``AUDIT_FLUSH_INTERVAL_SECONDS``, whichever comes first. When the database
+    falls behind and the queue is full, rows are dropped according to
+    ``AUDIT_DROP_POLICY`` instead of slowing down requests.
+    """
+
+    def __init__(
+        self,
+        max_queue: int = AUDIT_QUEUE_SIZE,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        flush_interval: float = AUDIT_FLUSH_INTERVAL_SECONDS,
+        drop_policy: str = AUDIT_DROP_POLICY,
+    ):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._session_factory = None
+        self._own_engine = None
+        self._table = UserActionLog.__table__
+        self.written = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        self._failed_cycles = 0
+        # 队首正在写入的行数：drop_oldest 只淘汰其后的行，每行只会计入写入或丢弃之一
+        self._in_flight = 0
+
+    @property
+    def session_factory(self):
+        return self._session_factory
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self._queue),
+            "max_queue": self.max_queue,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed_batches": self.failed_batches,
+            "separate_database": self._own_engine is not None,
+        }
+
+    def enqueue(self, **row: Any) -> None:
+        row.setdefault("created_at", now_bj())
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            if self.drop_policy != "drop_oldest" or len(self._queue) <= self._in_flight:
+                return
+            del self._queue[self._in_flight]
+        self._queue.append(row)
+        if self._wakeup is not None and len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def start(self, session_factory) -> None:
+        if self._task is not None:
+            return
+        if AUDIT_DATABASE_URL:
+            self._own_engine = create_async_engine(AUDIT_DATABASE_URL, pool_size=2, max_overflow=2, pool_pre_ping=True)
+            async with self._own_engine.begin() as conn:
+                await conn.run_sync(_standalone_metadata.create_all)
+            self._session_factory = sessionmaker(self._own_engine, class_=AsyncSession, expire_on_commit=False)
+            self._table = standalone_action_log_table
+        else:
+            self._session_factory = session_factory
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background writer and flush whatever is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._queue:
+            if not await self._write_batch():
+                break
+        if self._queue:
+            print(f"WARN: {len(self._queue)} audit log rows discarded at shutdown")
+            self.dropped += len(self._queue)
+            self._queue.clear()
+        if self._own_engine is not None:
+            await self._own_engine.dispose()
+            self._own_engine = None
+        self._wakeup = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._queue:
+                if not await self._write_batch():
+                    # 数据库暂时不可用：等下一个周期再试，期间新日志按丢弃策略处理
+                    break
+                if len(self._queue) < self.batch_size:
+                    break
+
+    async def _write_batch(self) -> bool:
+        batch: List[Dict[str, Any]] = list(islice(self._queue, self.batch_size))
+        if not batch:
+            return True
+        self._in_flight = len(batch)
+        try:
+            for attempt in range(AUDIT_MAX_RETRIES):
+                try:
+                    async with self._session_factory() as session:
+                        await session.execute(insert(self._table), batch)
+                        await session.commit()
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:  # noqa: W0703
+                    if attempt == AUDIT_MAX_RETRIES - 1:
+                        self.failed_batches += 1
+                        self._failed_cycles += 1
+                        print(f"WARN: failed to write {len(batch)} audit log rows: {exc}")
+                        if self._failed_cycles >= AUDIT_MAX_FAILED_CYCLES:
+                            self._failed_cycles = 0
+                            self.dropped += self._pop_batch(len(batch))
+                        return False
+                    await asyncio.sleep(0.2 * (attempt + 1))
+            self._failed_cycles = 0
+            self.written += self._pop_batch(len(batch))
+            return True
+        finally:
+            self._in_flight = 0
+
+    def _pop_batch(self, size: int) -> int:
+        # 写入期间队首的这一批不会被淘汰，按条数弹出即可
+        popped = 0
+        while popped < size and self._queue:
+            self._queue.popleft()
+            popped += 1
+        return popped
+
+
+audit_log_writer = AuditLogWriter()
+
+
+async def get_audit_session() -> AsyncIterator[AsyncSession]:
+    """Session bound to wherever audit rows are stored (the main DB unless AUDIT_DATABASE_URL is set)."""
+    factory = audit_log_writer.session_factory or async_session
+    async with factory() as session:
+        yield session
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from typing import List, Optional
+
+from sqlalchemy import func, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+
+from app.models.hospital import Hospitalization, NurseSchedule, Ward
+
+# 病床看板：Ward.occupied_beds 记录各病房“在院”人数，随住院/换房/出院原子增减
+ACTIVE_STATUS = "在院"
+
+
+async def allocate_bed(session: AsyncSession, ward_id: int) -> bool:
+    """Atomically take one bed; returns False when the ward is full.
+
+    The conditional UPDATE holds the ward row lock until the caller commits,
+    so the hospitalization insert and the counter change succeed or fail together.
+    """
+    result = await session.execute(
+        update(Ward)
+        .where(Ward.ward_id == ward_id)
+        .where(Ward.occupied_beds < Ward.bed_count)
+        .values(occupied_beds=Ward.occupied_beds + 1)
+        .execution_options(synchronize_session=False)
+    )
+    return (result.rowcount or 0) == 1
+
+
+async def release_bed(session: AsyncSession, ward_id: Optional[int]) -> None:
+    if ward_id is None:
+        return
+    await session.execute(
+        update(Ward)
+        .where(Ward.ward_id == ward_id)
+        .where(Ward.occupied_beds > 0)
+        .values(occupied_beds=Ward.occupied_beds - 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def resync_beds(session: AsyncSession) -> int:
+    """Recompute ``occupied_beds`` for every ward from active hospitalizations."""
+    counted = (
+        select(func.count())
+        .select_from(Hospitalization)
+        .where(Hospitalization.ward_id == Ward.ward_id)
+        .where(Hospitalization.status == ACTIVE_STATUS)
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        update(Ward).values(occupied_beds=counted).execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return result.rowcount or 0
+
+
+async def list_wards(
+    session: AsyncSession,
+    dept_id: Optional[int] = None,
+    nurse_id: Optional[int] = None,
+) -> List[Ward]:
+    """Wards with their live occupancy in one query, optionally limited to a
+    department or to the wards a nurse is scheduled on."""
+    stmt = select(Ward).order_by(Ward.ward_id)
+    if dept_id is not None:
+        stmt = stmt.where(Ward.dept_id == dept_id)
+    if nurse_id is not None:
+        scheduled = select(NurseSchedule.ward_id).where(NurseSchedule.nurse_id == nurse_id)
+        stmt = stmt.where(Ward.ward_id.in_(scheduled))
+    # 计数由其他请求原子更新，读取时覆盖会话中可能缓存的旧值
+    return list((await session.execute(stmt.execution_options(populate_existing=True))).scalars().all())
+
+
+def free_beds(ward: Ward) -> int:
+    return max(ward.bed_count - ward.occupied_beds, 0)
@@ -1,15 +1,29 @@
 from __future__ import annotations
 
+import hashlib
 import json
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
+from sqlalchemy import func, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import select
 
-from app.models.hospital import Hospitalization, Medicine, NurseTask
+from app.core.sql import insert_ignore
+from app.core.time_utils import now_bj
+from app.models.hospital import (
+    Hospitalization,
+    HospitalizationCharge,
+    HospitalizationLedger,
+    Medicine,
+    NurseCarePlan,
+    NursePlanMedicine,
+    NurseTask,
+)
 
 DEFAULT_HOSPITAL_HOURLY_RATE = 80.0
+MEDICINE_CHARGE = "药品费"
+SERVICE_CHARGE = "服务费"
 
 
 def _safe_load_snapshot(snapshot: Optional[str]) -> List[Dict[str, Any]]:
@@ -24,107 +38,426 @@ def _safe_load_snapshot(snapshot: Optional[str]) -> List[Dict[str, Any]]:
     return []
 
 
-async def compute_hospitalization_bill(
-    session: AsyncSession,
-    hospitalization: Hospitalization,
-    hourly_rate: float = DEFAULT_HOSPITAL_HOURLY_RATE,
-    reference_end: Optional[datetime] = None,
-) -> Dict[str, Any]:
-    if not hospitalization.in_date:
-        return {
-            "base_hours": 0.0,
-            "base_fee": 0.0,
-            "medicine_fee": 0.0,
-            "service_fee": 0.0,
-            "total_fee": 0.0,
-            "tasks": [],
-        }
+def _empty_bill() -> Dict[str, Any]:
+    return {
+        "base_hours": 0.0,
+        "base_fee": 0.0,
+        "medicine_fee": 0.0,
+        "service_fee": 0.0,
+        "total_fee": 0.0,
+        "tasks": [],
+    }
 
-    end_time = reference_end or hospitalization.out_date or datetime.now()
-    base_hours = max((end_time - hospitalization.in_date).total_seconds() / 3600, 0.5)
-    base_fee = round(base_hours * hourly_rate, 2)
 
-    task_stmt = (
-        select(NurseTask)
-        .where(NurseTask.hosp_id == hospitalization.hosp_id)
-        .order_by(NurseTask.time.asc(), NurseTask.task_id.asc())
+def plan_signature(medicines_json: str, detail: Optional[str]) -> str:
+    """Plans with the same medicines and detail within one stay are charged once (as before plans had rows)."""
+    return hashlib.sha1(f"{medicines_json}::{detail or ''}".encode("utf-8")).hexdigest()
+
+
+async def _load_plan_charges(session: AsyncSession, plan_ids: Iterable[Optional[int]]) -> Dict[int, Dict[str, Any]]:
+    """Per plan: signature, medicine fee summed in SQL, and the priced medicine lines for display."""
+    ids = {plan_id for plan_id in plan_ids if plan_id}
+    if not ids:
+        return {}
+    unit_price = func.coalesce(Medicine.price, 0.0)
+    fee_stmt = (
+        select(
+            NurseCarePlan.plan_id,
+            NurseCarePlan.signature,
+            func.coalesce(func.sum(func.round(NursePlanMedicine.quantity * unit_price, 2)), 0.0),
+            func.count(NursePlanMedicine.line_id),
+        )
+        .join(NursePlanMedicine, NursePlanMedicine.plan_id == NurseCarePlan.plan_id, isouter=True)
+        .join(Medicine, Medicine.medicine_id == NursePlanMedicine.medicine_id, isouter=True)
+        .where(NurseCarePlan.plan_id.in_(ids))
+        .group_by(NurseCarePlan.plan_id, NurseCarePlan.signature)
     )
-    tasks = (await session.execute(task_stmt)).scalars().all()
+    plans: Dict[int, Dict[str, Any]] = {}
+    for plan_id, signature, fee, line_count in (await session.execute(fee_stmt)).all():
+        plans[plan_id] = {"signature": signature, "fee": float(fee or 0.0), "has_medicines": bool(line_count), "items": []}
 
-    price_cache: Dict[int, float] = {}
-    task_details: List[Dict[str, Any]] = []
-    total_medicine_fee = 0.0
-    total_service_fee = 0.0
+    item_stmt = (
+        select(NursePlanMedicine, unit_price)
+        .join(Medicine, Medicine.medicine_id == NursePlanMedicine.medicine_id, isouter=True)
+        .where(NursePlanMedicine.plan_id.in_(ids))
+        .order_by(NursePlanMedicine.line_id)
+    )
+    for line, price in (await session.execute(item_stmt)).all():
+        price = float(price or 0.0)
+        plans[line.plan_id]["items"].append({
+            "medicine_id": line.medicine_id,
+            "name": line.name,
+            "usage": line.usage,
+            "quantity": line.quantity,
+            "unit_price": price,
+            "subtotal": round(price * line.quantity, 2),
+        })
+    return plans
 
-    charged_snapshots: Set[str] = set()
 
+def _task_charges(tasks: List[NurseTask], plans: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Charges of each task, from scratch: medicines once per plan signature, service fee once completed."""
+    charges: List[Dict[str, Any]] = []
+    charged_signatures: Set[str] = set()
     for task in tasks:
-        is_completed = task.status == "已完成"
-        raw_snapshot = task.medicine_snapshot or ""
-        snapshot_entries = _safe_load_snapshot(raw_snapshot)
-        snapshot_signature = (
-            f"{raw_snapshot}::{task.detail or ''}"
-            if raw_snapshot and snapshot_entries
-            else None
-        )
-
-        charge_medicines = bool(snapshot_entries)
-        if charge_medicines and snapshot_signature:
-            if snapshot_signature in charged_snapshots:
+        plan = plans.get(task.plan_id) if task.plan_id else None
+        medicine_items = plan["items"] if plan else []
+        charge_medicines = bool(plan and plan["has_medicines"])
+        signature = plan["signature"] if charge_medicines else None
+        if charge_medicines and signature:
+            if signature in charged_signatures:
                 charge_medicines = False
             else:
-                charged_snapshots.add(snapshot_signature)
-
-        medicine_items: List[Dict[str, Any]] = []
-        medicine_fee = 0.0
-        for item in snapshot_entries:
-            med_id = item.get("medicine_id")
-            quantity = item.get("quantity")
-            if not med_id or not quantity:
-                continue
-            if med_id not in price_cache:
-                medicine = await session.get(Medicine, med_id)
-                price_cache[med_id] = float(medicine.price) if medicine else 0.0
-            unit_price = price_cache[med_id]
-            subtotal = round(unit_price * quantity, 2)
-            if charge_medicines:
-                medicine_fee += subtotal
-            medicine_items.append({
-                "medicine_id": med_id,
-                "name": item.get("name"),
-                "usage": item.get("usage"),
-                "quantity": quantity,
-                "unit_price": unit_price,
-                "subtotal": subtotal,
-            })
-
-        raw_service_fee = round(task.service_fee or 0.0, 2)
-        service_fee = raw_service_fee if is_completed else 0.0
-
-        total_medicine_fee += medicine_fee
-        total_service_fee += service_fee
+                charged_signatures.add(signature)
 
+        medicine_fee = plan["fee"] if charge_medicines else 0.0
+        service_fee = round(task.service_fee or 0.0, 2) if task.status == "已完成" else 0.0
         if medicine_fee + service_fee == 0.0:
             continue
+        charges.append({
+            "task": task,
+            "signature": signature if charge_medicines else None,
+            "medicine_fee": medicine_fee,
+            "service_fee": service_fee,
+            "medicines": medicine_items,
+        })
+    return charges
 
+
+def _base_charge(hospitalization: Hospitalization, hourly_rate: float, reference_end: Optional[datetime]) -> Tuple[float, float]:
+    end_time = reference_end or hospitalization.out_date or datetime.now()
+    base_hours = max((end_time - hospitalization.in_date).total_seconds() / 3600, 0.5)
+    return base_hours, round(base_hours * hourly_rate, 2)
+
+
+def _bill(base_hours: float, base_fee: float, medicine_fee: float, service_fee: float, task_details: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "base_hours": round(base_hours, 2),
+        "base_fee": base_fee,
+        "medicine_fee": round(medicine_fee, 2),
+        "service_fee": round(service_fee, 2),
+        "total_fee": round(base_fee + medicine_fee + service_fee, 2),
+        "tasks": task_details,
+    }
+
+
+def _build_bill(
+    hospitalization: Hospitalization,
+    tasks: List[NurseTask],
+    plans: Dict[int, Dict[str, Any]],
+    hourly_rate: float,
+    reference_end: Optional[datetime],
+) -> Dict[str, Any]:
+    if not hospitalization.in_date:
+        return _empty_bill()
+
+    base_hours, base_fee = _base_charge(hospitalization, hourly_rate, reference_end)
+    task_details: List[Dict[str, Any]] = []
+    total_medicine_fee = 0.0
+    total_service_fee = 0.0
+    for charge in _task_charges(tasks, plans):
+        task = charge["task"]
+        total_medicine_fee += charge["medicine_fee"]
+        total_service_fee += charge["service_fee"]
         task_details.append({
             "task_id": task.task_id,
             "type": task.type,
             "time": task.time,
             "detail": task.detail,
-            "medicine_fee": round(medicine_fee, 2),
-            "service_fee": service_fee,
-            "total_fee": round(medicine_fee + service_fee, 2),
-            "medicines": medicine_items,
+            "medicine_fee": round(charge["medicine_fee"], 2),
+            "service_fee": charge["service_fee"],
+            "total_fee": round(charge["medicine_fee"] + charge["service_fee"], 2),
+            "medicines": charge["medicines"],
         })
+    return _bill(base_hours, base_fee, total_medicine_fee, total_service_fee, task_details)
+
 
-    total_amount = round(base_fee + total_medicine_fee + total_service_fee, 2)
+async def _load_tasks(session: AsyncSession, hosp_ids: List[int]) -> Dict[int, List[NurseTask]]:
+    tasks_by_hosp: Dict[int, List[NurseTask]] = {hosp_id: [] for hosp_id in hosp_ids}
+    if hosp_ids:
+        task_stmt = (
+            select(NurseTask)
+            .where(NurseTask.hosp_id.in_(hosp_ids))
+            .order_by(NurseTask.time.asc(), NurseTask.task_id.asc())
+        )
+        for task in (await session.execute(task_stmt)).scalars().all():
+            tasks_by_hosp[task.hosp_id].append(task)
+    return tasks_by_hosp
 
+
+async def recompute_hospitalization_bills(
+    session: AsyncSession,
+    hospitalizations: Iterable[Hospitalization],
+    hourly_rate: float = DEFAULT_HOSPITAL_HOURLY_RATE,
+    reference_end: Optional[datetime] = None,
+) -> Dict[int, Dict[str, Any]]:
+    """Full recomputation from every task and current medicine prices (ledger rebuilds and consistency checks)."""
+    hosps = [h for h in hospitalizations if h is not None]
+    tasks_by_hosp = await _load_tasks(session, [h.hosp_id for h in hosps if h.in_date])
+    plans = await _load_plan_charges(session, (task.plan_id for bucket in tasks_by_hosp.values() for task in bucket))
     return {
-        "base_hours": round(base_hours, 2),
-        "base_fee": base_fee,
-        "medicine_fee": round(total_medicine_fee, 2),
-        "service_fee": round(total_service_fee, 2),
-        "total_fee": total_amount,
-        "tasks": task_details,
+        h.hosp_id: _build_bill(h, tasks_by_hosp.get(h.hosp_id, []), plans, hourly_rate, reference_end)
+        for h in hosps
     }
+
+
+# ---- 住院费用台账：建任务/完成任务时增量记账，读账单只读汇总行与明细行 ----
+
+def _bump_ledger(hosp_id: int, medicine_delta: float = 0.0, service_delta: float = 0.0):
+    return (
+        update(HospitalizationLedger)
+        .where(HospitalizationLedger.hosp_id == hosp_id)
+        .values(
+            medicine_fee=HospitalizationLedger.medicine_fee + medicine_delta,
+            service_fee=HospitalizationLedger.service_fee + service_delta,
+            updated_at=now_bj(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _charge_lines(hosp_id: int, charges: List[Dict[str, Any]]) -> List[HospitalizationCharge]:
+    lines: List[HospitalizationCharge] = []
+    for charge in charges:
+        items = json.dumps(charge["medicines"], ensure_ascii=False) if charge["medicines"] else None
+        if charge["medicine_fee"]:
+            lines.append(HospitalizationCharge(
+                hosp_id=hosp_id,
+                task_id=charge["task"].task_id,
+                kind=MEDICINE_CHARGE,
+                amount=round(charge["medicine_fee"], 2),
+                signature=charge["signature"],
+                items=items,
+            ))
+        if charge["service_fee"]:
+            lines.append(HospitalizationCharge(
+                hosp_id=hosp_id,
+                task_id=charge["task"].task_id,
+                kind=SERVICE_CHARGE,
+                amount=charge["service_fee"],
+                items=items,
+            ))
+    return lines
+
+
+async def recompute_charge_lines(
+    session: AsyncSession,
+    hospitalizations: Iterable[Hospitalization],
+) -> Dict[int, List[HospitalizationCharge]]:
+    """The (unsaved) charge lines a full recomputation gives each stay, medicines at current prices."""
+    hosps = [h for h in hospitalizations if h is not None and h.in_date]
+    tasks_by_hosp = await _load_tasks(session, [h.hosp_id for h in hosps])
+    plans = await _load_plan_charges(session, (task.plan_id for bucket in tasks_by_hosp.values() for task in bucket))
+    return {h.hosp_id: _charge_lines(h.hosp_id, _task_charges(tasks_by_hosp[h.hosp_id], plans)) for h in hosps}
+
+
+def charge_line_key(line: HospitalizationCharge) -> Tuple[str, Any]:
+    """Identity of a charge line when comparing stored lines with a recomputation.
+
+    A plan's medicines are charged once per stay, on whichever of its tasks
+    was created first, so medicine lines with a signature are matched by
+    signature; every other line belongs to its task.
+    """
+    if line.kind == MEDICINE_CHARGE and line.signature:
+        return line.kind, line.signature
+    return line.kind, line.task_id
+
+
+def order_time_amount(line: HospitalizationCharge) -> float:
+    """A medicine line's amount re-added from the unit prices saved with it; other lines as stored."""
+    if line.kind != MEDICINE_CHARGE:
+        return round(line.amount or 0.0, 2)
+    items = _safe_load_snapshot(line.items)
+    if not items:
+        return round(line.amount or 0.0, 2)
+    return round(sum(round(float(item.get("unit_price") or 0.0) * float(item.get("quantity") or 0), 2) for item in items), 2)
+
+
+async def rebuild_ledgers(session: AsyncSession, hospitalizations: Iterable[Hospitalization]) -> int:
+    """Create ledgers for stays that have none, from a full recomputation. Returns how many were created."""
+    hosps = [h for h in hospitalizations if h is not None and h.in_date]
+    if not hosps:
+        return 0
+    lines_by_hosp = await recompute_charge_lines(session, hosps)
+    created = 0
+    for hosp in hosps:
+        lines = lines_by_hosp[hosp.hosp_id]
+        # 并发懒重建时只有一个请求能插入台账行，其余的读取已有结果
+        inserted = await insert_ignore(session, HospitalizationLedger.__table__, {
+            "hosp_id": hosp.hosp_id,
+            "medicine_fee": round(sum(line.amount for line in lines if line.kind == MEDICINE_CHARGE), 2),
+            "service_fee": round(sum(line.amount for line in lines if line.kind == SERVICE_CHARGE), 2),
+            "updated_at": now_bj(),
+        }, ["hosp_id"])
+        if inserted:
+            session.add_all(lines)
+            created += 1
+    await session.flush()
+    return created
+
+
+async def backfill_ledgers(session: AsyncSession, hospitalizations: Iterable[Hospitalization]) -> int:
+    """Rebuild the ledgers that are missing for the given stays; returns how many were created."""
+    hosps = [h for h in hospitalizations if h is not None and h.in_date]
+    if not hosps:
+        return 0
+    stmt = select(HospitalizationLedger.hosp_id).where(HospitalizationLedger.hosp_id.in_([h.hosp_id for h in hosps]))
+    present = set((await session.execute(stmt)).scalars().all())
+    missing = [h for h in hosps if h.hosp_id not in present]
+    return await rebuild_ledgers(session, missing) if missing else 0
+
+
+async def ensure_ledgers(session: AsyncSession, hospitalizations: Iterable[Hospitalization]) -> Dict[int, HospitalizationLedger]:
+    """Ledgers of the given stays; stays created before the ledger existed are rebuilt lazily.
+
+    Migration 0013 backfills every stay, so the rebuild only runs for rows
+    written by something that bypassed the application.
+    """
+    hosps = [h for h in hospitalizations if h is not None and h.in_date]
+    hosp_ids = [h.hosp_id for h in hosps]
+    if not hosp_ids:
+        return {}
+    stmt = select(HospitalizationLedger).where(HospitalizationLedger.hosp_id.in_(hosp_ids))
+    ledgers = {row.hosp_id: row for row in (await session.execute(stmt)).scalars().all()}
+    missing = [h for h in hosps if h.hosp_id not in ledgers]
+    if missing:
+        await rebuild_ledgers(session, missing)
+        stmt = select(HospitalizationLedger).where(HospitalizationLedger.hosp_id.in_([h.hosp_id for h in missing]))
+        ledgers.update({row.hosp_id: row for row in (await session.execute(stmt)).scalars().all()})
+    return ledgers
+
+
+async def ensure_ledger(session: AsyncSession, hospitalization: Hospitalization) -> Optional[HospitalizationLedger]:
+    return (await ensure_ledgers(session, [hospitalization])).get(hospitalization.hosp_id)
+
+
+async def record_task_charges(session: AsyncSession, hosp_id: int, tasks: List[NurseTask]) -> None:
+    """Charge the medicines of newly created (and flushed) plan tasks, once per plan signature per stay.
+
+    Call ``ensure_ledger`` before adding the tasks, so a lazy rebuild cannot count them too.
+    The stay's ledger row is locked before the charged signatures are read, so
+    concurrent requests for the same stay charge a plan once between them.
+    """
+    plans = await _load_plan_charges(session, (task.plan_id for task in tasks))
+    first_tasks: Dict[str, NurseTask] = {}
+    for task in sorted(tasks, key=lambda t: (t.time, t.task_id or 0)):
+        plan = plans.get(task.plan_id) if task.plan_id else None
+        if plan and plan["has_medicines"] and plan["signature"]:
+            first_tasks.setdefault(plan["signature"], task)
+    if not first_tasks:
+        return
+
+    # 先锁住台账行：并发为同一住院单建任务时后到的请求在此等待，随后的加锁读能看到先提交的计费行
+    await session.execute(
+        select(HospitalizationLedger.hosp_id).where(HospitalizationLedger.hosp_id == hosp_id).with_for_update()
+    )
+    existing_stmt = (
+        select(HospitalizationCharge.signature)
+        .where(HospitalizationCharge.hosp_id == hosp_id)
+        .where(HospitalizationCharge.kind == MEDICINE_CHARGE)
+        .where(HospitalizationCharge.signature.in_(list(first_tasks)))
+        .with_for_update()
+    )
+    charged = set((await session.execute(existing_stmt)).scalars().all())
+
+    delta = 0.0
+    for signature, task in first_tasks.items():
+        plan = plans[task.plan_id]
+        if signature in charged or not plan["fee"]:
+            continue
+        session.add(HospitalizationCharge(
+            hosp_id=hosp_id,
+            task_id=task.task_id,
+            kind=MEDICINE_CHARGE,
+            amount=round(plan["fee"], 2),
+            signature=signature,
+            items=json.dumps(plan["items"], ensure_ascii=False),
+        ))
+        delta += plan["fee"]
+    if delta:
+        await session.execute(_bump_ledger(hosp_id, medicine_delta=delta))
+
+
+async def record_task_completion(session: AsyncSession, task: NurseTask) -> None:
+    """Charge a task's service fee when it turns 已完成 (call ``ensure_ledger`` before changing the status)."""
+    fee = round(task.service_fee or 0.0, 2)
+    if not fee:
+        return
+    plans = await _load_plan_charges(session, [task.plan_id])
+    medicine_items = plans[task.plan_id]["items"] if task.plan_id in plans else []
+    session.add(HospitalizationCharge(
+        hosp_id=task.hosp_id,
+        task_id=task.task_id,
+        kind=SERVICE_CHARGE,
+        amount=fee,
+        items=json.dumps(medicine_items, ensure_ascii=False) if medicine_items else None,
+    ))
+    await session.execute(_bump_ledger(task.hosp_id, service_delta=fee))
+
+
+async def _load_charge_details(session: AsyncSession, hosp_ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    details: Dict[int, List[Dict[str, Any]]] = {hosp_id: [] for hosp_id in hosp_ids}
+    if not hosp_ids:
+        return details
+    stmt = (
+        select(HospitalizationCharge, NurseTask.type, NurseTask.time, NurseTask.detail)
+        .join(NurseTask, HospitalizationCharge.task_id == NurseTask.task_id, isouter=True)
+        .where(HospitalizationCharge.hosp_id.in_(hosp_ids))
+        .order_by(NurseTask.time.asc(), HospitalizationCharge.task_id.asc(), HospitalizationCharge.charge_id.asc())
+    )
+    by_task: Dict[Tuple[int, Optional[int]], Dict[str, Any]] = {}
+    for line, task_type, task_time, task_detail in (await session.execute(stmt)).all():
+        entry = by_task.get((line.hosp_id, line.task_id))
+        if entry is None:
+            entry = by_task[(line.hosp_id, line.task_id)] = {
+                "task_id": line.task_id,
+                "type": task_type,
+                "time": task_time,
+                "detail": task_detail,
+                "medicine_fee": 0.0,
+                "service_fee": 0.0,
+                "total_fee": 0.0,
+                "medicines": [],
+            }
+            details[line.hosp_id].append(entry)
+        if line.kind == MEDICINE_CHARGE:
+            entry["medicine_fee"] = round(entry["medicine_fee"] + line.amount, 2)
+        else:
+            entry["service_fee"] = round(entry["service_fee"] + line.amount, 2)
+        entry["total_fee"] = round(entry["medicine_fee"] + entry["service_fee"], 2)
+        if line.items and not entry["medicines"]:
+            entry["medicines"] = _safe_load_snapshot(line.items)
+    return details
+
+
+async def compute_hospitalization_bill(
+    session: AsyncSession,
+    hospitalization: Hospitalization,
+    hourly_rate: float = DEFAULT_HOSPITAL_HOURLY_RATE,
+    reference_end: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    if not hospitalization.in_date:
+        return _empty_bill()
+    bills = await compute_hospitalization_bills(session, [hospitalization], hourly_rate, reference_end)
+    return bills[hospitalization.hosp_id]
+
+
+async def compute_hospitalization_bills(
+    session: AsyncSession,
+    hospitalizations: Iterable[Hospitalization],
+    hourly_rate: float = DEFAULT_HOSPITAL_HOURLY_RATE,
+    reference_end: Optional[datetime] = None,
+) -> Dict[int, Dict[str, Any]]:
+    """Bill several stays from their ledgers: running totals plus base hours, and the charge lines."""
+    hosps = [h for h in hospitalizations if h is not None]
+    ledgers = await ensure_ledgers(session, hosps)
+    details = await _load_charge_details(session, list(ledgers))
+    bills: Dict[int, Dict[str, Any]] = {}
+    for hosp in hosps:
+        ledger = ledgers.get(hosp.hosp_id)
+        if not hosp.in_date or ledger is None:
+            bills[hosp.hosp_id] = _empty_bill()
+            continue
+        base_hours, base_fee = _base_charge(hosp, hourly_rate, reference_end)
+        bills[hosp.hosp_id] = _bill(base_hours, base_fee, ledger.medicine_fee, ledger.service_fee, details[hosp.hosp_id])
+    return bills
@@ -2,12 +2,17 @@ from __future__ import annotations
 
 import asyncio
 import difflib
+import hashlib
+import json
+import math
 import os
+import time
 import re
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, Iterable, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 import httpx
 import xlrd
@@ -17,36 +22,271 @@ PRICE_SOURCE_URL = os.getenv(
     "https://ybj.beijing.gov.cn/2020_zwfw/2020_bmcx/202002/P020211231647015053723.xls",
 )
 CACHE_TTL_SECONDS = int(os.getenv("EXAM_PRICE_CACHE_TTL", "43200"))  # 12 hours
+LOOKUP_CACHE_SIZE = int(os.getenv("EXAM_PRICE_LOOKUP_CACHE_SIZE", "4096"))
+FUZZY_CUTOFF = 0.8
 CACHE_FILE = Path(
     os.getenv(
         "EXAM_PRICE_CACHE_PATH",
         Path(__file__).resolve().parent.parent / "data" / "exam_price_catalog.xls",
     )
 ).resolve()
+# 解析后的目录快照（紧凑 JSON），启动时直接加载，无需下载与解析 xls
+SNAPSHOT_FILE = Path(
+    os.getenv(
+        "EXAM_PRICE_SNAPSHOT_PATH",
+        Path(__file__).resolve().parent.parent / "data" / "exam_price_catalog.json",
+    )
+).resolve()
+# 熔断：连续失败达到阈值后，冷却期内不再访问价格表来源
+BREAKER_THRESHOLD = int(os.getenv("EXAM_PRICE_BREAKER_THRESHOLD", "3"))
+BREAKER_COOLDOWN_SECONDS = int(os.getenv("EXAM_PRICE_BREAKER_COOLDOWN_SECONDS", "600"))
+SNAPSHOT_FORMAT = 1
 
 
 @dataclass
 class PriceLookupResult:
     price: float
     matched_name: str
+    catalog_version: str = ""
+
+
+def normalize_exam_name(name: str) -> str:
+    text = (name or "").strip().lower()
+    if not text:
+        return ""
+    return re.sub(r"[\s·•、,，.。/\\-]", "", text)
+
+
+class CatalogIndex:
+    """Inverted indexes over normalized catalog keys.
+
+    Gives the same answer as a linear scan (exact, then the longest
+    containment match in catalog order, then ``difflib.get_close_matches``
+    with cutoff 0.8) while only touching candidate keys:
+
+    * containment "key in query": every substring of the query is probed in
+      the key map (queries are short);
+    * containment "query in key": intersection of the query's bigram postings;
+    * fuzzy: character postings select candidates, and each candidate's
+      shared-character count gives difflib's ``quick_ratio``. It is an upper bound of ``ratio`` and prunes
+      everything that cannot reach the cutoff before any SequenceMatcher runs.
+    """
+
+    def __init__(self, keys: Iterable[str]):
+        self.keys: List[str] = list(keys)
+        self.position: Dict[str, int] = {key: idx for idx, key in enumerate(self.keys)}
+        # 字符多重集合表示为 {(字符, 第几次出现)}，如含两个"血"的键记为
+        # ("血", 1)、("血", 2)；每个二元组编号为整数，集合交集大小即共享字符数
+        self.token_ids: Dict[Tuple[str, int], int] = {}
+        # token id -> key length -> key idxs. Grouped by length so the fuzzy
+        # pass only walks keys whose length can still reach the cutoff
+        self.char_postings: Dict[int, Dict[int, Set[int]]] = {}
+        self.bigram_postings: Dict[str, Set[int]] = {}
+        self.key_tokens: List[frozenset] = []
+        for idx, key in enumerate(self.keys):
+            tokens = self._tokens(key, register=True)
+            self.key_tokens.append(tokens)
+            for token in tokens:
+                self.char_postings.setdefault(token, {}).setdefault(len(key), set()).add(idx)
+            for i in range(len(key) - 1):
+                self.bigram_postings.setdefault(key[i:i + 2], set()).add(idx)
+
+    def _tokens(self, text: str, register: bool = False) -> frozenset:
+        seen: Dict[str, int] = {}
+        tokens = []
+        for ch in text:
+            seen[ch] = seen.get(ch, 0) + 1
+            token = self.token_ids.get((ch, seen[ch]))
+            if token is None:
+                if not register:
+                    continue
+                token = self.token_ids[(ch, seen[ch])] = len(self.token_ids)
+            tokens.append(token)
+        return frozenset(tokens)
+
+    def containment(self, query: str) -> Optional[str]:
+        best_idx: Optional[int] = None
+        best_len = 0
+
+        def consider(idx: int) -> None:
+            nonlocal best_idx, best_len
+            length = len(self.keys[idx])
+            # 与线性扫描一致：取最长者，等长时取目录中靠前的
+            if length > best_len or (length == best_len and best_idx is not None and idx < best_idx):
+                best_idx, best_len = idx, length
+
+        n = len(query)
+        for start in range(n):
+            for end in range(start + 1, n + 1):
+                idx = self.position.get(query[start:end])
+                if idx is not None:
+                    consider(idx)
+
+        if n == 1:
+            candidates: Iterable[int] = [idx for postings in self.char_postings.get(self.token_ids.get((query, 1), -1), {}).values() for idx in postings]
+        else:
+            bigrams = sorted({query[i:i + 2] for i in range(n - 1)}, key=lambda g: len(self.bigram_postings.get(g, ())))
+            candidates = set(self.bigram_postings.get(bigrams[0], ()))
+            for gram in bigrams[1:]:
+                if not candidates:
+                    break
+                candidates &= self.bigram_postings.get(gram, set())
+        for idx in candidates:
+            if len(self.keys[idx]) >= best_len and query in self.keys[idx]:
+                consider(idx)
+        return self.keys[best_idx] if best_idx is not None else None
+
+    def fuzzy(self, query: str, cutoff: float = FUZZY_CUTOFF) -> Optional[str]:
+        qlen = len(query)
+        # ratio <= 2*min(lq, lk)/(lq + lk)，长度差过大的键不可能达到阈值
+        min_len = qlen * cutoff / (2 - cutoff)
+        max_len = qlen * (2 - cutoff) / cutoff
+        query_tokens = self._tokens(query)
+
+        # 前缀过滤（按键长分桶）：长度为 lk 的键要达到阈值至少共享
+        # need = ceil(cutoff*(qlen+lk)/2) 个字符，因此必然包含该桶内最稀有的
+        # (qlen - need + 1) 个查询字符之一，只需遍历这些字符的倒排表
+        buckets: Dict[int, List[Set[int]]] = {}
+        for token in query_tokens:
+            for length, postings in self.char_postings.get(token, {}).items():
+                if min_len <= length <= max_len:
+                    buckets.setdefault(length, []).append(postings)
+        candidates: Set[int] = set()
+        for length, postings_list in buckets.items():
+            budget = qlen - math.ceil(cutoff * (qlen + length) / 2 - 1e-9) + 1
+            if budget <= 0:
+                continue
+            # 查询中未出现在该桶的字符倒排表为空，同样计入 budget
+            missing = qlen - len(postings_list)
+            if missing >= budget:
+                continue
+            postings_list.sort(key=len)
+            for postings in postings_list[:budget - missing]:
+                candidates.update(postings)
+
+        # quick_ratio 是 ratio 的上界：按上界从高到低计算，上界低于当前最优即可停止
+        bounds = []
+        for idx in candidates:
+            common = len(query_tokens & self.key_tokens[idx])
+            bound = 2.0 * common / (qlen + len(self.keys[idx]))
+            if bound >= cutoff:
+                bounds.append((bound, idx))
+        bounds.sort(reverse=True)
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(query)
+        best: Optional[Tuple[float, str]] = None
+        for bound, idx in bounds:
+            if best is not None and bound < best[0]:
+                break
+            key = self.keys[idx]
+            matcher.set_seq1(key)
+            score = matcher.ratio()
+            # difflib.get_close_matches 取 (score, key) 最大者
+            if score >= cutoff and (best is None or (score, key) > best):
+                best = (score, key)
+        return best[1] if best else None
+
+
+class CatalogSnapshot:
+    """One parsed and indexed catalog version.
+
+    Never mutated after construction except for ``fetched_at`` and its own
+    lookup cache; a refresh builds a new snapshot and swaps the reference, so
+    readers always see a complete catalog without taking a lock.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[str, float]], version: str = "", fetched_at: Optional[datetime] = None):
+        self.price_map: Dict[str, float] = {}
+        self.raw_names: Dict[str, str] = {}
+        for raw_name, price in entries:
+            key = normalize_exam_name(raw_name)
+            if not key:
+                continue
+            self.price_map[key] = round(float(price), 2)
+            self.raw_names[key] = raw_name
+        self.version = version
+        self.fetched_at = fetched_at
+        self.index = CatalogIndex(self.price_map.keys())
+        self.lookup_cache: "OrderedDict[str, Optional[PriceLookupResult]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.price_map)
+
+    def match(self, normalized: str) -> Optional[PriceLookupResult]:
+        key: Optional[str] = normalized if normalized in self.price_map else None
+        if key is None:
+            key = self.index.containment(normalized)
+        if key is None:
+            key = self.index.fuzzy(normalized)
+        if key is None:
+            return None
+        return PriceLookupResult(price=self.price_map[key], matched_name=self.raw_names.get(key, key), catalog_version=self.version)
+
+    def lookup(self, normalized: str) -> Optional[PriceLookupResult]:
+        cache = self.lookup_cache
+        if normalized in cache:
+            cache.move_to_end(normalized)
+            return cache[normalized]
+        result = self.match(normalized)
+        cache[normalized] = result
+        if len(cache) > LOOKUP_CACHE_SIZE:
+            cache.popitem(last=False)
+        return result
+
+    def to_json(self) -> bytes:
+        payload = {
+            "format": SNAPSHOT_FORMAT,
+            "version": self.version,
+            "fetched_at": self.fetched_at.isoformat() if self.fetched_at else None,
+            "entries": [[self.raw_names[key], price] for key, price in self.price_map.items()],
+        }
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @classmethod
+    def from_json(cls, data: bytes) -> "CatalogSnapshot":
+        payload = json.loads(data)
+        if payload.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"unsupported snapshot format: {payload.get('format')}")
+        fetched_at = payload.get("fetched_at")
+        return cls(
+            ((name, price) for name, price in payload.get("entries", [])),
+            version=payload.get("version", ""),
+            fetched_at=datetime.fromisoformat(fetched_at) if fetched_at else None,
+        )
 
 
 class ExamPriceCatalog:
+    """Exam price catalog with stale-while-revalidate refresh.
+
+    Lookups read the current ``CatalogSnapshot`` without locking. When it is
+    older than the TTL, a single background task downloads the price sheet,
+    parses it in a worker thread, persists the snapshot and swaps it in;
+    meanwhile lookups keep answering from the stale one. Repeated download
+    failures open a circuit breaker so an unreachable source is not retried
+    on every lookup.
+    """
+
     def __init__(self, source_url: str = PRICE_SOURCE_URL):
         self.source_url = source_url
         self.cache_ttl = CACHE_TTL_SECONDS
         self.cache_file = CACHE_FILE
-        self._price_map: Dict[str, float] = {}
-        self._raw_names: Dict[str, str] = {}
-        self._loaded_at: Optional[datetime] = None
-        self._lock = asyncio.Lock()
+        self.snapshot_file = SNAPSHOT_FILE
+        self._snapshot = CatalogSnapshot(())
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._failures = 0
+        self._breaker_open_until: Optional[datetime] = None
+        self._last_error: Optional[str] = None
+        self.snapshot_load_seconds: Optional[float] = None
 
-    @staticmethod
-    def _normalize(name: str) -> str:
-        text = (name or "").strip().lower()
-        if not text:
-            return ""
-        return re.sub(r"[\s·•、,，.。/\\-]", "", text)
+    _normalize = staticmethod(normalize_exam_name)
+
+    @property
+    def snapshot(self) -> CatalogSnapshot:
+        return self._snapshot
 
     @staticmethod
     def _parse_price(value) -> Optional[float]:
@@ -69,7 +309,7 @@ class ExamPriceCatalog:
                     return idx
         return None
 
-    def _parse_catalog(self, data: bytes) -> Dict[str, float]:
+    def _parse_catalog(self, data: bytes) -> List[Tuple[str, float]]:
         workbook = xlrd.open_workbook(file_contents=data)
         sheet = workbook.sheet_by_index(0)
         headers = [str(sheet.cell_value(0, c)).strip() for c in range(sheet.ncols)]
@@ -78,8 +318,7 @@ class ExamPriceCatalog:
         if name_col is None or price_col is None:
             raise ValueError("无法在价格表中找到项目名称或价格列")
 
-        mapping: Dict[str, float] = {}
-        raw_names: Dict[str, str] = {}
+        entries: List[Tuple[str, float]] = []
         for row in range(1, sheet.nrows):
             raw_name = str(sheet.cell_value(row, name_col)).strip()
             if not raw_name:
@@ -87,14 +326,36 @@ class ExamPriceCatalog:
             price_val = self._parse_price(sheet.cell_value(row, price_col))
             if price_val is None:
                 continue
-            key = self._normalize(raw_name)
-            if not key:
-                continue
-            mapping[key] = round(float(price_val), 2)
-            raw_names[key] = raw_name
-        self._price_map = mapping
-        self._raw_names = raw_names
-        return mapping
+            entries.append((raw_name, price_val))
+        return entries
+
+    @staticmethod
+    def _version_of(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()[:16]
+
+    def _build_snapshot(self, data: bytes, fetched_at: datetime) -> CatalogSnapshot:
+        return CatalogSnapshot(self._parse_catalog(data), version=self._version_of(data), fetched_at=fetched_at)
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _read_snapshot(self) -> Optional[CatalogSnapshot]:
+        """Runs in a worker thread. Falls back to the cached xls when no snapshot exists yet."""
+        if self.snapshot_file.exists():
+            try:
+                return CatalogSnapshot.from_json(self.snapshot_file.read_bytes())
+            except Exception as exc:  # noqa: W0703
+                print(f"WARN: exam price snapshot unreadable, ignoring: {exc}")
+        if self.cache_file.exists():
+            data = self.cache_file.read_bytes()
+            snapshot = self._build_snapshot(data, datetime.utcfromtimestamp(self.cache_file.stat().st_mtime))
+            self._write_atomic(self.snapshot_file, snapshot.to_json())
+            return snapshot
+        return None
 
     async def _download_latest(self) -> bytes:
         headers = {
@@ -106,68 +367,146 @@ class ExamPriceCatalog:
             resp.raise_for_status()
             return resp.content
 
-    async def _ensure_catalog(self, force_refresh: bool = False) -> Dict[str, float]:
-        async with self._lock:
-            now = datetime.utcnow()
-            if (
-                not force_refresh
-                and self._price_map
-                and self._loaded_at
-                and now - self._loaded_at < timedelta(seconds=self.cache_ttl)
-            ):
-                return self._price_map
-
-            data: Optional[bytes] = None
-            last_error = None
+    async def load_snapshot(self) -> CatalogSnapshot:
+        """Load the persisted snapshot once per process (the only place lookups may wait)."""
+        if self._loaded:
+            return self._snapshot
+        async with self._load_lock:
+            if self._loaded:
+                return self._snapshot
+            started = time.perf_counter()
             try:
-                data = await self._download_latest()
-                self.cache_file.parent.mkdir(parents=True, exist_ok=True)
-                self.cache_file.write_bytes(data)
+                snapshot = await asyncio.to_thread(self._read_snapshot)
             except Exception as exc:  # noqa: W0703
-                last_error = exc
-                if self.cache_file.exists():
-                    data = self.cache_file.read_bytes()
-            if data is None:
-                # Network/cache both failed; keep app running with empty catalog and let caller use fallback price
-                self._price_map = {}
-                self._raw_names = {}
-                self._loaded_at = now
-                print(f"WARN: exam price catalog unavailable: {last_error}")
-                return self._price_map
-
-            self._parse_catalog(data)
-            self._loaded_at = now
-            return self._price_map
+                snapshot = None
+                print(f"WARN: failed to load exam price snapshot: {exc}")
+            self.snapshot_load_seconds = time.perf_counter() - started
+            if snapshot is not None:
+                self._snapshot = snapshot
+                print(f"INFO: exam price catalog loaded ({len(snapshot)} entries, version {snapshot.version}) in {self.snapshot_load_seconds * 1000:.0f}ms")
+            self._loaded = True
+            return self._snapshot
+
+    def is_stale(self, now: Optional[datetime] = None) -> bool:
+        fetched_at = self._snapshot.fetched_at
+        if fetched_at is None or not len(self._snapshot):
+            return True
+        return (now or datetime.utcnow()) - fetched_at >= timedelta(seconds=self.cache_ttl)
+
+    def breaker_open(self, now: Optional[datetime] = None) -> bool:
+        return self._breaker_open_until is not None and (now or datetime.utcnow()) < self._breaker_open_until
+
+    def schedule_refresh(self) -> Optional[asyncio.Task]:
+        """Start a background refresh unless one is running or the breaker is open."""
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return self._refresh_task
+        if self.breaker_open():
+            return None
+        self._refresh_task = asyncio.create_task(self.refresh())
+        return self._refresh_task
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Download, parse off the event loop and swap in a new snapshot. Returns True on success."""
+        now = datetime.utcnow()
+        if not force and self.breaker_open(now):
+            return False
+        try:
+            data = await self._download_latest()
+        except Exception as exc:  # noqa: W0703
+            self._failures += 1
+            self._last_error = str(exc) or exc.__class__.__name__
+            if self._failures >= BREAKER_THRESHOLD:
+                self._breaker_open_until = now + timedelta(seconds=BREAKER_COOLDOWN_SECONDS)
+                print(f"WARN: exam price source unreachable ({self._failures} failures), retry after {BREAKER_COOLDOWN_SECONDS}s: {self._last_error}")
+            else:
+                print(f"WARN: exam price catalog refresh failed: {self._last_error}")
+            return False
+
+        self._failures = 0
+        self._breaker_open_until = None
+        self._last_error = None
+        current = self._snapshot
+        if current.version == self._version_of(data) and len(current):
+            # 内容未变：只更新时间戳，不重新解析
+            current.fetched_at = now
+            await asyncio.to_thread(self._write_atomic, self.snapshot_file, current.to_json())
+            return True
+        try:
+            snapshot = await asyncio.to_thread(self._build_snapshot, data, now)
+        except Exception as exc:  # noqa: W0703
+            self._last_error = f"parse failed: {exc}"
+            print(f"WARN: exam price catalog parse failed, keeping version {current.version or '-'}: {exc}")
+            return False
+        await asyncio.to_thread(self._write_atomic, self.cache_file, data)
+        await asyncio.to_thread(self._write_atomic, self.snapshot_file, snapshot.to_json())
+        self._snapshot = snapshot
+        print(f"INFO: exam price catalog refreshed ({len(snapshot)} entries, version {snapshot.version})")
+        return True
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._warm_up())
+
+    async def stop(self) -> None:
+        for task in (self._task, self._refresh_task):
+            if task is None or task.done():
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._refresh_task = None
+
+    async def _warm_up(self) -> None:
+        await self.load_snapshot()
+        if self.is_stale():
+            self.schedule_refresh()
+
+    def stats(self) -> Dict[str, object]:
+        snapshot = self._snapshot
+        now = datetime.utcnow()
+        return {
+            "version": snapshot.version or None,
+            "entries": len(snapshot),
+            "fetched_at": snapshot.fetched_at.isoformat() if snapshot.fetched_at else None,
+            "age_seconds": round((now - snapshot.fetched_at).total_seconds(), 1) if snapshot.fetched_at else None,
+            "stale": self.is_stale(now),
+            "snapshot_load_ms": round(self.snapshot_load_seconds * 1000, 1) if self.snapshot_load_seconds is not None else None,
+            "refreshing": self._refresh_task is not None and not self._refresh_task.done(),
+            "consecutive_failures": self._failures,
+            "breaker_open_until": self._breaker_open_until.isoformat() if self.breaker_open(now) else None,
+            "last_error": self._last_error,
+        }
+
+    async def _current(self, force_refresh: bool = False) -> CatalogSnapshot:
+        if not self._loaded:
+            await self.load_snapshot()
+        if force_refresh:
+            await self.refresh(force=True)
+        elif self.is_stale():
+            # 过期也先用旧目录作答，刷新在后台进行
+            self.schedule_refresh()
+        return self._snapshot
 
     async def lookup_price(self, exam_name: str, force_refresh: bool = False) -> Optional[PriceLookupResult]:
-        await self._ensure_catalog(force_refresh=force_refresh)
+        snapshot = await self._current(force_refresh)
         normalized = self._normalize(exam_name)
         if not normalized:
             return None
+        return snapshot.lookup(normalized)
 
-        direct = self._price_map.get(normalized)
-        if direct is not None:
-            return PriceLookupResult(price=direct, matched_name=self._raw_names.get(normalized, exam_name))
-
-        # substring / containment
-        candidate_key = None
-        candidate_price = None
-        longest = 0
-        for key, price in self._price_map.items():
-            if key in normalized or normalized in key:
-                if len(key) > longest:
-                    longest = len(key)
-                    candidate_key = key
-                    candidate_price = price
-        if candidate_price is not None and candidate_key:
-            return PriceLookupResult(price=candidate_price, matched_name=self._raw_names.get(candidate_key, candidate_key))
-
-        # fuzzy fallback
-        closest = difflib.get_close_matches(normalized, list(self._price_map.keys()), n=1, cutoff=0.8)
-        if closest:
-            key = closest[0]
-            return PriceLookupResult(price=self._price_map[key], matched_name=self._raw_names.get(key, key))
-        return None
+    async def lookup_many(self, exam_names: Iterable[str]) -> Dict[str, Optional[PriceLookupResult]]:
+        """Resolve many names against one catalog version; each distinct normalized name is matched once."""
+        snapshot = await self._current()
+        results: Dict[str, Optional[PriceLookupResult]] = {}
+        for name in exam_names:
+            if name in results:
+                continue
+            normalized = self._normalize(name)
+            results[name] = snapshot.lookup(normalized) if normalized else None
+        return results
 
 
 exam_price_catalog = ExamPriceCatalog()
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import exists, or_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+
+from app.core.time_utils import now_bj, today_bj
+from app.models.hospital import NurseTask, Payment, PaymentType, Registration, RegStatus
+
+# 日界之后多等几秒再清扫，避免与跨日写入挤在同一时刻
+SWEEP_DAY_OFFSET_SECONDS = 5
+# 兜底间隔：即使错过日界（进程重启、时钟漂移），最迟这么久也会再清扫一次
+SWEEP_FALLBACK_SECONDS = int(os.getenv("REG_EXPIRY_SWEEP_INTERVAL_SECONDS", "3600"))
+# 护理任务过期清扫间隔；读取时已按时间推导“已过期”，落库只影响统计与历史查询
+NURSE_TASK_SWEEP_SECONDS = int(os.getenv("NURSE_TASK_EXPIRY_SWEEP_SECONDS", "300"))
+# 旧数据（payment.reg_id 为空）按挂号时间前后窗口匹配挂号费
+LEGACY_PAYMENT_WINDOW = timedelta(hours=2)
+
+
+def _registration_fee_filter():
+    return or_(
+        Payment.type == PaymentType.REGISTRATION,
+        Payment.type == "挂号费",
+        Payment.type == "REGISTRATION",
+    )
+
+
+async def expire_overdue_registrations(session: AsyncSession, today: Optional[date] = None) -> Dict[str, int]:
+    """Expire every WAITING registration whose visit date has passed, hospital-wide.
+
+    Unpaid registration-fee payments of those registrations are cancelled; paid
+    ones stay 已缴费 (no refund). Payments are updated first and registrations
+    last, all in one transaction, so a concurrent sweep sees either nothing or
+    everything. Returns the affected row counts.
+    """
+    today = today or today_bj()
+    overdue = (
+        select(Registration.reg_id)
+        .where(Registration.status == RegStatus.WAITING)
+        .where(Registration.visit_date < today)
+    )
+
+    pay_result = await session.execute(
+        update(Payment)
+        .where(_registration_fee_filter())
+        .where(Payment.reg_id.in_(overdue.scalar_subquery()))
+        .where(Payment.status != "已缴费")
+        .values(status="已取消")
+        .execution_options(synchronize_session=False)
+    )
+    cancelled = pay_result.rowcount or 0
+
+    # Backward compatibility: older payment rows may not have reg_id filled.
+    legacy_regs = (await session.execute(
+        select(Registration.reg_id, Registration.patient_id, Registration.reg_date)
+        .where(Registration.status == RegStatus.WAITING)
+        .where(Registration.visit_date < today)
+        .where(~exists().where(Payment.reg_id == Registration.reg_id))
+    )).all()
+    if legacy_regs:
+        patient_ids = {row.patient_id for row in legacy_regs}
+        candidates = (await session.execute(
+            select(Payment.payment_id, Payment.patient_id, Payment.time, Payment.status)
+            .where(Payment.patient_id.in_(patient_ids))
+            .where(_registration_fee_filter())
+            .where(Payment.reg_id.is_(None))
+            .where(Payment.pres_id.is_(None))
+            .where(Payment.exam_id.is_(None))
+            .where(Payment.hosp_id.is_(None))
+            .order_by(Payment.time.desc(), Payment.payment_id.desc())
+        )).all()
+        to_cancel = set()
+        for reg in legacy_regs:
+            window_start = reg.reg_date - LEGACY_PAYMENT_WINDOW
+            window_end = reg.reg_date + LEGACY_PAYMENT_WINDOW
+            match = next(
+                (
+                    pay for pay in candidates
+                    if pay.patient_id == reg.patient_id and window_start <= pay.time <= window_end
+                ),
+                None,
+            )
+            if match and match.status != "已缴费":
+                to_cancel.add(match.payment_id)
+        if to_cancel:
+            legacy_result = await session.execute(
+                update(Payment)
+                .where(Payment.payment_id.in_(to_cancel))
+                .values(status="已取消")
+                .execution_options(synchronize_session=False)
+            )
+            cancelled += legacy_result.rowcount or 0
+
+    reg_result = await session.execute(
+        update(Registration)
+        .where(Registration.status == RegStatus.WAITING)
+        .where(Registration.visit_date < today)
+        .values(status=RegStatus.EXPIRED)
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return {"registrations": reg_result.rowcount or 0, "payments": cancelled}
+
+
+def _seconds_until_next_sweep(now: datetime) -> float:
+    next_day = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    until_boundary = (next_day - now).total_seconds() + SWEEP_DAY_OFFSET_SECONDS
+    return max(min(until_boundary, SWEEP_FALLBACK_SECONDS), 1.0)
+
+
+class RegistrationExpirySweeper:
+    """Runs ``expire_overdue_registrations`` at startup and after each day boundary (Beijing time).
+
+    Every worker runs one; the UPDATEs are conditional on status, so concurrent
+    sweeps are harmless.
+    """
+
+    def __init__(self, session_factory=None):
+        self._session_factory = session_factory
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, session_factory=None) -> None:
+        if session_factory is not None:
+            self._session_factory = session_factory
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def sweep_once(self) -> Dict[str, int]:
+        async with self._session_factory() as session:
+            return await expire_overdue_registrations(session)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                counts = await self.sweep_once()
+                if counts["registrations"]:
+                    print(f"INFO: expired {counts['registrations']} registrations, cancelled {counts['payments']} payments")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # noqa: W0703
+                print(f"WARN: registration expiry sweep failed: {exc}")
+            await asyncio.sleep(_seconds_until_next_sweep(now_bj()))
+
+
+async def expire_overdue_nurse_tasks(session: AsyncSession, now: Optional[datetime] = None) -> int:
+    """Mark every 未完成 task whose time has passed as 已过期 with one UPDATE.
+
+    Served by ``ix_nursetask_status_time``; the nurse endpoints derive the
+    same status at read time, so this only needs to run periodically.
+    """
+    now = now or datetime.now()
+    result = await session.execute(
+        update(NurseTask)
+        .where(NurseTask.status == "未完成")
+        .where(NurseTask.time < now)
+        .values(status="已过期")
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return result.rowcount or 0
+
+
+class NurseTaskExpirySweeper:
+    """Runs ``expire_overdue_nurse_tasks`` at startup and every ``NURSE_TASK_SWEEP_SECONDS``."""
+
+    def __init__(self, session_factory=None, interval: float = NURSE_TASK_SWEEP_SECONDS):
+        self._session_factory = session_factory
+        self._interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, session_factory=None) -> None:
+        if session_factory is not None:
+            self._session_factory = session_factory
+        if self._task is None and self._interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def sweep_once(self) -> int:
+        async with self._session_factory() as session:
+            return await expire_overdue_nurse_tasks(session)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                expired = await self.sweep_once()
+                if expired:
+                    print(f"INFO: expired {expired} overdue nurse tasks")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # noqa: W0703
+                print(f"WARN: nurse task expiry sweep failed: {exc}")
+            await asyncio.sleep(self._interval)
+
+
+registration_expiry_sweeper = RegistrationExpirySweeper()
+nurse_task_expiry_sweeper = NurseTaskExpirySweeper()
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple, Union
+
+from sqlalchemy import and_, case, delete, func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from sqlmodel import select
+
+from app.models.hospital import MedicineUsageDaily, Prescription, PrescriptionDetail
+
+Executor = Union[AsyncSession, AsyncConnection]
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def _as_date(value) -> date:
+    # SQLite 的 date() 返回字符串，MySQL 返回 date
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _upsert(dialect_name: str):
+    # 同一药品同一天的用量累加；并发开方时由数据库在行内相加，不需要先读后写
+    table = MedicineUsageDaily.__table__
+    if dialect_name == "mysql":
+        stmt = mysql_insert(table)
+        return stmt.on_duplicate_key_update(quantity=table.c.quantity + stmt.inserted.quantity)
+    stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.medicine_id, table.c.usage_date],
+        set_={"quantity": table.c.quantity + stmt.excluded.quantity},
+    )
+
+
+async def record_usage(executor: Executor, usage_date: date, deltas: Dict[int, int]) -> None:
+    """Add per-medicine quantity deltas (may be negative) to one day of the rollup.
+
+    Runs in the caller's transaction, so the rollup commits or rolls back
+    together with the prescription that caused it.
+    """
+    rows = [
+        {"medicine_id": medicine_id, "usage_date": usage_date, "quantity": int(delta)}
+        for medicine_id, delta in sorted(deltas.items())
+        if delta
+    ]
+    if not rows:
+        return
+    if isinstance(executor, AsyncSession):
+        # 使用会话当前事务的连接，与处方一同提交或回滚
+        conn = await executor.connection()
+    else:
+        conn = executor
+    await conn.execute(_upsert(conn.dialect.name), rows)
+
+
+def usage_deltas(old: Dict[int, int], new: Dict[int, int]) -> Dict[int, int]:
+    deltas: Dict[int, int] = {}
+    for medicine_id in set(old) | set(new):
+        delta = new.get(medicine_id, 0) - old.get(medicine_id, 0)
+        if delta:
+            deltas[medicine_id] = delta
+    return deltas
+
+
+async def load_history_usage(executor: Executor, since: Optional[date] = None) -> Dict[Tuple[int, date], int]:
+    """Per (medicine, day) quantities aggregated straight from prescription details."""
+    usage_date = func.date(Prescription.create_time).label("usage_date")
+    stmt = (
+        select(PrescriptionDetail.medicine_id, usage_date, func.sum(PrescriptionDetail.quantity).label("qty"))
+        .join(Prescription, PrescriptionDetail.pres_id == Prescription.pres_id)
+        .group_by(PrescriptionDetail.medicine_id, usage_date)
+    )
+    if since is not None:
+        stmt = stmt.where(Prescription.create_time >= datetime.combine(since, datetime.min.time()))
+    return {
+        (medicine_id, _as_date(day)): int(qty)
+        for medicine_id, day, qty in (await executor.execute(stmt)).all()
+        if qty
+    }
+
+
+async def load_rollup(executor: Executor, since: Optional[date] = None) -> Dict[Tuple[int, date], int]:
+    stmt = select(MedicineUsageDaily.medicine_id, MedicineUsageDaily.usage_date, MedicineUsageDaily.quantity)
+    if since is not None:
+        stmt = stmt.where(MedicineUsageDaily.usage_date >= since)
+    return {(medicine_id, _as_date(day)): int(qty) for medicine_id, day, qty in (await executor.execute(stmt)).all()}
+
+
+async def rebuild_usage_rollup(executor: Executor, since: Optional[date] = None) -> int:
+    """Recompute the rollup from prescription history (from ``since`` on, or all of it)."""
+    table = MedicineUsageDaily.__table__
+    clear = delete(table)
+    if since is not None:
+        clear = clear.where(table.c.usage_date >= since)
+    await executor.execute(clear)
+
+    rows = [
+        {"medicine_id": medicine_id, "usage_date": day, "quantity": qty}
+        for (medicine_id, day), qty in sorted((await load_history_usage(executor, since)).items())
+    ]
+    for start in range(0, len(rows), REBUILD_BATCH_SIZE):
+        await executor.execute(table.insert(), rows[start:start + REBUILD_BATCH_SIZE])
+    return len(rows)
+
+
+async def load_daily_usage(executor: Executor, start: date) -> List[Tuple[int, date, int]]:
+    stmt = (
+        select(MedicineUsageDaily.medicine_id, MedicineUsageDaily.usage_date, MedicineUsageDaily.quantity)
+        .where(MedicineUsageDaily.usage_date >= start)
+        .where(MedicineUsageDaily.quantity != 0)
+    )
+    return [(medicine_id, _as_date(day), int(qty)) for medicine_id, day, qty in (await executor.execute(stmt)).all()]
+
+
+async def load_monthly_usage(executor: Executor, month_starts: List[date], end: date) -> Dict[int, List[int]]:
+    """Per-medicine totals for each ``[month_starts[i], month_starts[i + 1])`` range, the last one ending at ``end``."""
+    bounds = list(zip(month_starts, month_starts[1:] + [end]))
+    columns = [
+        func.sum(case(
+            (and_(MedicineUsageDaily.usage_date >= lower, MedicineUsageDaily.usage_date < upper), MedicineUsageDaily.quantity),
+            else_=0,
+        ))
+        for lower, upper in bounds
+    ]
+    stmt = (
+        select(MedicineUsageDaily.medicine_id, *columns)
+        .where(MedicineUsageDaily.usage_date >= month_starts[0])
+        .where(MedicineUsageDaily.usage_date < end)
+        .group_by(MedicineUsageDaily.medicine_id)
+    )
+    return {row[0]: [int(value or 0) for value in row[1:]] for row in (await executor.execute(stmt)).all()}
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import os
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+
+from app.models.hospital import Nurse, NurseSchedule
+
+# 单个班次的最长时长；按时间窗加载排班时以此向前回看，保证能取到跨入窗口的班次
+MAX_SHIFT_HOURS = int(os.getenv("NURSE_SHIFT_MAX_HOURS", "24"))
+MAX_SHIFT = timedelta(hours=MAX_SHIFT_HOURS)
+
+
+class _WardShifts:
+    """One ward's shifts sorted by (start, end, nurse_id).
+
+    ``max_end[i]`` is the latest end among the first ``i + 1`` shifts, so it is
+    non-decreasing and the first shift still running at ``t`` is found with
+    two bisects instead of a scan.
+    """
+
+    __slots__ = ("starts", "max_end", "nurses")
+
+    def __init__(self, entries: List[Tuple[datetime, datetime, int, Nurse]]):
+        entries.sort(key=lambda entry: entry[:3])
+        self.starts = [entry[0] for entry in entries]
+        self.nurses = [entry[3] for entry in entries]
+        self.max_end: List[datetime] = []
+        latest: Optional[datetime] = None
+        for entry in entries:
+            latest = entry[1] if latest is None or entry[1] > latest else latest
+            self.max_end.append(latest)
+
+    def on_duty(self, at: datetime) -> Optional[Nurse]:
+        started = bisect_right(self.starts, at)
+        first_running = bisect_left(self.max_end, at, 0, started)
+        return self.nurses[first_running] if first_running < started else None
+
+
+class DutyIndex:
+    """Per-ward interval index answering "who is on duty in ward W at time t".
+
+    Matches the previous linear scan: among shifts with start <= t <= end, the
+    one that sorts first by (start, end, nurse_id) wins.
+    """
+
+    def __init__(self, rows: Iterable[Tuple[NurseSchedule, Nurse]]):
+        buckets: Dict[int, List[Tuple[datetime, datetime, int, Nurse]]] = {}
+        for schedule, nurse in rows:
+            buckets.setdefault(schedule.ward_id, []).append((schedule.start_time, schedule.end_time, schedule.nurse_id, nurse))
+        self._wards = {ward_id: _WardShifts(entries) for ward_id, entries in buckets.items()}
+
+    def on_duty(self, ward_id: Optional[int], at: datetime) -> Optional[Nurse]:
+        if ward_id is None:
+            return None
+        shifts = self._wards.get(ward_id)
+        return shifts.on_duty(at) if shifts else None
+
+    def __len__(self) -> int:
+        return sum(len(shifts.starts) for shifts in self._wards.values())
+
+
+async def load_duty_index(
+    session: AsyncSession,
+    ward_ids: Sequence[int],
+    window_start: datetime,
+    window_end: datetime,
+) -> DutyIndex:
+    """Build the index from the shifts of ``ward_ids`` that overlap [window_start, window_end]."""
+    if not ward_ids:
+        return DutyIndex([])
+    stmt = (
+        select(NurseSchedule, Nurse)
+        .join(Nurse, NurseSchedule.nurse_id == Nurse.nurse_id)
+        .where(NurseSchedule.ward_id.in_(list(ward_ids)))
+        # start_time 上下界都落在 (ward_id, start_time) 索引范围内，不再读取全部历史排班
+        .where(NurseSchedule.start_time >= window_start - MAX_SHIFT)
+        .where(NurseSchedule.start_time <= window_end)
+        .where(NurseSchedule.end_time >= window_start)
+    )
+    return DutyIndex((await session.execute(stmt)).all())
+
+
+async def find_overlapping_shifts(
+    session: AsyncSession,
+    nurse_ids: Sequence[int],
+    start: datetime,
+    end: datetime,
+) -> List[Tuple[NurseSchedule, Nurse]]:
+    """Existing shifts of ``nurse_ids`` that overlap [start, end); back-to-back shifts do not count."""
+    if not nurse_ids:
+        return []
+    stmt = (
+        select(NurseSchedule, Nurse)
+        .join(Nurse, NurseSchedule.nurse_id == Nurse.nurse_id)
+        .where(NurseSchedule.nurse_id.in_(list(nurse_ids)))
+        .where(NurseSchedule.start_time >= start - MAX_SHIFT)
+        .where(NurseSchedule.start_time < end)
+        .where(NurseSchedule.end_time > start)
+        .order_by(NurseSchedule.nurse_id, NurseSchedule.start_time)
+    )
+    return list((await session.execute(stmt)).all())
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import math
+import os
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+
+from app.models.hospital import Hospitalization, Nurse, NurseSchedule, NurseTask, Ward
+from app.services.nurse_duty import MAX_SHIFT
+
+# 自动排班规则：两个班次之间的最短休息、每周（自排班开始时间起每 7 天）最多班次数，
+# 以及一名护士每班可照看的在院患者数 / 可完成的护理任务数（用于按负荷决定每班人数）
+MIN_REST_HOURS = int(os.getenv("NURSE_ROSTER_MIN_REST_HOURS", "11"))
+MAX_SHIFTS_PER_WEEK = int(os.getenv("NURSE_ROSTER_MAX_SHIFTS_PER_WEEK", "5"))
+PATIENTS_PER_NURSE = float(os.getenv("NURSE_ROSTER_PATIENTS_PER_NURSE", "8"))
+TASKS_PER_NURSE = float(os.getenv("NURSE_ROSTER_TASKS_PER_NURSE", "20"))
+INSERT_BATCH_SIZE = 1000
+
+WEEK = timedelta(days=7)
+
+
+@dataclass(frozen=True)
+class RosterRules:
+    min_rest: timedelta = timedelta(hours=MIN_REST_HOURS)
+    max_shifts_per_week: int = MAX_SHIFTS_PER_WEEK
+    patients_per_nurse: float = PATIENTS_PER_NURSE
+    tasks_per_nurse: float = TASKS_PER_NURSE
+
+
+@dataclass
+class Roster:
+    assignments: List[Tuple[int, int, datetime, datetime]] = field(default_factory=list)
+    # 因护士不足（休息或周上限）未能补齐的岗位数；每个病房每班至少一人的岗位优先补齐
+    unfilled: int = 0
+    uncovered: int = 0
+    nurse_load: Dict[int, float] = field(default_factory=dict)
+
+
+def build_slots(start: datetime, shift_hours: int, shift_count: int, days: int = 1) -> List[Tuple[datetime, datetime]]:
+    """``shift_count`` consecutive shifts from ``start``, repeated every 24 hours for ``days`` days."""
+    length = timedelta(hours=shift_hours)
+    return [
+        (start + timedelta(days=day, hours=shift_hours * index), start + timedelta(days=day, hours=shift_hours * index) + length)
+        for day in range(days)
+        for index in range(shift_count)
+    ]
+
+
+def bucket_tasks(
+    slots: Sequence[Tuple[datetime, datetime]],
+    task_counts: Iterable[Tuple[int, datetime, int]],
+) -> Dict[Tuple[int, int], int]:
+    """Sum ``(ward_id, time, count)`` rows into ``(ward_id, slot index)`` buckets."""
+    starts = [slot[0] for slot in slots]
+    buckets: Dict[Tuple[int, int], int] = {}
+    for ward_id, at, count in task_counts:
+        index = bisect_right(starts, at) - 1
+        if index >= 0 and at < slots[index][1]:
+            buckets[(ward_id, index)] = buckets.get((ward_id, index), 0) + count
+    return buckets
+
+
+def _blocked_slots(
+    slots: Sequence[Tuple[datetime, datetime]],
+    existing: Iterable[Tuple[int, datetime, datetime]],
+    min_rest: timedelta,
+) -> Dict[int, Set[int]]:
+    """Slot indices each nurse cannot take because of shifts already on the books
+    (overlap, or less than ``min_rest`` before/after)."""
+    starts = [slot[0] for slot in slots]
+    length = slots[0][1] - slots[0][0]
+    blocked: Dict[int, Set[int]] = {}
+    for nurse_id, busy_start, busy_end in existing:
+        # 冲突条件：slot_start < busy_end + rest 且 slot_start + length > busy_start - rest
+        low = bisect_right(starts, busy_start - min_rest - length)
+        high = bisect_left(starts, busy_end + min_rest)
+        if low < high:
+            blocked.setdefault(nurse_id, set()).update(range(low, high))
+    return blocked
+
+
+def _shift_positions(
+    wards: Sequence[Tuple[int, int]],
+    index: int,
+    task_buckets: Dict[Tuple[int, int], int],
+    rules: RosterRules,
+) -> List[Tuple[bool, float, int, float]]:
+    """``(extra, -share, ward_id, share)`` per nurse position a shift needs, most urgent first."""
+    positions = []
+    for ward_id, inpatients in wards:
+        tasks = task_buckets.get((ward_id, index), 0)
+        if inpatients <= 0 and tasks <= 0:
+            continue
+        load = inpatients / rules.patients_per_nurse + tasks / rules.tasks_per_nurse
+        needed = max(1, math.ceil(load))
+        share = load / needed
+        positions.extend((rank > 0, -share, ward_id, share) for rank in range(needed))
+    positions.sort()
+    return positions
+
+
+def build_roster(
+    wards: Sequence[Tuple[int, int]],
+    nurse_ids: Sequence[int],
+    slots: Sequence[Tuple[datetime, datetime]],
+    task_buckets: Optional[Dict[Tuple[int, int], int]] = None,
+    existing: Iterable[Tuple[int, datetime, datetime]] = (),
+    rules: RosterRules = RosterRules(),
+) -> Roster:
+    """Assign nurses to every (ward, shift) in time order.
+
+    ``wards`` are ``(ward_id, inpatients)`` pairs. A shift's load is
+    inpatients / patients_per_nurse + tasks / tasks_per_nurse, and the ward
+    needs ``max(1, ceil(load))`` nurses; wards with neither inpatients nor
+    tasks in a shift are skipped. The first nurse of every ward comes first:
+    extra positions only draw on the weekly quota left after the base
+    positions of the rest of the week plus one shift in reserve, so early
+    shifts do not use up the nurses later ones need. Within a shift the positions with the heaviest per-nurse share
+    go to the eligible nurses with the least accumulated load. A nurse is
+    eligible if they rested ``min_rest`` since their last shift, are under
+    the weekly cap, and have no existing shift too close to this one.
+    """
+    roster = Roster(nurse_load={nurse_id: 0.0 for nurse_id in nurse_ids})
+    if not slots or not nurse_ids:
+        return roster
+    task_buckets = task_buckets or {}
+    window_start = slots[0][0]
+    existing = list(existing)
+    blocked = _blocked_slots(slots, existing, rules.min_rest)
+
+    shifts_in_week: Dict[Tuple[int, int], int] = {}
+    for nurse_id, busy_start, _ in existing:
+        if busy_start >= window_start:
+            week = (busy_start - window_start) // WEEK
+            shifts_in_week[(nurse_id, week)] = shifts_in_week.get((nurse_id, week), 0) + 1
+
+    positions_by_slot = [_shift_positions(wards, index, task_buckets, rules) for index in range(len(slots))]
+    weeks = [(slot_start - window_start) // WEEK for slot_start, _ in slots]
+    # 本周剩余班次额度须先留给后续班次“每病房一人”的岗位，另预留一个班次的人手以应对休息时间限制
+    quota: Dict[int, int] = {}
+    base_after: Dict[int, int] = {}
+    extras_after: Dict[int, int] = {}
+    reserve: Dict[int, int] = {}
+    for week, positions in zip(weeks, positions_by_slot):
+        extras = sum(1 for position in positions if position[0])
+        if week not in quota:
+            quota[week] = sum(max(rules.max_shifts_per_week - shifts_in_week.get((nurse_id, week), 0), 0) for nurse_id in nurse_ids)
+        base_after[week] = base_after.get(week, 0) + len(positions) - extras
+        extras_after[week] = extras_after.get(week, 0) + extras
+        reserve[week] = max(reserve.get(week, 0), len(positions) - extras)
+
+    free_from: Dict[int, datetime] = {}
+    shift_total = {nurse_id: 0 for nurse_id in nurse_ids}
+    for index, ((slot_start, slot_end), positions, week) in enumerate(zip(slots, positions_by_slot, weeks)):
+        if not positions:
+            continue
+        extras = sum(1 for position in positions if position[0])
+        base = len(positions) - extras
+        spare = quota[week] - base_after[week] - reserve[week]
+        ratio = min(max(spare, 0) / extras_after[week], 1.0) if extras_after[week] else 0.0
+        wanted = base + math.floor(extras * ratio)
+        base_after[week] -= base
+        extras_after[week] -= extras
+
+        eligible = [
+            nurse_id for nurse_id in nurse_ids
+            if free_from.get(nurse_id, slot_start) <= slot_start
+            and shifts_in_week.get((nurse_id, week), 0) < rules.max_shifts_per_week
+            and index not in blocked.get(nurse_id, ())
+        ]
+        staffed = positions[:min(wanted, len(eligible))]
+        roster.unfilled += len(positions) - len(staffed)
+        roster.uncovered += sum(1 for position in positions[len(staffed):] if not position[0])
+        if not staffed:
+            continue
+
+        staffed.sort(key=lambda position: position[1])
+        eligible.sort(key=lambda nurse_id: (roster.nurse_load[nurse_id], shift_total[nurse_id], nurse_id))
+        for (_, _, ward_id, share), nurse_id in zip(staffed, eligible):
+            roster.assignments.append((nurse_id, ward_id, slot_start, slot_end))
+            roster.nurse_load[nurse_id] += share
+            shift_total[nurse_id] += 1
+            shifts_in_week[(nurse_id, week)] = shifts_in_week.get((nurse_id, week), 0) + 1
+            free_from[nurse_id] = slot_end + rules.min_rest
+        quota[week] -= len(staffed)
+    return roster
+
+
+async def generate_roster(
+    session: AsyncSession,
+    wards: Sequence[Ward],
+    nurse_ids: Sequence[int],
+    slots: Sequence[Tuple[datetime, datetime]],
+    rules: RosterRules = RosterRules(),
+) -> Roster:
+    """Replace the shifts of ``wards`` inside the slots' window with a new roster.
+
+    Loads task volume and the nurses' remaining shifts with one grouped query
+    each, builds the roster in memory and writes it with batched INSERTs. The
+    caller commits.
+    """
+    ward_ids = [ward.ward_id for ward in wards]
+    window_start, window_end = slots[0][0], slots[-1][1]
+    await session.execute(
+        delete(NurseSchedule)
+        .where(NurseSchedule.ward_id.in_(ward_ids))
+        .where(NurseSchedule.start_time >= window_start)
+        .where(NurseSchedule.start_time < window_end)
+        .execution_options(synchronize_session=False)
+    )
+
+    task_stmt = (
+        select(Hospitalization.ward_id, NurseTask.time, func.count())
+        .join(Hospitalization, NurseTask.hosp_id == Hospitalization.hosp_id)
+        .where(Hospitalization.ward_id.in_(ward_ids))
+        .where(NurseTask.time >= window_start)
+        .where(NurseTask.time < window_end)
+        .group_by(Hospitalization.ward_id, NurseTask.time)
+    )
+    task_buckets = bucket_tasks(slots, (await session.execute(task_stmt)).all())
+
+    # 其他病房或时间窗外已有的班次：不能重叠，也要满足最短休息
+    margin = rules.min_rest
+    existing_stmt = (
+        select(NurseSchedule.nurse_id, NurseSchedule.start_time, NurseSchedule.end_time)
+        .where(NurseSchedule.nurse_id.in_(list(nurse_ids)))
+        .where(NurseSchedule.start_time >= window_start - margin - MAX_SHIFT)
+        .where(NurseSchedule.start_time < window_end + margin)
+    )
+    existing = (await session.execute(existing_stmt)).all()
+
+    roster = build_roster(
+        [(ward.ward_id, ward.occupied_beds) for ward in wards],
+        nurse_ids,
+        slots,
+        task_buckets,
+        existing,
+        rules,
+    )
+    rows = [
+        {"nurse_id": nurse_id, "ward_id": ward_id, "start_time": start, "end_time": end}
+        for nurse_id, ward_id, start, end in roster.assignments
+    ]
+    table = NurseSchedule.__table__
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        await session.execute(table.insert(), rows[start:start + INSERT_BATCH_SIZE])
+    return roster
+
+
+async def schedulable_nurse_ids(session: AsyncSession) -> List[int]:
+    """Non-head nurses, or every nurse if there are only head nurses."""
+    nurse_ids = (await session.execute(
+        select(Nurse.nurse_id).where(Nurse.is_head_nurse == False).order_by(Nurse.nurse_id)
+    )).scalars().all()
+    if not nurse_ids:
+        nurse_ids = (await session.execute(select(Nurse.nurse_id).order_by(Nurse.nurse_id))).scalars().all()
+    return list(nurse_ids)
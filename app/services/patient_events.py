@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict, List, Optional, Set
+
+from sqlalchemy import delete, event, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlmodel import select
+
+from app.core.time_utils import now_bj
+from app.models.hospital import PatientEvent
+
+# 事件类型
+EVENT_REGISTRATION_CANCELLED = "registration.cancelled"
+EVENT_REGISTRATION_FINISHED = "registration.finished"
+EVENT_PAYMENT_PAID = "payment.paid"
+EVENT_PAYMENT_REFUNDED = "payment.refunded"
+EVENT_HOSPITALIZATION_DISCHARGED = "hospitalization.discharged"
+# 订阅队列溢出时下发，提示客户端改为全量同步
+EVENT_RESYNC = "resync"
+
+MAX_SUBSCRIBERS = int(os.getenv("PATIENT_EVENT_MAX_SUBSCRIBERS", "20000"))
+SUBSCRIPTION_BUFFER = int(os.getenv("PATIENT_EVENT_BUFFER", "32"))
+RELAY_POLL_SECONDS = float(os.getenv("PATIENT_EVENT_POLL_SECONDS", "1.0"))
+RELAY_BATCH_SIZE = 500
+# 事件编号在提交前就已分配，编号较小的事件可能晚于编号较大的事件提交；
+# 中继每轮都回看这段时间内的事件，补发此前尚未提交而被跳过的那些
+RELAY_LOOKBACK = timedelta(seconds=float(os.getenv("PATIENT_EVENT_LOOKBACK_SECONDS", "60")))
+OUTBOX_RETENTION = timedelta(hours=int(os.getenv("PATIENT_EVENT_RETENTION_HOURS", "24")))
+OUTBOX_PURGE_INTERVAL_SECONDS = 3600
+
+_PENDING_FLAG = "patient_events_pending"
+
+
+def record_patient_event(session: AsyncSession, patient_id: int, kind: str, **payload: Any) -> None:
+    """Stage an outbox row; it becomes visible (and is pushed) only if the caller commits."""
+    session.add(PatientEvent(
+        patient_id=patient_id,
+        kind=kind,
+        payload=json.dumps(payload, ensure_ascii=False, default=str) if payload else None,
+    ))
+    session.info[_PENDING_FLAG] = True
+
+
+class SubscriberLimitExceeded(Exception):
+    pass
+
+
+class Subscription:
+    """Per-connection mailbox with a fixed-size buffer.
+
+    When the buffer overflows the oldest events are dropped and a single
+    ``resync`` marker is delivered instead, so memory per idle connection stays
+    bounded no matter how slow the client is.
+    """
+
+    __slots__ = ("patient_id", "_buffer", "_wakeup", "_overflowed")
+
+    def __init__(self, patient_id: int, buffer_size: int = SUBSCRIPTION_BUFFER):
+        self.patient_id = patient_id
+        self._buffer: Deque[Dict[str, Any]] = deque(maxlen=buffer_size)
+        self._wakeup = asyncio.Event()
+        self._overflowed = False
+
+    def push(self, item: Dict[str, Any]) -> None:
+        if len(self._buffer) == self._buffer.maxlen:
+            self._overflowed = True
+        self._buffer.append(item)
+        self._wakeup.set()
+
+    async def next_batch(self, timeout: float) -> Optional[List[Dict[str, Any]]]:
+        """Wait for events; returns ``None`` when ``timeout`` elapses with nothing to send."""
+        if not self._buffer:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        if self._overflowed:
+            self._overflowed = False
+            self._buffer.clear()
+            return [{"kind": EVENT_RESYNC}]
+        items = list(self._buffer)
+        self._buffer.clear()
+        return items
+
+
+class PatientEventBus:
+    def __init__(self, max_subscribers: int = MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self._count = 0
+
+    @property
+    def subscriber_count(self) -> int:
+        return self._count
+
+    def subscribe(self, patient_id: int) -> Subscription:
+        if self._count >= self.max_subscribers:
+            raise SubscriberLimitExceeded()
+        sub = Subscription(patient_id)
+        self._subscribers.setdefault(patient_id, set()).add(sub)
+        self._count += 1
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        bucket = self._subscribers.get(sub.patient_id)
+        if not bucket or sub not in bucket:
+            return
+        bucket.discard(sub)
+        self._count -= 1
+        if not bucket:
+            self._subscribers.pop(sub.patient_id, None)
+
+    def publish(self, patient_id: int, item: Dict[str, Any]) -> None:
+        for sub in self._subscribers.get(patient_id, ()):
+            sub.push(item)
+
+
+class OutboxRelay:
+    """Tails the ``patientevent`` outbox and fans new rows out to local subscribers.
+
+    Each worker process runs its own relay, so events committed by any worker
+    reach every connection. Commits made in this process wake the relay
+    immediately; otherwise it polls every ``RELAY_POLL_SECONDS``.
+
+    Besides rows above the high-water mark, every pass re-reads the ids created
+    within ``RELAY_LOOKBACK`` and publishes the ones not delivered yet: an id
+    allocated before a higher one may commit after it. Delivered ids are kept
+    for the length of the window to avoid sending them twice.
+    """
+
+    def __init__(self, bus: PatientEventBus, session_factory=None):
+        self.bus = bus
+        self._session_factory = session_factory
+        self._last_id: Optional[int] = None
+        self._delivered: Dict[int, datetime] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_purge = None
+
+    def wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self, session_factory=None) -> None:
+        if session_factory is not None:
+            self._session_factory = session_factory
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._wakeup = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), RELAY_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._pump()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # noqa: W0703
+                print(f"WARN: patient event relay failed: {exc}")
+
+    async def _pump(self) -> None:
+        async with self._session_factory() as session:
+            await self._maybe_purge(session)
+            if self._last_id is None or not self.bus.subscriber_count:
+                # 无人订阅时只推进高水位；回看窗口会把刚提交的事件补发给随后连上的客户端
+                self._last_id = (await session.execute(select(func.max(PatientEvent.event_id)))).scalar() or 0
+                if not self.bus.subscriber_count:
+                    return
+
+            cutoff = now_bj() - RELAY_LOOKBACK
+            self._delivered = {event_id: at for event_id, at in self._delivered.items() if at >= cutoff}
+            recent_stmt = (
+                select(PatientEvent.event_id)
+                .where(PatientEvent.created_at >= cutoff)
+                .where(PatientEvent.event_id <= self._last_id)
+            )
+            missed = sorted(
+                event_id for event_id in (await session.execute(recent_stmt)).scalars().all()
+                if event_id not in self._delivered
+            )
+            for start in range(0, len(missed), RELAY_BATCH_SIZE):
+                stmt = (
+                    select(PatientEvent)
+                    .where(PatientEvent.event_id.in_(missed[start:start + RELAY_BATCH_SIZE]))
+                    .order_by(PatientEvent.event_id.asc())
+                )
+                for row in (await session.execute(stmt)).scalars().all():
+                    self._publish(row)
+
+            while True:
+                stmt = (
+                    select(PatientEvent)
+                    .where(PatientEvent.event_id > self._last_id)
+                    .order_by(PatientEvent.event_id.asc())
+                    .limit(RELAY_BATCH_SIZE)
+                )
+                rows = (await session.execute(stmt)).scalars().all()
+                for row in rows:
+                    self._publish(row)
+                    self._last_id = row.event_id
+                if len(rows) < RELAY_BATCH_SIZE:
+                    break
+
+    def _publish(self, row: PatientEvent) -> None:
+        self._delivered[row.event_id] = row.created_at
+        self.bus.publish(row.patient_id, {
+            "event_id": row.event_id,
+            "kind": row.kind,
+            "payload": json.loads(row.payload) if row.payload else {},
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+        })
+
+    async def _maybe_purge(self, session: AsyncSession) -> None:
+        now = now_bj()
+        if self._last_purge and (now - self._last_purge).total_seconds() < OUTBOX_PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = now
+        await session.execute(delete(PatientEvent).where(PatientEvent.created_at < now - OUTBOX_RETENTION))
+        await session.commit()
+
+
+patient_event_bus = PatientEventBus()
+patient_event_relay = OutboxRelay(patient_event_bus)
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_relay_after_commit(session: Session) -> None:
+    if session.info.pop(_PENDING_FLAG, False):
+        patient_event_relay.wake()
+
+
+@event.listens_for(Session, "after_rollback")
+def _clear_pending_after_rollback(session: Session) -> None:
+    session.info.pop(_PENDING_FLAG, None)
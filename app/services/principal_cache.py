@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+
+from app.models.hospital import Doctor, Nurse, Patient
+from app.models.user import UserAccount
+
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+
+def _row_dict(obj: Any) -> Optional[Dict[str, Any]]:
+    if obj is None:
+        return None
+    return {col.name: getattr(obj, col.name) for col in type(obj).__table__.columns}
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Snapshot of an authenticated account and its role profile.
+
+    The accessors return fresh, session-less model instances so callers can
+    read them freely; anything that needs to modify the row must load it from
+    its own session.
+    """
+
+    phone: str
+    account_row: Dict[str, Any]
+    patient_row: Optional[Dict[str, Any]] = None
+    doctor_row: Optional[Dict[str, Any]] = None
+    nurse_row: Optional[Dict[str, Any]] = None
+
+    @property
+    def role(self):
+        return self.account_row["role"]
+
+    @property
+    def patient_id(self) -> Optional[int]:
+        return self.patient_row["patient_id"] if self.patient_row else None
+
+    def account(self) -> UserAccount:
+        return UserAccount(**self.account_row)
+
+    def patient(self) -> Optional[Patient]:
+        return Patient(**self.patient_row) if self.patient_row else None
+
+    def doctor(self) -> Optional[Doctor]:
+        return Doctor(**self.doctor_row) if self.doctor_row else None
+
+    def nurse(self) -> Optional[Nurse]:
+        return Nurse(**self.nurse_row) if self.nurse_row else None
+
+
+async def load_principal(session: AsyncSession, phone: str) -> Optional[Principal]:
+    """Resolve account + patient/doctor/nurse profile in a single query."""
+    stmt = (
+        select(UserAccount, Patient, Doctor, Nurse)
+        .outerjoin(Patient, Patient.phone == UserAccount.phone)
+        .outerjoin(Doctor, Doctor.phone == UserAccount.phone)
+        .outerjoin(Nurse, Nurse.phone == UserAccount.phone)
+        .where(UserAccount.phone == phone)
+    )
+    row = (await session.execute(stmt)).first()
+    if not row:
+        return None
+    account, patient, doctor, nurse = row
+    return Principal(
+        phone=phone,
+        account_row=_row_dict(account),
+        patient_row=_row_dict(patient),
+        doctor_row=_row_dict(doctor),
+        nurse_row=_row_dict(nurse),
+    )
+
+
+class PrincipalCache:
+    """Per-process TTL + LRU cache of ``Principal`` snapshots keyed by phone.
+
+    Writes that change an account or its profile call ``invalidate`` in this
+    process; other workers pick the change up once the TTL expires.
+    """
+
+    def __init__(self, ttl: float = PRINCIPAL_CACHE_TTL_SECONDS, max_size: int = PRINCIPAL_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: "OrderedDict[str, Tuple[float, Principal]]" = OrderedDict()
+
+    def get(self, phone: str) -> Optional[Principal]:
+        item = self._items.get(phone)
+        if item is None:
+            return None
+        expires_at, principal = item
+        if expires_at < time.monotonic():
+            self._items.pop(phone, None)
+            return None
+        self._items.move_to_end(phone)
+        return principal
+
+    def put(self, principal: Principal) -> None:
+        if self.ttl <= 0:
+            return
+        self._items[principal.phone] = (time.monotonic() + self.ttl, principal)
+        self._items.move_to_end(principal.phone)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, phone: Optional[str]) -> None:
+        if phone:
+            self._items.pop(phone, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+
+principal_cache = PrincipalCache()
+
+
+def invalidate_principal(phone: Optional[str]) -> None:
+    principal_cache.invalidate(phone)
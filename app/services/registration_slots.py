@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+from datetime import date
+from typing import Dict, Optional
+
+from sqlalchemy import and_, func, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+
+from app.core.sql import insert_ignore
+from app.core.time_utils import today_bj
+from app.models.hospital import Doctor, RegStatus, RegType, Registration, RegistrationSlot
+from app.models.user import UserAccount
+
+# 挂号限额：同一医生当日，专家号最多30个，普通号最多50个（不含已取消）
+SLOT_CAPACITY = {RegType.EXPERT: 30, RegType.NORMAL: 50}
+REGISTRATION_FEE = {RegType.EXPERT: 50.0, RegType.NORMAL: 10.0}
+
+_SLOT_KEY_COLUMNS = ("doctor_id", "visit_date", "reg_type")
+
+
+def normalize_reg_type(reg_type) -> RegType:
+    if isinstance(reg_type, RegType):
+        return reg_type
+    if reg_type in ("EXPERT", RegType.EXPERT.value):
+        return RegType.EXPERT
+    return RegType.NORMAL
+
+
+def _slot_key(doctor_id: int, visit_date: date, reg_type: RegType):
+    return and_(
+        RegistrationSlot.doctor_id == doctor_id,
+        RegistrationSlot.visit_date == visit_date,
+        RegistrationSlot.reg_type == reg_type,
+    )
+
+
+def _active_registration_count(doctor_id, visit_date, reg_type):
+    return (
+        select(func.count())
+        .select_from(Registration)
+        .where(Registration.doctor_id == doctor_id)
+        .where(Registration.visit_date == visit_date)
+        .where(Registration.reg_type == reg_type)
+        .where(Registration.status != RegStatus.CANCELLED)
+    )
+
+
+async def _ensure_slot(session: AsyncSession, doctor_id: int, visit_date: date, reg_type: RegType) -> None:
+    exists = (await session.execute(
+        select(RegistrationSlot.slot_id).where(_slot_key(doctor_id, visit_date, reg_type))
+    )).first()
+    if exists:
+        return
+    # 首次为该医生/日期/号别建号源时，按已有挂号（表上线前的数据）初始化已用数
+    used = (await session.execute(_active_registration_count(doctor_id, visit_date, reg_type))).scalar_one() or 0
+    await insert_ignore(
+        session,
+        RegistrationSlot.__table__,
+        {
+            "doctor_id": doctor_id,
+            "visit_date": visit_date,
+            "reg_type": reg_type,
+            "capacity": SLOT_CAPACITY[reg_type],
+            "used": used,
+        },
+        _SLOT_KEY_COLUMNS,
+    )
+
+
+async def reserve_slot(session: AsyncSession, doctor_id: int, visit_date: date, reg_type) -> bool:
+    """Atomically take one slot; returns False when the day is fully booked.
+
+    The conditional UPDATE holds the slot row lock until the caller commits,
+    so the registration insert and the counter change succeed or fail together.
+    """
+    reg_type = normalize_reg_type(reg_type)
+    await _ensure_slot(session, doctor_id, visit_date, reg_type)
+    result = await session.execute(
+        update(RegistrationSlot)
+        .where(_slot_key(doctor_id, visit_date, reg_type))
+        .where(RegistrationSlot.used < RegistrationSlot.capacity)
+        .values(used=RegistrationSlot.used + 1)
+        .execution_options(synchronize_session=False)
+    )
+    return (result.rowcount or 0) == 1
+
+
+async def release_slot(session: AsyncSession, doctor_id: int, visit_date: date, reg_type) -> None:
+    reg_type = normalize_reg_type(reg_type)
+    await session.execute(
+        update(RegistrationSlot)
+        .where(_slot_key(doctor_id, visit_date, reg_type))
+        .where(RegistrationSlot.used > 0)
+        .values(used=RegistrationSlot.used - 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def cancel_and_release_slot(session: AsyncSession, reg: Registration) -> bool:
+    """Cancel a waiting registration and give its slot back; False if it is no longer waiting.
+
+    The status change is a conditional UPDATE, so when the same registration
+    is cancelled twice concurrently only one of them releases the slot.
+    """
+    result = await session.execute(
+        update(Registration)
+        .where(Registration.reg_id == reg.reg_id)
+        .where(Registration.status == RegStatus.WAITING)
+        .values(status=RegStatus.CANCELLED)
+        .execution_options(synchronize_session=False)
+    )
+    if not result.rowcount:
+        return False
+    await release_slot(session, reg.doctor_id, reg.visit_date, reg.reg_type)
+    return True
+
+
+async def resync_slots(session: AsyncSession, from_date: Optional[date] = None) -> int:
+    """Recompute ``used`` from the registration table for today and later dates."""
+    from_date = from_date or today_bj()
+    counted = (
+        select(func.count())
+        .select_from(Registration)
+        .where(Registration.doctor_id == RegistrationSlot.doctor_id)
+        .where(Registration.visit_date == RegistrationSlot.visit_date)
+        .where(Registration.reg_type == RegistrationSlot.reg_type)
+        .where(Registration.status != RegStatus.CANCELLED)
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        update(RegistrationSlot)
+        .where(RegistrationSlot.visit_date >= from_date)
+        .values(used=counted)
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return result.rowcount or 0
+
+
+async def department_availability(session: AsyncSession, dept_id: int, visit_date: date) -> list:
+    """Remaining slots for every enabled doctor in a department, in a single query."""
+    stmt = (
+        select(Doctor, RegistrationSlot.reg_type, RegistrationSlot.capacity, RegistrationSlot.used)
+        .join(UserAccount, Doctor.phone == UserAccount.phone)
+        .outerjoin(
+            RegistrationSlot,
+            and_(
+                RegistrationSlot.doctor_id == Doctor.doctor_id,
+                RegistrationSlot.visit_date == visit_date,
+            ),
+        )
+        .where(Doctor.dept_id == dept_id)
+        .where(UserAccount.status == "启用")
+        .order_by(Doctor.doctor_id)
+    )
+    by_doctor: Dict[int, dict] = {}
+    for doctor, reg_type, capacity, used in (await session.execute(stmt)).all():
+        item = by_doctor.get(doctor.doctor_id)
+        if item is None:
+            item = {
+                "doctor_id": doctor.doctor_id,
+                "name": doctor.name,
+                "title": doctor.title,
+                "visit_date": visit_date,
+                "remaining": {t.value: SLOT_CAPACITY[t] for t in RegType},
+                "capacity": {t.value: SLOT_CAPACITY[t] for t in RegType},
+            }
+            by_doctor[doctor.doctor_id] = item
+        if reg_type is not None:
+            key = normalize_reg_type(reg_type).value
+            item["capacity"][key] = capacity
+            item["remaining"][key] = max(capacity - used, 0)
+    return list(by_doctor.values())
@@ -84,6 +84,7 @@ export interface AutoSchedulePayload {
   start_time?: string;
   shift_hours?: number;
   shift_count?: number;
+  days?: number;
   ward_ids?: number[];
 }
 
@@ -186,3 +186,38 @@ export function payPayment(paymentId: number) {
 export function refundPayment(paymentId: number) {
   return http.post(`/api/payments/${paymentId}/refund`);
 }
+
+export interface NotificationFeedPayment {
+  payment_id: number;
+  type: string;
+  amount: number;
+  time: string;
+  status: string;
+  reg_id?: number | null;
+}
+
+export interface NotificationFeedRegistration {
+  reg_id: number;
+  visit_date?: string;
+  status: string;
+  doctor_id: number;
+}
+
+export interface NotificationFeed {
+  cursor: string;
+  full: boolean;
+  payments: NotificationFeedPayment[];
+  registrations: NotificationFeedRegistration[];
+  badges: {
+    unpaid: number;
+    refundable: number;
+    today_visits: number;
+  };
+  next_poll_ms: number;
+}
+
+export function fetchNotificationFeed(cursor?: string | null) {
+  return http.get<NotificationFeed>(`/api/notifications/feed`, {
+    params: cursor ? { cursor } : undefined
+  });
+}
@@ -2,7 +2,11 @@ import { computed, ref } from "vue";
 import { defineStore } from "pinia";
 
 import { useAuthStore } from "./auth";
-import { fetchMyPayments, fetchMyRegistrations, type PaymentItem, type RegistrationItem } from "../api/modules/patient";
+import {
+  fetchNotificationFeed,
+  type NotificationFeedPayment,
+  type NotificationFeedRegistration
+} from "../api/modules/patient";
 
 type NoticeItem = {
   key: string;
@@ -18,10 +22,30 @@ export const useNotificationStore = defineStore("notifications", () => {
 
   const notifications = ref<NoticeItem[]>([]);
   const pollingId = ref<number | null>(null);
+  const badges = ref({ unpaid: 0, refundable: 0, today_visits: 0 });
+
+  // Delta-sync state: server cursor, the local day it was issued on, and current reminders by key.
+  let cursor: string | null = null;
+  let cursorDay = "";
+  let fallbackIntervalMs = 15000;
+
+  // Server push: while the event stream is connected, polling only runs as a slow safety net.
+  const STREAM_SAFETY_POLL_MS = 300000;
+  const STREAM_EVENT_KINDS = [
+    "registration.cancelled",
+    "registration.finished",
+    "payment.paid",
+    "payment.refunded",
+    "hospitalization.discharged",
+    "resync"
+  ];
+  let eventSource: EventSource | null = null;
+  const streamConnected = ref(false);
+  const noticeMap = new Map<string, { notice: NoticeItem; sortTime: number; sortId: number }>();
 
   const isEnabled = computed(() => auth.isAuthenticated && auth.currentRole === "患者");
 
-  function buildPaymentNotice(payment: PaymentItem): NoticeItem {
+  function buildPaymentNotice(payment: NotificationFeedPayment): NoticeItem {
     const typeText = payment.type || "缴费";
 
     if (payment.status === "待退费" && typeText === "挂号费") {
@@ -43,7 +67,7 @@ export const useNotificationStore = defineStore("notifications", () => {
     };
   }
 
-  function buildTodayVisitNotice(reg: RegistrationItem): NoticeItem {
+  function buildTodayVisitNotice(reg: NotificationFeedRegistration): NoticeItem {
     return {
       key: `reg-${reg.reg_id}`,
       kind: "registration",
@@ -82,85 +106,155 @@ export const useNotificationStore = defineStore("notifications", () => {
     return s;
   }
 
-  async function syncPaymentsOnce() {
-    if (!isEnabled.value) return;
-
-    let payments: PaymentItem[] = [];
-    let regs: RegistrationItem[] = [];
-    try {
-      const [payRes, regRes] = await Promise.all([fetchMyPayments(), fetchMyRegistrations()]);
-      payments = Array.isArray(payRes.data) ? payRes.data : [];
-      regs = Array.isArray(regRes.data) ? regRes.data : [];
-    } catch {
-      // ignore polling errors; UI should still work without hard-failing
-      return;
-    }
-
-    // Always reflect current unpaid payments (including historical);
-    // once paid, it disappears from the list.
-    const unpaid = payments
-      .filter((p) => {
-        if (typeof p?.payment_id !== "number") return false;
-        if (p.status === "未缴费") return true;
-        if (p.status === "待退费" && p.type === "挂号费") return true;
-        return false;
-      })
-      .sort((a, b) => {
-        const tb = parseTime((b as any).time);
-        const ta = parseTime((a as any).time);
-        if (tb !== ta) return tb - ta;
-        return (b.payment_id ?? 0) - (a.payment_id ?? 0);
-      });
+  function isPaymentNoticeWorthy(p: NotificationFeedPayment): boolean {
+    if (typeof p?.payment_id !== "number") return false;
+    if (p.status === "未缴费") return true;
+    if (p.status === "待退费" && p.type === "挂号费") return true;
+    return false;
+  }
 
-    const map = new Map<string, NoticeItem>();
-    for (const p of unpaid) {
-      const notice = buildPaymentNotice(p);
-      map.set(notice.key, notice);
+  function applyPayments(payments: NotificationFeedPayment[]) {
+    for (const p of payments) {
+      const key = `payment-${p.payment_id}`;
+      if (isPaymentNoticeWorthy(p)) {
+        noticeMap.set(key, { notice: buildPaymentNotice(p), sortTime: parseTime(p.time), sortId: p.payment_id });
+      } else {
+        noticeMap.delete(key);
+      }
     }
+  }
 
-    // Appointment-day reminder
+  function applyRegistrations(regs: NotificationFeedRegistration[]) {
     const today = todayYmd();
     for (const r of regs) {
-      const vd = toYmd((r as any).visit_date as any);
-      const status = normalizeRegistrationStatus((r as any).status);
+      const key = `reg-${r.reg_id}`;
+      const vd = toYmd(r.visit_date);
+      const status = normalizeRegistrationStatus(r.status);
       // Only remind when: local today matches visit_date AND still waiting (排队中).
       // Do NOT remind for "就诊中" / "已完成" / "已取消" / "已过期" etc.
       if (vd && vd === today && status === "排队中") {
-        const notice = buildTodayVisitNotice(r);
-        map.set(notice.key, notice);
+        noticeMap.set(key, { notice: buildTodayVisitNotice(r), sortTime: -1, sortId: r.reg_id });
+      } else {
+        noticeMap.delete(key);
       }
     }
+  }
+
+  function rebuildNotifications() {
+    // Payments newest first, then appointment-day reminders.
+    const entries = Array.from(noticeMap.values()).sort((a, b) => {
+      if (b.sortTime !== a.sortTime) return b.sortTime - a.sortTime;
+      return b.sortId - a.sortId;
+    });
+    notifications.value = entries.slice(0, 200).map((entry) => entry.notice);
+  }
+
+  async function syncPaymentsOnce(): Promise<number | null> {
+    if (!isEnabled.value) return null;
+
+    // Visit-day reminders depend on the local date, so start over from a full snapshot each day.
+    const today = todayYmd();
+    if (cursorDay !== today) {
+      cursor = null;
+    }
+
+    let feed;
+    try {
+      const res = await fetchNotificationFeed(cursor);
+      feed = res.data;
+    } catch {
+      // ignore polling errors; UI should still work without hard-failing
+      return null;
+    }
+
+    if (feed.full) {
+      noticeMap.clear();
+    }
+    applyPayments(Array.isArray(feed.payments) ? feed.payments : []);
+    applyRegistrations(Array.isArray(feed.registrations) ? feed.registrations : []);
+    rebuildNotifications();
 
-    notifications.value = Array.from(map.values());
+    badges.value = feed.badges ?? badges.value;
+    cursor = feed.cursor ?? null;
+    cursorDay = today;
+    return typeof feed.next_poll_ms === "number" && feed.next_poll_ms > 0 ? feed.next_poll_ms : null;
+  }
+
+  function scheduleNext(delayMs: number) {
+    pollingId.value = window.setTimeout(async () => {
+      const suggested = await syncPaymentsOnce();
+      if (pollingId.value === null) return;
+      const next = suggested ?? fallbackIntervalMs;
+      scheduleNext(streamConnected.value ? Math.max(next, STREAM_SAFETY_POLL_MS) : next);
+    }, delayMs);
+  }
+
+  function reschedule(delayMs: number) {
+    if (pollingId.value === null) return;
+    window.clearTimeout(pollingId.value);
+    scheduleNext(delayMs);
+  }
 
-    if (notifications.value.length > 200) {
-      notifications.value = notifications.value.slice(0, 200);
+  function openStream() {
+    if (eventSource || typeof window.EventSource === "undefined") return;
+    const token = window.localStorage.getItem("hms-token");
+    if (!token) return;
+
+    eventSource = new EventSource(`/api/events/stream?token=${encodeURIComponent(token)}`);
+    eventSource.addEventListener("ready", () => {
+      streamConnected.value = true;
+      // Catch up on anything missed while disconnected.
+      void syncPaymentsOnce();
+    });
+    for (const kind of STREAM_EVENT_KINDS) {
+      eventSource.addEventListener(kind, () => {
+        void syncPaymentsOnce();
+      });
+    }
+    eventSource.onerror = () => {
+      // EventSource reconnects by itself; fall back to normal polling in the meantime.
+      if (streamConnected.value) {
+        streamConnected.value = false;
+        reschedule(fallbackIntervalMs);
+      }
+    };
+  }
+
+  function closeStream() {
+    if (eventSource) {
+      eventSource.close();
+      eventSource = null;
     }
+    streamConnected.value = false;
   }
 
   function startPolling(intervalMs = 15000) {
     if (!isEnabled.value) return;
     if (pollingId.value !== null) return;
-    void syncPaymentsOnce();
-
-    pollingId.value = window.setInterval(() => {
-      void syncPaymentsOnce();
-    }, intervalMs);
+    fallbackIntervalMs = intervalMs;
+    openStream();
+    scheduleNext(0);
   }
 
   function stopPolling() {
+    closeStream();
     if (pollingId.value !== null) {
-      window.clearInterval(pollingId.value);
+      window.clearTimeout(pollingId.value);
       pollingId.value = null;
     }
   }
 
   function clearNotifications() {
     notifications.value = [];
+    noticeMap.clear();
+    cursor = null;
+    cursorDay = "";
+    badges.value = { unpaid: 0, refundable: 0, today_visits: 0 };
   }
 
   return {
     notifications,
+    badges,
     startPolling,
     stopPolling,
     clearNotifications,